@@ -0,0 +1,365 @@
+"""
+Alignment backends.
+
+An alignment backend aligns an adapter template or barcode (target) to a
+read window and reports score, position of the last aligned bp in the read
+and, if requested, the number of matches. Backends are registered by name
+(see register_backend) and selected with qcatConfig.align_backend
+(--align-backend), so that different alignment engines can be used and
+benchmarked (qcat-benchmark --align-backends) on the same reads.
+
+All backends run semi-global alignments with free end gaps in the read.
+"""
+from __future__ import print_function
+
+import logging
+import sys
+
+from collections import namedtuple
+
+try:
+    import parasail
+except ImportError as e:
+    logging.error("Could not load parasail library. Please try reinstalling "
+                  "parasail using pip.")
+    sys.exit(1)
+
+from qcat import vectorized
+
+
+if parasail.can_use_sse2():
+    parasail_sg_stat = parasail.sg_stats_striped_32
+    parasail_sg = parasail.sg_striped_32
+    parasail_profile_create = parasail.profile_create_32
+    parasail_sg_profile = parasail.sg_striped_profile_32
+    # Narrower striped variants (see ALIGN_PRECISION_AUTO)
+    parasail_sg_stat_narrow = {8: parasail.sg_stats_striped_8,
+                               16: parasail.sg_stats_striped_16}
+    parasail_sg_narrow = {8: parasail.sg_striped_8,
+                          16: parasail.sg_striped_16}
+    parasail_profile_narrow = {8: (parasail.profile_create_8,
+                                   parasail.sg_striped_profile_8),
+                               16: (parasail.profile_create_16,
+                                    parasail.sg_striped_profile_16)}
+else:
+    logging.warning("Warning: SSE not supported, falling back to standard alignment")
+    parasail_sg_stat = parasail.sg_stats
+    parasail_sg = parasail.sg
+    parasail_profile_create = None
+    parasail_sg_profile = None
+    parasail_sg_stat_narrow = {}
+    parasail_sg_narrow = {}
+    parasail_profile_narrow = {}
+
+# Alignment precision (qcatConfig.align_precision)
+# 32: always use 32 bit scores
+# auto: use 8 or 16 bit scores if the best possible alignment score fits and
+# re-run the alignment with 32 bit scores if parasail reports saturation.
+# Note: parasail's striped alignment is not exact, 8/16 bit alignments can
+# report slightly different scores or end positions than 32 bit alignments.
+ALIGN_PRECISION_32 = "32"
+ALIGN_PRECISION_AUTO = "auto"
+ALIGN_PRECISIONS = [ALIGN_PRECISION_32, ALIGN_PRECISION_AUTO]
+
+# Number of alignments run with 8/16 bit scores and number of those that
+# saturated and were re-run with 32 bit scores. Counted per process, worker
+# processes send their counts back with their results (see parallel
+# module).
+precision_stats = {"narrow": 0, "fallback": 0}
+
+
+def get_precision_stats():
+    """
+    Returns how many alignments were run with 8/16 bit scores (narrow) and
+    how many of those had to be re-run with 32 bit scores (fallback) in this
+    process
+
+    :return: dict
+    """
+    return dict(precision_stats)
+
+
+def get_precision_delta(before):
+    """
+    Counts added to precision_stats since before
+
+    :param before: Result of get_precision_stats
+    :return: dict
+    """
+    return dict((key, count - before[key])
+                for key, count in precision_stats.items())
+
+
+def add_precision_stats(delta):
+    """
+    Adds counts of another process to precision_stats
+
+    :param delta: Result of get_precision_delta
+    :return: None
+    """
+    for key, count in delta.items():
+        precision_stats[key] += count
+
+
+def get_alignment_width(query_length, ref_length, matrix, qcat_config):
+    """
+    Returns the narrowest score width (8, 16 or 32 bit) that can hold the
+    best possible score of a semi-global alignment
+
+    :param query_length: Length of s1
+    :param ref_length: Length of s2
+    :param matrix: parasail scoring matrix
+    :param qcat_config: qcatConfig object
+    :return: int
+    """
+    if qcat_config.align_precision != ALIGN_PRECISION_AUTO or \
+            not parasail_sg_narrow:
+        return 32
+    max_score = min(query_length, ref_length) * matrix.max
+    if max_score < 127:
+        return 8
+    if max_score < 32767:
+        return 16
+    return 32
+
+
+def align_sg(read_sequence, target, gap_open, gap_extend, matrix,
+             qcat_config, stats=False):
+    """
+    Semi-global alignment of target to the read using the precision
+    selected by qcatConfig.align_precision. Saturated 8/16 bit alignments
+    are repeated with 32 bit scores.
+
+    :param read_sequence: Query sequence (s1)
+    :param target: Reference sequence (s2)
+    :param gap_open: Gap open penalty
+    :param gap_extend: Gap extension penalty
+    :param matrix: parasail scoring matrix
+    :param qcat_config: qcatConfig object
+    :param stats: Compute alignment statistics (matches, length)
+    :return: parasail Result
+    """
+    width = get_alignment_width(len(read_sequence), len(target), matrix,
+                                qcat_config)
+    if width < 32:
+        if stats:
+            align = parasail_sg_stat_narrow[width]
+        else:
+            align = parasail_sg_narrow[width]
+        result = align(read_sequence, target, gap_open, gap_extend, matrix)
+        precision_stats["narrow"] += 1
+        if not result.saturated:
+            return result
+        precision_stats["fallback"] += 1
+
+    if stats:
+        align = parasail_sg_stat
+    else:
+        align = parasail_sg
+    return align(s1=read_sequence,
+                 s2=target,
+                 open=gap_open,
+                 extend=gap_extend,
+                 matrix=matrix)
+
+
+class ReadProfile(object):
+    """
+    parasail query profiles of a read window. Profiles for each score width
+    are created when first needed (see get_alignment_width).
+    """
+
+    def __init__(self, read_sequence, matrix, qcat_config):
+        """
+        :param read_sequence: Read window (query of all alignments)
+        :param matrix: parasail scoring matrix
+        :param qcat_config: qcatConfig object
+        """
+        self.read_sequence = read_sequence
+        self.matrix = matrix
+        self.qcat_config = qcat_config
+        self.profiles = {}
+
+    def get_profile(self, width):
+        """
+        :param width: Score width (8, 16 or 32)
+        :return: parasail profile, alignment function
+        """
+        if width not in self.profiles:
+            if width < 32:
+                create, align = parasail_profile_narrow[width]
+            else:
+                create, align = parasail_profile_create, parasail_sg_profile
+            self.profiles[width] = (create(self.read_sequence, self.matrix),
+                                    align)
+        return self.profiles[width]
+
+    def align(self, target, gap_open, gap_extend):
+        """
+        Semi-global alignment of target to the read window
+
+        :param target: Reference sequence (s2)
+        :param gap_open: Gap open penalty
+        :param gap_extend: Gap extension penalty
+        :return: parasail Result
+        """
+        width = get_alignment_width(len(self.read_sequence), len(target),
+                                    self.matrix, self.qcat_config)
+        if width < 32:
+            profile, align = self.get_profile(width)
+            result = align(profile, target, gap_open, gap_extend)
+            precision_stats["narrow"] += 1
+            if not result.saturated:
+                return result
+            precision_stats["fallback"] += 1
+
+        profile, align = self.get_profile(32)
+        return align(profile, target, gap_open, gap_extend)
+
+
+# Result of AlignBackend.align. Attributes have the same names as in
+# parasail results, so both can be used interchangeably
+AlignResult = namedtuple("AlignResult",
+                         "score end_query matches length saturated")
+
+
+class AlignBackend(object):
+    """
+    Base class for alignment backends
+    """
+
+    # Name used for qcatConfig.align_backend and --align-backend
+    name = None
+
+    def align(self, read_sequence, target, gap_open, gap_extend, matrix,
+              qcat_config, stats=False):
+        """
+        Semi-global alignment of target to the read window
+
+        :param read_sequence: Read window (s1)
+        :param target: Adapter template or barcode (s2)
+        :param gap_open: Gap open penalty
+        :param gap_extend: Gap extension penalty
+        :param matrix: parasail scoring matrix
+        :param qcat_config: qcatConfig object
+        :param stats: Compute number of matches and alignment length
+        :return: Alignment result with score, end_query (position of the
+        last aligned bp in the read), matches and length attributes
+        """
+        raise NotImplementedError("Abstract class")
+
+    def create_profile(self, read_sequence, matrix, qcat_config):
+        """
+        Prepares a read window for many alignments with the same matrix.
+        The returned object has an align(target, gap_open, gap_extend)
+        method.
+
+        :param read_sequence: Read window
+        :param matrix: parasail scoring matrix
+        :param qcat_config: qcatConfig object
+        :return: Profile or None if the backend doesn't use profiles
+        """
+        return None
+
+
+class ParasailBackend(AlignBackend):
+    """
+    Aligns each read window/target pair with parasail (striped if SSE2 is
+    available, see align_sg)
+    """
+
+    name = "parasail"
+
+    def align(self, read_sequence, target, gap_open, gap_extend, matrix,
+              qcat_config, stats=False):
+        return align_sg(read_sequence, target, gap_open, gap_extend, matrix,
+                        qcat_config, stats)
+
+
+class ParasailProfileBackend(ParasailBackend):
+    """
+    Builds the striped query profile of a read window once and reuses it
+    for all adapter templates (or barcodes). Gives the same results as
+    ParasailBackend.
+    """
+
+    name = "parasail-profile"
+
+    def create_profile(self, read_sequence, matrix, qcat_config):
+        """
+        The read window is always the query (s1) of the alignment: swapping
+        query and adapter would allow profiling the adapters once per kit,
+        but striped semi-global alignment in parasail is not symmetric, so
+        scores and end positions would change.
+        """
+        if not read_sequence or parasail_sg_profile is None:
+            return None
+        return ReadProfile(read_sequence, matrix, qcat_config)
+
+
+class NumpyBackend(AlignBackend):
+    """
+    Exact semi-global alignment in NumPy (see vectorized.align_target).
+    Scores and end positions are those of parasail.sg, which can differ
+    slightly from the striped parasail alignments used by ParasailBackend.
+    Matches and alignment length are not computed: alignments with stats
+    (identity of adapters and barcodes) are run with parasail.
+    """
+
+    name = "numpy"
+
+    def align(self, read_sequence, target, gap_open, gap_extend, matrix,
+              qcat_config, stats=False):
+        if stats or not read_sequence or not target:
+            return align_sg(read_sequence, target, gap_open, gap_extend,
+                            matrix, qcat_config, stats)
+        score, end = vectorized.align_target(read_sequence, target, matrix,
+                                             gap_open, gap_extend)
+        return AlignResult(score, end, 0, 0, False)
+
+
+# Registered backends by name
+_backends = {}
+# Backend names in order of registration
+_backend_names = []
+
+
+def register_backend(backend):
+    """
+    Makes an alignment backend available to qcatConfig.align_backend.
+    Registering a backend with the name of an existing one replaces it.
+
+    :param backend: AlignBackend
+    :return: None
+    """
+    if backend.name not in _backends:
+        _backend_names.append(backend.name)
+    _backends[backend.name] = backend
+
+
+def get_backend(name):
+    """
+    :param name: Name of a registered backend
+    :return: AlignBackend
+    """
+    try:
+        return _backends[name]
+    except KeyError:
+        raise RuntimeError("Unknown alignment backend: {}. Must be one of "
+                           "{}".format(name, ", ".join(_backend_names)))
+
+
+def get_backend_names():
+    """
+    :return: Names of all registered backends
+    """
+    return list(_backend_names)
+
+
+ALIGN_BACKEND_PARASAIL = ParasailBackend.name
+ALIGN_BACKEND_PROFILE = ParasailProfileBackend.name
+ALIGN_BACKEND_NUMPY = NumpyBackend.name
+
+register_backend(ParasailBackend())
+register_backend(ParasailProfileBackend())
+register_backend(NumpyBackend())
@@ -0,0 +1,569 @@
+"""
+Benchmarks for barcode detection.
+
+Measures the throughput (reads per second) of batch barcode detection for
+different parallel backends and numbers of workers. Reads are loaded into
+memory first and the time needed to start the workers is not included, so
+only barcode detection is measured. Results are compared to a
+single-threaded run to make sure all configurations call the same barcodes.
+
+With --compiled-kit, single-threaded detection with precompiled adapter
+layouts (see layout.CompiledKit) is compared to detection that recomputes
+alignment targets, lengths and normalization constants for every read.
+With --reuse-alignments, single-threaded detection that reuses the adapter
+alignments of kit detection is compared to detection that aligns the
+adapters of the detected kit again.
+With --align-backends, single-threaded detection is compared between
+alignment backends (see align module).
+With --streaming, the single-read streaming path of --no-batch
+(cli.stream_reads) is compared to running single reads through batches of
+one read and the pipeline. Reads are read from the input files and written
+as TSV to memory. The per-read overhead is measured with a scanner that
+returns the same result for every read, and then with barcode detection.
+"""
+from __future__ import print_function
+
+import itertools
+import logging
+import sys
+import time
+
+import six
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from qcat import __version__, align, cli, config, parallel, pipeline
+from qcat.scanner import factory
+from qcat.scanner_base import build_return_dict
+
+
+def parse_args(argv):
+    """
+    Commandline parser
+
+    :param argv: Command line arguments
+    :type argv: List
+    :return: None
+    """
+    usage = "Benchmark barcode detection throughput"
+    parser = ArgumentParser(description=usage,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-V", '--version',
+                        action='version',
+                        version='%(prog)s ' + __version__)
+    parser.add_argument('-l', "--log",
+                        dest="log",
+                        type=str,
+                        default="INFO",
+                        help="Print debug information")
+    parser.add_argument("-f", "--fastq",
+                        type=str,
+                        dest="fastq",
+                        nargs="+",
+                        required=True,
+                        help="Barcoded read file(s)")
+    parser.add_argument("-t", "--threads",
+                        dest="threads",
+                        type=int,
+                        nargs="+",
+                        default=[1, 2, 4, 8],
+                        help="Numbers of workers to benchmark "
+                             "(default: 1 2 4 8)")
+    parser.add_argument("--backends",
+                        dest="backends",
+                        nargs="+",
+                        choices=parallel.BACKENDS,
+                        default=parallel.BACKENDS,
+                        help="Parallel backends to benchmark "
+                             "(default: all)")
+    parser.add_argument("--max-reads",
+                        dest="max_reads",
+                        type=int,
+                        default=20000,
+                        help="Number of reads used for benchmarking "
+                             "(default: 20000)")
+    parser.add_argument("--batch-size",
+                        dest="batch_size",
+                        type=int,
+                        default=4000,
+                        help="Number of reads per batch (default: 4000)")
+    parser.add_argument("--repeats",
+                        dest="repeats",
+                        type=int,
+                        default=1,
+                        help="Repeat each measurement and report the "
+                             "fastest run (default: 1)")
+    parser.add_argument("-k", "--kit",
+                        dest="kit",
+                        type=str,
+                        default="auto",
+                        help="Sequencing kit (default: auto)")
+    parser.add_argument("--mode",
+                        dest="mode",
+                        type=str,
+                        default="epi2me",
+                        help="Demultiplexing mode (default: epi2me)")
+    parser.add_argument("--compiled-kit",
+                        dest="compiled_kit",
+                        action="store_true",
+                        help="Measure the per-read overhead removed by "
+                             "precompiled adapter layouts instead of thread "
+                             "scaling")
+    parser.add_argument("--reuse-alignments",
+                        dest="reuse_alignments",
+                        action="store_true",
+                        help="Measure the time saved by reusing the adapter "
+                             "alignments of kit detection instead of thread "
+                             "scaling")
+    parser.add_argument("--align-backends",
+                        dest="align_backends",
+                        nargs="+",
+                        choices=align.get_backend_names(),
+                        help="Compare alignment backends instead of "
+                             "measuring thread scaling")
+    parser.add_argument("--streaming",
+                        action="store_true",
+                        help="Measure the per-read overhead of --no-batch "
+                             "with and without single-read streaming "
+                             "instead of thread scaling")
+
+    return parser.parse_args(argv)
+
+
+def load_batches(filenames, batch_size, max_reads):
+    """
+    Read up to max_reads reads into memory
+
+    :param filenames: FASTQ/FASTA files, folders or glob patterns
+    :param batch_size: Number of reads per batch
+    :param max_reads: Maximum number of reads
+    :return: List of read sequence lists, list of read quality lists
+    """
+    filenames = cli.get_input_files(filenames)
+    fastq = cli.is_fastq_files(filenames)
+
+    batches = []
+    n = 0
+    for names, comments, seqs, quals in cli.iter_fastx_files(filenames, fastq,
+                                                             batch_size):
+        seqs = seqs[:max_reads - n]
+        batches.append((seqs, quals[:len(seqs)]))
+        n += len(seqs)
+        if n >= max_reads:
+            break
+    return batches
+
+
+def get_calls(results):
+    """
+    Barcode call and trimming positions of each read. Used to check that
+    all benchmarked configurations give the same results.
+
+    :param results: List of barcode result dicts
+    :return: List of tuples
+    """
+    calls = []
+    for result in results:
+        barcode = None
+        if result['barcode']:
+            barcode = result['barcode'].id
+        calls.append((barcode, result['trim5p'], result['trim3p']))
+    return calls
+
+
+def time_detection(detector, batches, qcat_config, repeats=1):
+    """
+    Run batch barcode detection and measure the time it takes
+
+    :param detector: BarcodeScanner
+    :param batches: see load_batches
+    :param qcat_config: qcatConfig object
+    :param repeats: Number of runs
+    :return: Time of fastest run in seconds, barcode calls (see get_calls)
+    """
+    best = None
+    calls = []
+    for _ in range(max(1, repeats)):
+        calls = []
+        start = time.time()
+        for seqs, quals in batches:
+            calls += get_calls(detector.detect_barcode_batch(seqs, quals,
+                                                             qcat_config))
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, calls
+
+
+def run_thread_scaling(batches, backends, thread_counts, mode, kit,
+                       qcat_config, repeats=1):
+    """
+    Measures how throughput scales with the number of workers for each
+    parallel backend
+
+    :param batches: see load_batches
+    :param backends: List of parallel backends (see parallel.BACKENDS)
+    :param thread_counts: List of numbers of workers
+    :param mode: Demultiplexing mode
+    :param kit: Sequencing kit
+    :param qcat_config: qcatConfig object
+    :param repeats: Number of runs per configuration
+    :return: List of dicts (one per configuration)
+    """
+    n_reads = sum(len(seqs) for seqs, _ in batches)
+
+    detector = factory(mode=mode, kit=kit)
+    serial_time, expected = time_detection(detector, batches, qcat_config,
+                                           repeats)
+    detector.close()
+
+    rows = [{"backend": "serial",
+             "threads": 1,
+             "reads": n_reads,
+             "seconds": serial_time,
+             "speedup": 1.0,
+             "same_calls": True}]
+
+    for backend in backends:
+        for threads in thread_counts:
+            if threads < 2:
+                continue
+            detector = factory(mode=mode, kit=kit, threads=threads,
+                               parallel_backend=backend)
+            try:
+                elapsed, calls = time_detection(detector, batches,
+                                                qcat_config, repeats)
+            finally:
+                detector.close()
+            rows.append({"backend": backend,
+                         "threads": threads,
+                         "reads": n_reads,
+                         "seconds": elapsed,
+                         "speedup": serial_time / max(elapsed, 1e-9),
+                         "same_calls": calls == expected})
+    return rows
+
+
+def compare_scanner_setting(batches, mode, kit, qcat_config, attribute,
+                            repeats=1):
+    """
+    Times detection with a boolean attribute of the BarcodeScanner switched
+    off and on. Both settings are measured alternately, so that caches warmed
+    up by the first run don't favour the second one
+
+    :param batches: see load_batches
+    :param mode: Demultiplexing mode
+    :param kit: Sequencing kit
+    :param qcat_config: qcatConfig object
+    :param attribute: Name of the BarcodeScanner attribute
+    :param repeats: Number of runs per setting
+    :return: Best time without and with the setting, True if both settings
+    called the same barcodes
+    :rtype: float, float, bool
+    """
+    disabled_time = None
+    enabled_time = None
+    detector = factory(mode=mode, kit=kit)
+    try:
+        for repeat in range(max(1, repeats)):
+            for enabled in [repeat % 2 == 1, repeat % 2 == 0]:
+                setattr(detector, attribute, enabled)
+                elapsed, result = time_detection(detector, batches,
+                                                 qcat_config)
+                if enabled:
+                    calls = result
+                    enabled_time = min(enabled_time or elapsed, elapsed)
+                else:
+                    expected = result
+                    disabled_time = min(disabled_time or elapsed, elapsed)
+    finally:
+        detector.close()
+
+    return disabled_time, enabled_time, calls == expected
+
+
+def get_setting_rows(n_reads, names, disabled_time, enabled_time,
+                     same_calls):
+    """
+    Result rows of compare_scanner_setting
+
+    :param n_reads: Number of reads
+    :param names: Names of the disabled and enabled setting
+    :return: List of dicts (see run_thread_scaling)
+    """
+    return [{"backend": names[0],
+             "threads": 1,
+             "reads": n_reads,
+             "seconds": disabled_time,
+             "speedup": 1.0,
+             "same_calls": True},
+            {"backend": names[1],
+             "threads": 1,
+             "reads": n_reads,
+             "seconds": enabled_time,
+             "speedup": disabled_time / max(enabled_time, 1e-9),
+             "same_calls": same_calls}]
+
+
+def run_compiled_kit(batches, mode, kit, qcat_config, repeats=1):
+    """
+    Measures the time saved by precompiled adapter layouts
+    (see BarcodeScanner.precompile_layouts)
+
+    :param batches: see load_batches
+    :param mode: Demultiplexing mode
+    :param kit: Sequencing kit
+    :param qcat_config: qcatConfig object
+    :param repeats: Number of runs per configuration
+    :return: List of dicts (see run_thread_scaling)
+    """
+    n_reads = sum(len(seqs) for seqs, _ in batches)
+
+    baseline_time, compiled_time, same_calls = compare_scanner_setting(
+        batches, mode, kit, qcat_config, "precompile_layouts", repeats)
+
+    logging.info("Per-read overhead removed by compiled layouts: "
+                 "{:.1f} us".format((baseline_time - compiled_time) * 1e6 /
+                                    max(n_reads, 1)))
+    return get_setting_rows(n_reads, ["uncompiled", "compiled"],
+                            baseline_time, compiled_time, same_calls)
+
+
+def run_reuse_alignments(batches, mode, kit, qcat_config, repeats=1):
+    """
+    Measures the time saved by reusing the adapter alignments of kit
+    detection for barcode detection
+    (see BarcodeScanner.reuse_adapter_alignments)
+
+    :param batches: see load_batches
+    :param mode: Demultiplexing mode
+    :param kit: Sequencing kit
+    :param qcat_config: qcatConfig object
+    :param repeats: Number of runs per configuration
+    :return: List of dicts (see run_thread_scaling)
+    """
+    n_reads = sum(len(seqs) for seqs, _ in batches)
+
+    realign_time, reuse_time, same_calls = compare_scanner_setting(
+        batches, mode, kit, qcat_config, "reuse_adapter_alignments", repeats)
+
+    logging.info("Time saved per read by reusing adapter alignments: "
+                 "{:.1f} us".format((realign_time - reuse_time) * 1e6 /
+                                    max(n_reads, 1)))
+    return get_setting_rows(n_reads, ["realign", "reuse"],
+                            realign_time, reuse_time, same_calls)
+
+
+def run_align_backends(batches, backends, mode, kit, qcat_config,
+                       repeats=1):
+    """
+    Compares single-threaded barcode detection with different alignment
+    backends. Calls are compared to the first backend.
+
+    :param batches: see load_batches
+    :param backends: List of alignment backend names
+    (see align.get_backend_names)
+    :param mode: Demultiplexing mode
+    :param kit: Sequencing kit
+    :param qcat_config: qcatConfig object
+    :param repeats: Number of runs per backend
+    :return: List of dicts (see run_thread_scaling)
+    """
+    n_reads = sum(len(seqs) for seqs, _ in batches)
+    align_backend = qcat_config.align_backend
+
+    rows = []
+    expected = None
+    first_time = None
+    detector = factory(mode=mode, kit=kit)
+    try:
+        for backend in backends:
+            qcat_config.align_backend = backend
+            elapsed, calls = time_detection(detector, batches, qcat_config,
+                                            repeats)
+            if expected is None:
+                expected = calls
+                first_time = elapsed
+            rows.append({"backend": backend,
+                         "threads": 1,
+                         "reads": n_reads,
+                         "seconds": elapsed,
+                         "speedup": first_time / max(elapsed, 1e-9),
+                         "same_calls": calls == expected})
+    finally:
+        qcat_config.align_backend = align_backend
+        detector.close()
+    return rows
+
+
+class ConstantScanner(object):
+    """
+    Returns the same barcode result for every read. Used instead of a
+    BarcodeScanner to measure the overhead of reading and writing reads.
+    """
+
+    def __init__(self):
+        self.result = build_return_dict(best_barcode=None,
+                                        best_barcode_score=0.0,
+                                        best_adapter=None,
+                                        best_adapter_end=0,
+                                        exit_status=0)
+
+    def detect_barcode(self, read_sequence, read_qualities, qcat_config):
+        return self.result
+
+
+def time_no_batch(filenames, detector, qcat_config, max_reads, streaming):
+    """
+    Demultiplex single reads as with --no-batch and measure the time it
+    takes
+
+    :param filenames: FASTQ/FASTA files (see cli.get_input_files)
+    :param detector: BarcodeScanner or ConstantScanner
+    :param qcat_config: qcatConfig object
+    :param max_reads: Maximum number of reads
+    :param streaming: Use cli.stream_reads, batches of one read run
+    through the pipeline otherwise
+    :return: Time in seconds, TSV output
+    :rtype: float, str
+    """
+    fastq = cli.is_fastq_files(filenames)
+
+    def detect(batch):
+        names, comments, seqs, quals = batch
+        return [detector.detect_barcode(read_sequence=seqs[0],
+                                        read_qualities=quals[0],
+                                        qcat_config=qcat_config)]
+
+    stdout = sys.stdout
+    sys.stdout = six.StringIO()
+    try:
+        writer = cli.ResultWriter(out=None, tsv=True, output=None,
+                                  fastq=fastq, trim=False,
+                                  min_read_length=0)
+        start = time.time()
+        if streaming:
+            cli.stream_reads(
+                itertools.islice(cli.iter_fastx_files_reads(filenames,
+                                                            fastq),
+                                 max_reads),
+                detector, writer, qcat_config)
+        else:
+            pipeline.Pipeline(sizeof=cli.get_batch_bytes).run(
+                itertools.islice(cli.iter_fastx_files(filenames, fastq, 1),
+                                 max_reads),
+                detect,
+                writer.write)
+        elapsed = time.time() - start
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    return elapsed, output
+
+
+def run_streaming(filenames, mode, kit, qcat_config, max_reads, repeats=1):
+    """
+    Measures the per-read overhead removed by single-read streaming
+    (see cli.stream_reads). Both paths are measured alternately.
+
+    :param filenames: FASTQ/FASTA files, folders or glob patterns
+    :param mode: Demultiplexing mode
+    :param kit: Sequencing kit
+    :param qcat_config: qcatConfig object
+    :param max_reads: Maximum number of reads
+    :param repeats: Number of runs per configuration
+    :return: List of dicts (see run_thread_scaling)
+    """
+    filenames = cli.get_input_files(filenames)
+
+    rows = []
+    for name, detector in [("none", ConstantScanner()),
+                           (mode, factory(mode=mode, kit=kit))]:
+        times = {}
+        outputs = {}
+        for repeat in range(max(1, repeats)):
+            for streaming in [repeat % 2 == 1, repeat % 2 == 0]:
+                elapsed, outputs[streaming] = time_no_batch(
+                    filenames, detector, qcat_config, max_reads, streaming)
+                times[streaming] = min(times.get(streaming, elapsed),
+                                       elapsed)
+        if name != "none":
+            detector.close()
+
+        n_reads = outputs[True].count("\n") - 1
+        logging.info("Per-read overhead removed by streaming (detection: "
+                     "{}): {:.1f} us".format(name,
+                                             (times[False] - times[True]) *
+                                             1e6 / max(n_reads, 1)))
+        rows += get_setting_rows(n_reads,
+                                 ["batch-1:" + name, "stream:" + name],
+                                 times[False], times[True],
+                                 outputs[True] == outputs[False])
+    return rows
+
+
+def print_rows(rows, out=sys.stdout):
+    """
+    Print benchmark results as TSV
+
+    :param rows: see run_thread_scaling
+    :return: None
+    """
+    print("backend", "threads", "reads", "seconds", "reads_per_second",
+          "speedup", "same_calls", sep="\t", file=out)
+    for row in rows:
+        print(row["backend"],
+              row["threads"],
+              row["reads"],
+              "{:.3f}".format(row["seconds"]),
+              "{:.1f}".format(row["reads"] / max(row["seconds"], 1e-9)),
+              "{:.2f}".format(row["speedup"]),
+              row["same_calls"],
+              sep="\t", file=out)
+
+
+def main(argv=sys.argv[1:]):
+    """
+    Command line interface to the qcat benchmarks
+
+    :param argv: Command line arguments
+    :type argv: list
+    :return: None
+    :rtype: NoneType
+    """
+    args = parse_args(argv=argv)
+
+    numeric_level = getattr(logging, args.log.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % args.log.upper())
+    logging.basicConfig(level=numeric_level, format='%(message)s')
+
+    qcat_config = config.get_default_config()
+    if args.streaming:
+        print_rows(run_streaming(args.fastq, args.mode, args.kit,
+                                 qcat_config, args.max_reads, args.repeats))
+        return
+
+    batches = load_batches(args.fastq, args.batch_size, args.max_reads)
+    logging.info("Benchmarking with {} reads".format(
+        sum(len(seqs) for seqs, _ in batches)))
+
+    if args.align_backends:
+        rows = run_align_backends(batches, args.align_backends, args.mode,
+                                  args.kit, qcat_config, args.repeats)
+    elif args.compiled_kit:
+        rows = run_compiled_kit(batches, args.mode, args.kit, qcat_config,
+                                args.repeats)
+    elif args.reuse_alignments:
+        rows = run_reuse_alignments(batches, args.mode, args.kit,
+                                    qcat_config, args.repeats)
+    else:
+        rows = run_thread_scaling(batches, args.backends, args.threads,
+                                  args.mode, args.kit, qcat_config,
+                                  args.repeats)
+    print_rows(rows)
+
+
+if __name__ == '__main__':
+
+    main()
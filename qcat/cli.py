@@ -1,18 +1,23 @@
 from __future__ import print_function
 
+import glob
+import json
 import logging
 import time
 import sys
 import os
 import six
+import zlib
 
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter, ArgumentTypeError
 
-from qcat import __version__, adapters, config
+from qcat import __version__, adapters, align, config, kit_detection, \
+    parallel, pipeline, scheduler, spill
 from qcat import scanner
+from qcat import scanner_base
 from qcat.adapters import Barcode
 from qcat.scanner import get_modes, factory, get_kits_info, get_kits
 
@@ -39,6 +44,50 @@ def check_minqual_arg(x):
     return x
 
 
+def check_recheck_rate_arg(x):
+    x = float(x)
+    if x < 0.0 or x > 1.0:
+        raise ArgumentTypeError("Re-check rate must be a value between 0 and 1.")
+    return x
+
+
+def check_batch_size_arg(x):
+    if str(x).lower() == scheduler.BATCH_SIZE_AUTO:
+        return scheduler.BATCH_SIZE_AUTO
+    try:
+        x = int(x)
+    except ValueError:
+        raise ArgumentTypeError("Batch size must be a number or auto.")
+    if x < 1:
+        raise ArgumentTypeError("Batch size must be at least 1.")
+    return x
+
+
+def check_positive_arg(x):
+    x = float(x)
+    if x <= 0.0:
+        raise ArgumentTypeError("Value must be greater than 0.")
+    return x
+
+
+def check_shard_arg(x):
+    """
+    Parses --shard i/N
+
+    :param x: Argument string
+    :return: Shard number (1-based), number of shards
+    :rtype: tuple
+    """
+    try:
+        shard, shards = [int(value) for value in str(x).split("/")]
+    except ValueError:
+        raise ArgumentTypeError("Shard must be given as i/N, e.g. 1/4.")
+    if shards < 1 or shard < 1 or shard > shards:
+        raise ArgumentTypeError("Shard must be given as i/N with "
+                                "1 <= i <= N.")
+    return shard, shards
+
+
 def check_kit_arg(x):
     x = str(x)
     if x.lower() == "dual":
@@ -80,7 +129,10 @@ def parse_args(argv):
     general_group.add_argument("-f", "--fastq",
                         type=str,
                         dest="fastq",
-                        help="Barcoded read file")
+                        nargs="+",
+                        help="Barcoded read file(s). Accepts files, folders "
+                             "(all FASTQ/FASTA files in the folder) and glob "
+                             "patterns (e.g. 'fastq_pass/*.fastq')")
     general_group.add_argument('-b', "--barcode_dir",
                         dest="barcode_dir",
                         type=str,
@@ -108,7 +160,124 @@ def parse_args(argv):
                         dest="threads",
                         type=int,
                         default=1,
-                        help="Number of threads. Only works with in guppy mode")
+                        help="Number of threads. In epi2me, dual and simple "
+                             "mode reads are processed by <threads> workers "
+                             "(batch mode only, see --parallel-backend)")
+    general_group.add_argument("--parallel-backend",
+                               dest="parallel_backend",
+                               choices=parallel.BACKENDS,
+                               default=parallel.PROCESS,
+                               help="Run the workers used with -t/--threads "
+                                    "as processes or as threads sharing one "
+                                    "barcode scanner (default: process)")
+    general_group.add_argument("--concurrent-ends",
+                               dest="concurrent_ends",
+                               action='store_true',
+                               help="Scan the 5' and 3' end (and the middle "
+                                    "with --detect-middle) of each read "
+                                    "concurrently. In dual mode, both "
+                                    "barcode sets are aligned concurrently "
+                                    "too. Reduces the time per read, mainly "
+                                    "useful with --no-batch")
+    general_group.add_argument("--align-backend",
+                               dest="align_backend",
+                               choices=align.get_backend_names(),
+                               default=align.ALIGN_BACKEND_PARASAIL,
+                               help="parasail: align adapters and barcodes "
+                                    "to each read separately. "
+                                    "parasail-profile: compute the alignment "
+                                    "profile of each read end once and reuse "
+                                    "it for all adapters and barcodes. Same "
+                                    "results, faster when many adapters or "
+                                    "barcodes are aligned. numpy: exact "
+                                    "alignment in NumPy, slower, mainly for "
+                                    "comparing alignment engines "
+                                    "(default: parasail)")
+    general_group.add_argument("--align-precision",
+                               dest="align_precision",
+                               choices=align.ALIGN_PRECISIONS,
+                               default=align.ALIGN_PRECISION_32,
+                               help="32: align with 32 bit scores. auto: use "
+                                    "8 or 16 bit scores where possible and "
+                                    "re-run saturated alignments with 32 bit. "
+                                    "Can change a small fraction of alignment "
+                                    "scores. With -l DEBUG, the number of "
+                                    "re-run alignments is reported "
+                                    "(default: 32)")
+    general_group.add_argument("--adapter-prefilter",
+                               dest="adapter_prefilter",
+                               action='store_true',
+                               help="Only align adapters that share k-mers "
+                                    "with the read end. Faster when the kit "
+                                    "is not known (-k auto), but can miss "
+                                    "the best adapter for a small fraction "
+                                    "of reads")
+    general_group.add_argument("--barcode-prefilter",
+                               dest="barcode_prefilter",
+                               action='store_true',
+                               help="First align the barcodes that share "
+                                    "the most q-grams with the barcode "
+                                    "region of the read. All barcodes are "
+                                    "aligned unless no other barcode can "
+                                    "score higher")
+    general_group.add_argument("--early-termination",
+                               dest="early_termination",
+                               action='store_true',
+                               help="Skip adapters and barcodes that can "
+                                    "not reach the best score found so far "
+                                    "(upper bound from shared q-grams). "
+                                    "Does not change results. Mainly faster "
+                                    "for kits with 96 barcodes")
+    general_group.add_argument("--barcode-backend",
+                               dest="barcode_backend",
+                               choices=scanner_base.BARCODE_BACKENDS,
+                               default=scanner_base.BARCODE_BACKEND_PARASAIL,
+                               help="parasail: score barcodes by semi-global "
+                                    "alignment. myers: score all barcodes of "
+                                    "a kit at once by bit-parallel edit "
+                                    "distance. Faster for large barcode "
+                                    "sets, but barcode scores can differ "
+                                    "slightly. numpy: align all barcodes of "
+                                    "a kit at once, same scores as parasail. "
+                                    "Only faster with --dual, where the "
+                                    "barcodes of a whole batch are aligned "
+                                    "together (default: parasail)")
+    general_group.add_argument("--banded-barcodes",
+                               dest="banded_barcodes",
+                               action='store_true',
+                               help="With --barcode-backend numpy, only "
+                                    "align barcodes within 11 bp (the "
+                                    "extension of the barcode region) of "
+                                    "the position expected from the adapter "
+                                    "alignment. Faster, scores can be lower "
+                                    "if the barcode is shifted further")
+    general_group.add_argument("--output-order",
+                               dest="output_order",
+                               choices=pipeline.OUTPUT_ORDERS,
+                               default=pipeline.ORDERED,
+                               help="ordered: reads are written in input "
+                                    "order. unordered: when running with "
+                                    "multiple threads, batches of reads are "
+                                    "written as soon as they are processed. "
+                                    "Reads within a batch keep their order "
+                                    "(default: ordered)")
+    general_group.add_argument("--shard",
+                               dest="shard",
+                               type=check_shard_arg,
+                               default=None,
+                               help="Only process reads in shard i of N "
+                                    "(e.g. 1/4). Reads are assigned to "
+                                    "shards by a hash of the read id. Use "
+                                    "qcat-merge to combine the results of "
+                                    "all shards.")
+    general_group.add_argument("--summary",
+                               dest="summary",
+                               type=str,
+                               default=None,
+                               help="Write adapter/barcode histograms to this "
+                                    "file (JSON). Required to merge the "
+                                    "summaries of sharded runs with "
+                                    "qcat-merge.")
     general_group.add_argument("--min-read-length",
                                dest="min_length",
                                type=int,
@@ -166,10 +335,67 @@ def parse_args(argv):
                               dest="nobatch",
                               action='store_true',
                               help="Don't use information from multiple reads for kit detection (default: false)")
+    epi2me_group.add_argument("--batch-size",
+                              dest="batch_size",
+                              type=check_batch_size_arg,
+                              default=scheduler.DEFAULT_BATCH_SIZE,
+                              help="Number of reads per batch. The kit is "
+                                   "detected and rare barcodes are filtered "
+                                   "per batch. auto: size batches from the "
+                                   "time and memory per read of recent "
+                                   "batches (see --batch-seconds, "
+                                   "--batch-memory), at least {} reads "
+                                   "(default: {})".format(
+                                       scheduler.MIN_BATCH_SIZE,
+                                       scheduler.DEFAULT_BATCH_SIZE))
+    epi2me_group.add_argument("--batch-seconds",
+                              dest="batch_seconds",
+                              type=check_positive_arg,
+                              default=scheduler.DEFAULT_BATCH_SECONDS,
+                              help="Target time per batch with --batch-size "
+                                   "auto (default: {:.0f})".format(
+                                       scheduler.DEFAULT_BATCH_SECONDS))
+    epi2me_group.add_argument("--batch-memory",
+                              dest="batch_memory",
+                              type=check_positive_arg,
+                              default=scheduler.DEFAULT_BATCH_MEMORY / 1e6,
+                              help="Maximum size of the reads of a batch in "
+                                   "MB with --batch-size auto. Exceeded if "
+                                   "needed for the minimum batch size "
+                                   "(default: {:.0f})".format(
+                                       scheduler.DEFAULT_BATCH_MEMORY / 1e6))
     epi2me_group.add_argument("--filter-barcodes",
                               dest="FILTER_BARCODES",
                               action='store_true',
                               help="Filter rare barcode calls when run in batch mode")
+    epi2me_group.add_argument("--filter-scope",
+                              dest="filter_scope",
+                              choices=spill.FILTER_SCOPES,
+                              default=spill.FILTER_SCOPE_BATCH,
+                              help="batch: --filter-barcodes compares the "
+                                   "barcode counts within each batch of "
+                                   "reads. run: compares the barcode counts "
+                                   "of the whole run. Results are kept in a "
+                                   "temporary file and the input is read "
+                                   "twice, so reading from stdin is not "
+                                   "supported (default: batch)")
+    epi2me_group.add_argument("--sticky-kit",
+                              dest="sticky_kit",
+                              action='store_true',
+                              help="Detect the kit from the first batches "
+                                   "of reads only. Once a kit clearly "
+                                   "dominates (sequential test on the "
+                                   "number of reads per kit), later batches "
+                                   "only scan a sample of the reads to "
+                                   "re-check the kit (batch mode only)")
+    epi2me_group.add_argument("--kit-recheck-rate",
+                              dest="kit_recheck_rate",
+                              type=check_recheck_rate_arg,
+                              default=kit_detection.DEFAULT_RECHECK_RATE,
+                              help="Fraction of reads used to re-check the "
+                                   "kit with --sticky-kit. 0 disables "
+                                   "re-checking (default: {})".format(
+                                       kit_detection.DEFAULT_RECHECK_RATE))
 
     simple_group = parser.add_argument_group('Simple options (only valid with --simple)')
     simple_group.add_argument("--simple-barcodes",
@@ -232,21 +458,119 @@ def is_fastq(filename):
                            "'@' or '>'. Current file starts with: " + c)
 
 
-def iter_fastx(reads_fx, fastq, batchsize):
+FASTX_EXTENSIONS = (".fastq", ".fq", ".fasta", ".fa")
+
+
+def get_input_files(paths):
     """
-    Return iterator for FASTA/Q file
+    Expands folders and glob patterns given to -f/--fastq
 
-    :param reads_fx: filename of FASTX file
+    :param paths: List of files, folders or glob patterns. None or empty
+    for stdin
+    :type paths: List
+    :return: List of files. [None] if reading from stdin
+    :rtype: List
+    """
+    if not paths:
+        return [None]
+    if isinstance(paths, six.string_types):
+        paths = [paths]
+
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            folder_files = []
+            for filename in glob.glob(os.path.join(path, "*")):
+                if os.path.isfile(filename) and \
+                        filename.lower().endswith(FASTX_EXTENSIONS):
+                    folder_files.append(filename)
+            if not folder_files:
+                raise ValueError("No FASTQ/FASTA files found in {}".format(path))
+            filenames += sorted(folder_files)
+        elif os.path.exists(path):
+            filenames.append(path)
+        else:
+            matches = sorted(glob.glob(path))
+            if not matches:
+                raise IOError("Input file not found: {}".format(path))
+            filenames += matches
+
+    return filenames
+
+
+def is_fastq_files(filenames):
+    """
+    Checks that all input files have the same format
+
+    :param filenames: List of files (see get_input_files)
+    :return: True for FASTQ, False for FASTA
+    """
+    formats = set(is_fastq(filename) for filename in filenames)
+    if len(formats) > 1:
+        raise ValueError("Input files must either all be FASTQ or all be "
+                         "FASTA files.")
+    return formats.pop()
+
+
+def in_shard(name, shard):
+    """
+    Checks whether a read belongs to a shard. Reads are assigned by the
+    CRC32 of their read id, which is stable across platforms and Python
+    versions (unlike hash()).
+
+    :param name: Read id
+    :type name: str
+    :param shard: Shard number (1-based), number of shards. None for all
+    reads
+    :type shard: tuple
+    :return: bool
+    """
+    if not shard:
+        return True
+    i, n = shard
+    return zlib.crc32(name.encode("utf-8")) % n == i - 1
+
+
+def get_batch_limits(batchsize):
+    """
+    Limits for the next batch read by iter_fastx
+
+    :param batchsize: Number of reads per batch or scheduler.BatchSizer
+    :return: Maximum number of reads, maximum bytes (None for no limit),
+    minimum number of reads before the byte limit applies
+    :rtype: int, int, int
+    """
+    if isinstance(batchsize, scheduler.BatchSizer):
+        return batchsize.get_limits()
+    return batchsize, None, batchsize
+
+
+def iter_fastx_files(filenames, fastq, batchsize, shard=None):
+    """
+    Return iterator over multiple FASTA/Q files. Batches never contain reads
+    from more than one file.
+
+    :param filenames: List of files (see get_input_files)
+    :param batchsize: see iter_fastx
+    :param shard: see in_shard
     :return: None
     """
-    # batch = []
+    for filename in filenames:
+        for batch in iter_fastx(filename, fastq, batchsize, shard):
+            yield batch
 
-    names = []
-    comments = []
-    seqs = []
-    quals = []
 
-    # fastq = is_fastq(reads_fx)
+def iter_fastx_reads(reads_fx, fastq, shard=None):
+    """
+    Return iterator over the reads of a FASTA/Q file. Used directly for
+    single-read streaming (--no-batch) and by iter_fastx for batches.
+
+    :param reads_fx: filename of FASTX file, None for stdin (FASTQ only)
+    :param fastq: File is FASTQ (FASTA otherwise)
+    :param shard: Only return reads in this shard (see in_shard)
+    :return: Generator of name, comment, sequence, quality tuples. Quality
+    is None for FASTA
+    """
     if fastq:
 
         if reads_fx:
@@ -259,50 +583,84 @@ def iter_fastx(reads_fx, fastq, batchsize):
         try:
             for title, seq, qual in FastqGeneralIterator(f):
                 name, comment = extract_fastx_comment(title)
-
-                # batch.append((name, comment, seq, qual))
-                names.append(name)
-                comments.append(comment)
-                seqs.append(seq)
-                quals.append(qual)
-
-                if len(names) >= batchsize:
-                    yield names, comments, seqs, quals
-                    # batch = []
-                    names = []
-                    comments = []
-                    seqs = []
-                    quals = []
+                if not in_shard(name, shard):
+                    continue
+                yield name, comment, seq, qual
         except ValueError as e:
             logging.error(e.message)
             sys.exit(1)
 
         if reads_fx:
             logging.debug("Closing file {}".format(reads_fx))
-
-                # yield name, comment, seq, qual
+            f.close()
 
     else:
         with open(reads_fx) as f:
             for title, seq in SimpleFastaParser(f):
                 name, comment = extract_fastx_comment(title)
+                if not in_shard(name, shard):
+                    continue
+                yield name, comment, seq, None
+
+
+def iter_fastx_files_reads(filenames, fastq, shard=None):
+    """
+    Return iterator over the reads of multiple FASTA/Q files
+
+    :param filenames: List of filenames, None for stdin
+    :param fastq: Files are FASTQ (FASTA otherwise)
+    :param shard: see iter_fastx_reads
+    :return: Generator of reads (see iter_fastx_reads)
+    """
+    for filename in filenames:
+        for read in iter_fastx_reads(filename, fastq, shard):
+            yield read
 
-                # batch.append((name, comment, seq, None))
-                names.append(name)
-                comments.append(comment)
-                seqs.append(seq)
-                quals.append(None)
 
-                if len(names) >= batchsize:
-                    yield names, comments, seqs, quals
-                    # batch = []
-                    names = []
-                    comments = []
-                    seqs = []
-                    quals = []
+def iter_fastx(reads_fx, fastq, batchsize, shard=None):
+    """
+    Return iterator for FASTA/Q file
+
+    :param reads_fx: filename of FASTX file
+    :param batchsize: Number of reads per batch or scheduler.BatchSizer.
+    With a BatchSizer, the limits are updated for every batch and batches
+    also end when their reads exceed the memory ceiling
+    (see get_batch_limits)
+    :param shard: Only return reads in this shard (see in_shard). Reads of
+    other shards are skipped before batching.
+    :return: Generator of names, comments, sequences, qualities lists
+    """
+    max_reads, max_bytes, min_reads = get_batch_limits(batchsize)
+    batch_bytes = 0
+
+    names = []
+    comments = []
+    seqs = []
+    quals = []
+
+    for name, comment, seq, qual in iter_fastx_reads(reads_fx, fastq, shard):
+        names.append(name)
+        comments.append(comment)
+        seqs.append(seq)
+        quals.append(qual)
+
+        if max_bytes:
+            # Same as get_batch_bytes
+            batch_bytes += len(name) + len(comment or "") + len(seq) + \
+                len(qual or "")
+
+        if len(names) >= max_reads or \
+                (max_bytes and batch_bytes >= max_bytes and
+                 len(names) >= min_reads):
+            yield names, comments, seqs, quals
+            names = []
+            comments = []
+            seqs = []
+            quals = []
+            max_reads, max_bytes, min_reads = get_batch_limits(batchsize)
+            batch_bytes = 0
 
     if len(names) > 0:
-        # yield batch
         yield names, comments, seqs, quals
 
 
@@ -442,15 +800,277 @@ def write_multiplexing_result(barcode_dict, comment, name, sequence, tsv):
                   sep='\t')
 
 
+class ResultWriter(object):
+    """
+    Writer stage of the demultiplexing pipeline. Owns all output files,
+    writes reads and TSV lines and records which adapters/barcodes were found
+    """
+
+    def __init__(self, out, tsv, output, fastq, trim, min_read_length):
+        """
+        Init
+
+        :param out: Folder reads will be written to (one file per barcode)
+        :param tsv: Print TSV to stdout
+        :param output: File trimmed reads will be written to (default: stdout)
+        :param fastq: Input is FASTQ (FASTA otherwise)
+        :param trim: Remove adapter and barcode sequences from reads
+        :param min_read_length: Reads shorter than this are skipped
+        """
+        self.out = out
+        self.tsv = tsv
+        self.output = output
+        self.fastq = fastq
+        self.notrimming = not trim
+        self.min_read_length = min_read_length
+
+        self.total_reads = 0
+        self.skipped_reads = 0
+        self.barcode_dist = {}
+        self.adapter_dist = {}
+
+        self.output_files = {}
+        self.trimmed_output_file = sys.stdout
+        if output:
+            self.trimmed_output_file = open(output, "w")
+
+        if out:
+            if not os.path.exists(out):
+                os.makedirs(out)
+
+        if tsv:
+            print("name", "length", "barcode", "score", "kit",
+                  "adapter_end", "comment", sep="\t")
+
+    def write(self, batch, results):
+        """
+        Writes a batch of reads and their barcode results
+
+        :param batch: names, comments, sequences, qualities
+        :param results: List of barcode result dicts
+        :return: None
+        """
+        names, comments, seqs, quals = batch
+        for name, comment, sequence, quality, result in zip(names,
+                                                            comments,
+                                                            seqs,
+                                                            quals,
+                                                            results):
+            self.write_read(name, comment, sequence, quality, result)
+
+    def write_read(self, name, comment, sequence, quality, result):
+        """
+        Writes a single read and its barcode result
+
+        :param name: Read name
+        :param comment: Read comment, None if missing
+        :param sequence: Read sequence
+        :param quality: Read qualities, None for FASTA
+        :param result: Barcode result dict
+        :return: None
+        """
+        self.total_reads += 1
+
+        if not self.notrimming:
+            trim_5p = result["trim5p"]
+            trim_3p = result["trim3p"]
+            sequence = sequence[trim_5p:trim_3p]
+            if quality:
+                quality = quality[trim_5p:trim_3p]
+
+        if len(sequence) < self.min_read_length:
+            self.skipped_reads += 1
+            return
+
+        # Record which adapter/barcode was found
+        barcode_found(self.barcode_dist, result['barcode'])
+        adapter_found(self.adapter_dist, result['adapter'])
+
+        # Write tsv result file
+        write_multiplexing_result(result,
+                                  comment,
+                                  name,
+                                  sequence,
+                                  self.tsv)
+        # Write FASTQ/A files
+        if self.out or not self.tsv:
+            write_to_file(self.trimmed_output_file,
+                          self.output_files,
+                          self.out,
+                          name,
+                          comment,
+                          sequence,
+                          quality,
+                          self.fastq,
+                          result)
+
+    def close(self):
+        """
+        Close all output files
+
+        :return: None
+        """
+        if self.out:
+            close_files(self.output_files)
+
+        if self.output:
+            self.trimmed_output_file.close()
+
+    def get_summary(self):
+        """
+        Adapter/barcode histograms of all reads written so far
+
+        :return: dict, see get_summary
+        """
+        return get_summary(self.total_reads, self.skipped_reads,
+                           self.barcode_dist, self.adapter_dist)
+
+    def print_summary(self):
+        """
+        Log adapter/barcode histograms
+
+        :return: None
+        """
+        print_summary(self.get_summary())
+
+
+def get_summary(total_reads, skipped_reads, barcode_dist, adapter_dist):
+    """
+    Adapter/barcode histograms of a run as written by --summary
+
+    :return: dict
+    """
+    return {"total_reads": total_reads,
+            "skipped_reads": skipped_reads,
+            "barcodes": barcode_dist,
+            "adapters": adapter_dist}
+
+
+def write_summary(summary, filename):
+    """
+    Write summary (see get_summary) to JSON file
+
+    :return: None
+    """
+    with open(filename, "w") as fh:
+        json.dump(summary, fh, indent=2, sort_keys=True)
+
+
+def read_summary(filename):
+    """
+    Read summary (see get_summary) from JSON file
+
+    :return: dict
+    """
+    with open(filename) as fh:
+        return json.load(fh)
+
+
+def print_summary(summary):
+    """
+    Log adapter/barcode histograms
+
+    :param summary: see get_summary
+    :return: None
+    """
+    print_barcode_hist(summary["barcodes"], summary["adapters"],
+                       summary["total_reads"])
+    if summary["skipped_reads"] > 0:
+        logging.info("{} reads were skipped due to the min. length filter.".format(summary["skipped_reads"]))
+
+
+def get_batch_bytes(batch):
+    """
+    Approximate memory used by the reads of a batch
+
+    :param batch: names, comments, sequences, qualities
+    :return: Number of bytes
+    :rtype: int
+    """
+    total = 0
+    for values in batch:
+        for value in values:
+            if value:
+                total += len(value)
+    return total
+
+
+def iter_offsets(batches):
+    """
+    Adds the offset of the first read in the run to each batch
+
+    :param batches: Generator of batches (see iter_fastx)
+    :return: Generator of offset, batch tuples
+    """
+    offset = 0
+    for batch in batches:
+        yield offset, batch
+        offset += len(batch[0])
+
+
+def write_filtered(batches, spill_file, detector, writer):
+    """
+    Second pass of --filter-scope run: removes rare barcodes from the
+    spilled results using the barcode counts of the whole run and writes the
+    reads
+
+    :param batches: Generator of batches (see iter_fastx), same reads as in
+    the first pass
+    :param spill_file: spill.SpillFile written by the first pass
+    :param detector: BarcodeScanner
+    :param writer: ResultWriter
+    :return: None
+    """
+    logging.debug("Filtering barcodes of {} reads, {} barcodes found".format(
+        spill_file.n_reads, len(spill_file.barcode_count)))
+    results = spill_file.iter_results()
+    for batch in batches:
+        batch_results = [next(results) for _ in batch[0]]
+        writer.write(batch, detector.filter_barcodes(spill_file.barcode_count,
+                                                     batch_results))
+
+
+def stream_reads(reads, detector, writer, qcat_config):
+    """
+    Single-read streaming path of --no-batch: each read is demultiplexed
+    and written before the next read is parsed, without batches or pipeline
+    threads
+
+    :param reads: Generator of reads (see iter_fastx_reads)
+    :param detector: BarcodeScanner
+    :param writer: ResultWriter
+    :param qcat_config: qcatConfig object
+    :return: None
+    """
+    detect_barcode = detector.detect_barcode
+    write_read = writer.write_read
+    for name, comment, seq, qual in reads:
+        write_read(name, comment, seq, qual,
+                   detect_barcode(read_sequence=seq,
+                                  read_qualities=qual,
+                                  qcat_config=qcat_config))
+
+
 def qcat_cli(reads_fq, kit, mode, nobatch, out,
                min_qual, tsv, output, threads, trim, adapter_yaml, quiet, filter_barcodes, middle_adapter, min_read_length,
-               qcat_config):
+               qcat_config, queue_size=pipeline.DEFAULT_QUEUE_SIZE,
+               output_order=pipeline.ORDERED, shard=None, summary=None,
+               parallel_backend=parallel.PROCESS, concurrent_ends=False,
+               sticky_kit=False,
+               kit_recheck_rate=kit_detection.DEFAULT_RECHECK_RATE,
+               filter_scope=spill.FILTER_SCOPE_BATCH,
+               batch_size=scheduler.DEFAULT_BATCH_SIZE,
+               batch_seconds=scheduler.DEFAULT_BATCH_SECONDS,
+               batch_memory=scheduler.DEFAULT_BATCH_MEMORY):
     """
     Runs barcode detection for each read in the fastq file
-    and print the read name + the barcode to a tsv file
+    and print the read name + the barcode to a tsv file.
+    Reading, barcode detection and writing run concurrently
+    (see pipeline.Pipeline)
 
-    :param reads_fq: Path to fastq file
-    :type reads_fq: str
+    :param reads_fq: Path(s) to FASTQ files, folders or glob patterns
+    (see get_input_files). None for stdin
+    :type reads_fq: List
     :param no_header: Print header or not for output tsv file
     :type no_header: bool
     :param kit: Which kit was used for sequencing
@@ -464,103 +1084,148 @@ def qcat_cli(reads_fq, kit, mode, nobatch, out,
     :type nobatch: bool
     :param qcat_config: qcatConfig object
     :type qcat_config: qcatConfig
+    :param queue_size: Maximum number of batches waiting between pipeline
+    stages
+    :type queue_size: int
+    :param output_order: Write reads in input order (ordered) or batches as
+    soon as they are processed (unordered)
+    :type output_order: str
+    :param shard: Only process reads of this shard (see in_shard)
+    :type shard: tuple
+    :param summary: Write adapter/barcode histograms to this JSON file
+    :type summary: str
+    :param parallel_backend: Run workers as processes or threads (see
+    parallel.BACKENDS)
+    :type parallel_backend: str
+    :param concurrent_ends: Scan both ends of a read concurrently
+    :type concurrent_ends: bool
+    :param sticky_kit: Keep the kit detected in previous batches (see
+    kit_detection)
+    :type sticky_kit: bool
+    :param kit_recheck_rate: Fraction of reads used to re-check the kit
+    with sticky_kit
+    :type kit_recheck_rate: float
+    :param filter_scope: Filter rare barcodes per batch or for the whole run
+    (see spill)
+    :type filter_scope: str
+    :param batch_size: Number of reads per batch or
+    scheduler.BATCH_SIZE_AUTO for adaptive batch sizes (see
+    scheduler.BatchSizer)
+    :param batch_seconds: Target time per batch with adaptive batch sizes
+    :type batch_seconds: float
+    :param batch_memory: Memory ceiling in bytes for the reads of a batch
+    with adaptive batch sizes
+    :type batch_memory: int
     :return: None
     """
 
-    total_reads = 0
-    skipped_reads = 0
-    barcode_dist = {}
-    adapter_dist = {}
+    filenames = get_input_files(reads_fq)
+    fastq = is_fastq_files(filenames)
 
-    notrimming = not trim
+    run_filter = filter_barcodes and filter_scope == spill.FILTER_SCOPE_RUN
+    if run_filter and None in filenames:
+        raise ValueError("--filter-scope run needs input files, reads from "
+                         "stdin can not be read twice")
 
     detector = factory(mode=mode,
                        kit=kit,
                        min_quality=min_qual,
                        kit_folder=adapter_yaml,
-                       enable_filter_barcodes=filter_barcodes,
+                       enable_filter_barcodes=filter_barcodes and
+                       not run_filter,
                        scan_middle_adapter=middle_adapter,
-                       threads=threads)
-
-    if tsv:
-        print("name", "length", "barcode", "score", "kit",
-              "adapter_end", "comment", sep="\t")
-
-    fastq = is_fastq(reads_fq)
-    output_files = {}
-
-    trimmed_output_file = sys.stdout
-    if output:
-        trimmed_output_file = open(output, "w")
-
-    if out:
-        if not os.path.exists(out):
-            os.makedirs(out)
-
-    batch_size = 4000
+                       threads=threads,
+                       parallel_backend=parallel_backend,
+                       concurrent_ends=concurrent_ends,
+                       sticky_kit=sticky_kit and not nobatch,
+                       kit_recheck_rate=kit_recheck_rate)
+
+    writer = ResultWriter(out=out,
+                          tsv=tsv,
+                          output=output,
+                          fastq=fastq,
+                          trim=trim,
+                          min_read_length=min_read_length)
+
+    batch_sizer = None
     if nobatch:
         batch_size = 1
+    elif batch_size == scheduler.BATCH_SIZE_AUTO:
+        batch_sizer = scheduler.BatchSizer(target_seconds=batch_seconds,
+                                           max_bytes=batch_memory)
+        batch_size = batch_sizer
 
-    for names, comments, seqs, quals in iter_fastx(reads_fq, fastq, batch_size):
+    def detect(batch):
+        names, comments, seqs, quals = batch
         # Detect adapter/barcode
         if nobatch:
-            results = [detector.detect_barcode(read_sequence=seqs[0],
-                                               read_qualities=quals[0],
-                                               qcat_config=qcat_config)]
+            return [detector.detect_barcode(read_sequence=seqs[0],
+                                            read_qualities=quals[0],
+                                            qcat_config=qcat_config)]
+        start = time.time()
+        results = detector.detect_barcode_batch(read_sequences=seqs,
+                                                read_qualities=quals,
+                                                qcat_config=qcat_config)
+        if batch_sizer:
+            batch_sizer.add_batch(len(seqs), get_batch_bytes(batch),
+                                  time.time() - start)
+        return results
+
+    # With worker processes, keep two batches in flight so that workers
+    # don't idle while the results of a batch are collected. With multiple
+    # input files, each batch (file) is processed by a single worker and
+    # one batch per worker is in flight.
+    detect_threads = 1
+    if detector.batch_executor and not nobatch:
+        detect_threads = 2
+        if len(filenames) > 1:
+            detector.batch_executor.split_batches = False
+            detect_threads = threads
+            if detector.kit_detector and \
+                    parallel_backend == parallel.PROCESS:
+                # Each batch is processed by a single worker process
+                logging.warning("--sticky-kit has no effect with multiple "
+                                "input files and --parallel-backend process")
+
+    spill_file = None
+    try:
+        if run_filter:
+            # Results are addressed by read offset, so batches can be
+            # spilled in any order
+            spill_file = spill.SpillFile()
+            pipeline.Pipeline(queue_size=queue_size,
+                              detect_threads=detect_threads,
+                              output_order=pipeline.UNORDERED,
+                              sizeof=lambda item: get_batch_bytes(item[1])).run(
+                iter_offsets(iter_fastx_files(filenames, fastq, batch_size,
+                                              shard)),
+                lambda item: detect(item[1]),
+                lambda item, results: spill_file.write(item[0], results))
+            write_filtered(iter_fastx_files(filenames, fastq, batch_size,
+                                            shard),
+                           spill_file, detector, writer)
+        elif nobatch:
+            stream_reads(iter_fastx_files_reads(filenames, fastq, shard),
+                         detector, writer, qcat_config)
         else:
-            results = detector.detect_barcode_batch(read_sequences=seqs,
-                                                    read_qualities=quals,
-                                                    qcat_config=qcat_config)
-        for name, comment, sequence, quality, result in zip(names,
-                                                            comments,
-                                                            seqs,
-                                                            quals,
-                                                            results):
-            total_reads += 1
-
-            if not notrimming:
-                trim_5p = result["trim5p"]
-                trim_3p = result["trim3p"]
-                sequence = sequence[trim_5p:trim_3p]
-                if quality:
-                    quality = quality[trim_5p:trim_3p]
-
-            if len(sequence) < min_read_length:
-                skipped_reads += 1
-                continue
-
-            # Record which adapter/barcode was found
-            barcode_found(barcode_dist, result['barcode'])
-            adapter_found(adapter_dist, result['adapter'])
-
-            # Write tsv result file
-            write_multiplexing_result(result,
-                                      comment,
-                                      name,
-                                      sequence,
-                                      tsv)
-            # Write FASTQ/A files
-            if out or not tsv:
-                write_to_file(trimmed_output_file,
-                              output_files,
-                              out,
-                              name,
-                              comment,
-                              sequence,
-                              quality,
-                              fastq,
-                              result)
-
-    if out:
-        close_files(output_files)
+            pipeline.Pipeline(queue_size=queue_size,
+                              detect_threads=detect_threads,
+                              output_order=output_order,
+                              sizeof=get_batch_bytes).run(
+                iter_fastx_files(filenames, fastq, batch_size, shard),
+                detect,
+                writer.write)
+    finally:
+        detector.close()
+        writer.close()
+        if spill_file:
+            spill_file.close()
+
+    if summary:
+        write_summary(writer.get_summary(), summary)
 
     if not quiet:
-        print_barcode_hist(barcode_dist, adapter_dist, total_reads)
-        if skipped_reads > 0:
-            logging.info("{} reads were skipped due to the min. length filter.".format(skipped_reads))
-
-    if output:
-        trimmed_output_file.close()
+        writer.print_summary()
 
 
 def barcodes_from_fasta(filename):
@@ -588,12 +1253,24 @@ def main(argv=sys.argv[1:]):
         args = parse_args(argv=argv)
 
         qcat_config = config.get_default_config()
+        qcat_config.align_backend = args.align_backend
+        qcat_config.align_precision = args.align_precision
+        qcat_config.adapter_prefilter = args.adapter_prefilter
+        qcat_config.barcode_prefilter = args.barcode_prefilter
+        qcat_config.barcode_backend = args.barcode_backend
+        qcat_config.early_termination = args.early_termination
+        qcat_config.banded_barcodes = args.banded_barcodes
 
         numeric_level = getattr(logging, args.log.upper(), None)
         if not isinstance(numeric_level, int):
             raise ValueError('Invalid log level: %s' % args.log.upper())
         logging.basicConfig(level=numeric_level, format='%(message)s')
 
+        if args.banded_barcodes and \
+                args.barcode_backend != scanner_base.BARCODE_BACKEND_NUMPY:
+            logging.warning("--banded-barcodes has no effect without "
+                            "--barcode-backend numpy")
+
         if args.list_kits:
             kits = get_kits_info()
             for kit in sorted(kits.keys()):
@@ -623,9 +1300,26 @@ def main(argv=sys.argv[1:]):
                  filter_barcodes=args.FILTER_BARCODES,
                  middle_adapter=args.DETECT_MIDDLE,
                  min_read_length=args.min_length,
-                 qcat_config=qcat_config)
+                 qcat_config=qcat_config,
+                 output_order=args.output_order,
+                 shard=args.shard,
+                 summary=args.summary,
+                 parallel_backend=args.parallel_backend,
+                 concurrent_ends=args.concurrent_ends,
+                 sticky_kit=args.sticky_kit,
+                 kit_recheck_rate=args.kit_recheck_rate,
+                 filter_scope=args.filter_scope,
+                 batch_size=args.batch_size,
+                 batch_seconds=args.batch_seconds,
+                 batch_memory=int(args.batch_memory * 1e6))
         end = time.time()
 
+        if args.align_precision == align.ALIGN_PRECISION_AUTO:
+            precision_stats = align.get_precision_stats()
+            logging.debug("{} of {} 8/16 bit alignments saturated and were "
+                          "re-run with 32 bit scores".format(
+                precision_stats["fallback"], precision_stats["narrow"]))
+
         if not args.QUIET:
             logging.info("Demultiplexing finished in {0:.2f}s".format(end - start))
     except IOError as e:
@@ -4,6 +4,61 @@ except ImportError:
     import configparser as ConfigParser
 import parasail
 
+# Scoring matrices by (alphabet, match, mismatch, wildcard match). Configs
+# with the same scores share one matrix, also after they were unpickled in a
+# worker process
+_matrices = {}
+# Keys of _matrices by id(matrix). Matrices in _matrices are never freed, so
+# their ids are not reused
+_matrix_keys = {}
+
+
+def get_matrix(alphabet, match, mismatch, nmatch=None):
+    """
+    Returns the parasail scoring matrix for the given scores. Each matrix is
+    created only once per process.
+
+    :param alphabet: Characters of the matrix
+    :param match: Match score
+    :param mismatch: Mismatch score
+    :param nmatch: Score of the wildcards 'N' and 'X' of the alphabet
+    "ATGCNX" (see qcatConfig.update_matrix), None to keep the scores of
+    parasail.matrix_create
+    :return: parasail scoring matrix
+    """
+    key = (alphabet, match, mismatch, nmatch)
+    matrix = _matrices.get(key)
+    if matrix is None:
+        matrix = parasail.matrix_create(alphabet, match, mismatch)
+        if nmatch is not None:
+            pointers = [4, 11, 18, 25, 28, 29, 30, 31, 32]
+            for i in pointers:
+                matrix.pointer[0].matrix[i] = nmatch
+
+            pointers = [5, 12, 19, 26, 33, 35, 36, 37, 38, 39, 40]
+            for i in pointers:
+                matrix.pointer[0].matrix[i] = 0
+        _matrices[key] = matrix
+        _matrix_keys[id(matrix)] = key
+    return matrix
+
+
+def get_matrix_key(matrix):
+    """
+    Key for caches of values computed from a scoring matrix. Matrices with
+    the same scores have the same key, unlike id(matrix).
+
+    :param matrix: parasail scoring matrix
+    :return: Scores of get_matrix, or the score table and character mapping
+    of matrices created otherwise
+    :rtype: tuple
+    """
+    key = _matrix_keys.get(id(matrix))
+    if key is None or _matrices.get(key) is not matrix:
+        key = (tuple(tuple(row) for row in matrix.matrix),
+               tuple(matrix.mapper[:256]))
+    return key
+
 
 class qcatConfig:
 
@@ -20,14 +75,47 @@ class qcatConfig:
         self._extracted_barcode_extension = 11
         self._barcode_context_length = 11
 
+        self._align_backend = "parasail"
+        self._align_precision = "32"
+        self._adapter_prefilter = False
+        self._barcode_prefilter = False
+        self._barcode_backend = "parasail"
+        self._early_termination = False
+        self._banded_barcodes = False
+
         self._matrix = None
         self.update_matrix()
 
-        self._matrix_barcode = parasail.matrix_create("ATGCN", 1, -1)
+        self._matrix_barcode = get_matrix("ATGCN", 1, -1)
 
         if config_path is not None:
             self.read(config_path)
 
+    def __getstate__(self):
+        """
+        Parasail scoring matrices can not be pickled. Drop them when
+        the config is sent to a worker process and look them up again in
+        __setstate__.
+
+        :return: dict
+        """
+        state = self.__dict__.copy()
+        state.pop('matrix', None)
+        state.pop('_matrix_barcode', None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore config and scoring matrices. Matrices are shared with all
+        other configs with the same scores (see get_matrix)
+
+        :param state: dict
+        :return: None
+        """
+        self.__dict__.update(state)
+        self.update_matrix()
+        self._matrix_barcode = get_matrix("ATGCN", 1, -1)
+
     @property
     def matrix_barcode(self):
         """
@@ -199,6 +287,153 @@ class qcatConfig:
         """
         self._barcode_context_length = value
 
+    @property
+    def align_backend(self):
+        """
+        Alignment backend used for adapter and barcode
+        detection (see align.get_backend_names)
+
+        :return: str
+        """
+        return self._align_backend
+
+    @align_backend.setter
+    def align_backend(self, value):
+        """
+        Alignment backend used for adapter and barcode
+        detection (see align.get_backend_names)
+
+        :param value: str
+        :return: None
+        """
+        self._align_backend = value
+
+    @property
+    def align_precision(self):
+        """
+        Score width used for alignments: 32 bit or auto
+        (see align.ALIGN_PRECISIONS)
+
+        :return: str
+        """
+        return self._align_precision
+
+    @align_precision.setter
+    def align_precision(self, value):
+        """
+        Score width used for alignments: 32 bit or auto
+        (see align.ALIGN_PRECISIONS)
+
+        :param value: str
+        :return: None
+        """
+        self._align_precision = value
+
+    @property
+    def adapter_prefilter(self):
+        """
+        Only align adapter templates that share k-mers with
+        the read (see scanner_base.AdapterKmerIndex)
+
+        :return: bool
+        """
+        return self._adapter_prefilter
+
+    @adapter_prefilter.setter
+    def adapter_prefilter(self, value):
+        """
+        Only align adapter templates that share k-mers with
+        the read (see scanner_base.AdapterKmerIndex)
+
+        :param value: bool
+        :return: None
+        """
+        self._adapter_prefilter = value
+
+    @property
+    def barcode_prefilter(self):
+        """
+        Align the barcodes that share the most q-grams with
+        the read first (see qgram.BarcodeQgramIndex)
+
+        :return: bool
+        """
+        return self._barcode_prefilter
+
+    @barcode_prefilter.setter
+    def barcode_prefilter(self, value):
+        """
+        Align the barcodes that share the most q-grams with
+        the read first (see qgram.BarcodeQgramIndex)
+
+        :param value: bool
+        :return: None
+        """
+        self._barcode_prefilter = value
+
+    @property
+    def barcode_backend(self):
+        """
+        Backend used for scoring barcodes
+        (see scanner_base.BARCODE_BACKENDS)
+
+        :return: str
+        """
+        return self._barcode_backend
+
+    @barcode_backend.setter
+    def barcode_backend(self, value):
+        """
+        Backend used for scoring barcodes
+        (see scanner_base.BARCODE_BACKENDS)
+
+        :param value: str
+        :return: None
+        """
+        self._barcode_backend = value
+
+    @property
+    def early_termination(self):
+        """
+        Skip adapter templates and barcodes that can not beat the best
+        score found so far
+
+        :return: bool
+        """
+        return self._early_termination
+
+    @early_termination.setter
+    def early_termination(self, value):
+        """
+        Skip adapter templates and barcodes that can not beat the best
+        score found so far
+
+        :param value: bool
+        :return: None
+        """
+        self._early_termination = value
+
+    @property
+    def banded_barcodes(self):
+        """
+        Align barcodes only close to the position expected from the adapter
+        alignment (numpy barcode backend)
+
+        :return: bool
+        """
+        return self._banded_barcodes
+
+    @banded_barcodes.setter
+    def banded_barcodes(self, value):
+        """
+        Align barcodes only close to the position expected from the adapter
+        alignment (numpy barcode backend)
+
+        :param value: bool
+        :return: None
+        """
+        self._banded_barcodes = value
+
     def write(self, out_config_path):
         """
         Write to ini file
@@ -235,22 +470,15 @@ class qcatConfig:
 
     def update_matrix(self):
         """
-        Create new parasail scoring matrix. 'N' is used as wildcard character
+        Set parasail scoring matrix. 'N' is used as wildcard character
         for barcodes and has its own match parameter (0 per default).
         'X' is used as wildcard character for modified bp as in the 16S
         sequencing adapter.
 
         :return: None
         """
-        self.matrix = parasail.matrix_create("ATGCNX", self.match, self.mismatch)
-
-        pointers = [4, 11, 18, 25, 28, 29, 30, 31, 32]
-        for i in pointers:
-            self.matrix.pointer[0].matrix[i] = self.nmatch
-
-        pointers = [5, 12, 19, 26, 33, 35, 36, 37, 38, 39, 40]
-        for i in pointers:
-            self.matrix.pointer[0].matrix[i] = 0
+        self.matrix = get_matrix("ATGCNX", self.match, self.mismatch,
+                                 self.nmatch)
 
     def read(self, config_path):
         """
@@ -0,0 +1,189 @@
+"""
+Run-level kit detection.
+
+In batch mode the kit is detected from the adapters found at the read ends
+of each batch (BarcodeScanner.detect_kit). All adapters of all kits are
+aligned to both ends of every read, although a run normally uses a single
+kit. RunKitDetector collects the adapter counts of successive batches and
+settles on a kit as soon as a sequential probability ratio test (SPRT) on
+the margin between the two most abundant kits is decided. Later batches
+skip kit detection, except for a small sample of reads (every
+1/recheck_rate-th read) that is used to re-check the kit. If another kit
+is most abundant in the re-checked reads, the kit is detected per batch
+again.
+
+The SPRT compares the number of reads of the most abundant kit (a) with
+the runner-up (b, adapter not found counts as a kit). H0: both are equally
+abundant, H1: the most abundant kit holds KIT_DETECTION_P1 of the a + b
+reads. The log likelihood ratio is
+
+    a * log(2 * p1) + b * log(2 * (1 - p1))
+
+The kit is accepted once it exceeds log((1 - beta) / alpha) and at least
+KIT_DETECTION_MIN_READS reads were sampled. If it drops below
+log(beta / (1 - alpha)), no kit dominates: the counts are discarded and the
+test starts again with the next batch.
+"""
+import logging
+import math
+import operator
+import threading
+
+# Share of the reads of the two most abundant kits that the dominant kit
+# holds under H1
+KIT_DETECTION_P1 = 0.75
+# Error rates of the SPRT
+KIT_DETECTION_ALPHA = 0.001
+KIT_DETECTION_BETA = 0.001
+# Minimum number of reads scanned before a kit is accepted. Kit detection
+# per batch uses 4000 reads
+KIT_DETECTION_MIN_READS = 1000
+# Fraction of reads scanned to re-check the kit once it was accepted
+DEFAULT_RECHECK_RATE = 0.05
+# Number of re-checked reads collected before they are evaluated
+KIT_RECHECK_MIN_READS = 200
+
+
+def get_top_kits(adapter_counts):
+    """
+    Two most abundant kits, ties are resolved as in
+    BarcodeScanner.get_most_abundant_kits
+
+    :param adapter_counts: Number of reads per kit
+    :type adapter_counts: dict
+    :return: Most abundant kit and its count, count of the runner-up
+    :rtype: str, int, int
+    """
+    counts = sorted(adapter_counts.items(), key=operator.itemgetter(1),
+                    reverse=True)
+    if not counts:
+        return None, 0, 0
+    runner_up = counts[1][1] if len(counts) > 1 else 0
+    return counts[0][0], counts[0][1], runner_up
+
+
+def get_margin_llr(count, runner_up, p1=KIT_DETECTION_P1):
+    """
+    Log likelihood ratio of H1 (the most abundant kit holds p1 of the reads
+    of the two most abundant kits) vs H0 (both kits are equally abundant)
+
+    :param count: Reads of the most abundant kit
+    :param runner_up: Reads of the second most abundant kit
+    :param p1: Share of the most abundant kit under H1
+    :return: Log likelihood ratio
+    :rtype: float
+    """
+    return count * math.log(2.0 * p1) + \
+        runner_up * math.log(2.0 * (1.0 - p1))
+
+
+class RunKitDetector(object):
+    """
+    Keeps the kit detected in previous batches of a run (see module
+    docstring). Can be shared by threads processing different batches.
+    """
+
+    def __init__(self, recheck_rate=DEFAULT_RECHECK_RATE,
+                 min_reads=KIT_DETECTION_MIN_READS,
+                 alpha=KIT_DETECTION_ALPHA, beta=KIT_DETECTION_BETA):
+        """
+        Init
+
+        :param recheck_rate: Fraction of reads scanned to re-check the kit
+        once it was accepted. 0 disables re-checking
+        :param min_reads: Minimum number of reads scanned before a kit is
+        accepted
+        :param alpha: Probability of accepting a kit that does not dominate
+        :param beta: Probability of rejecting a dominant kit
+        """
+        self.recheck_rate = recheck_rate
+        self.min_reads = min_reads
+        self.accept_llr = math.log((1.0 - beta) / alpha)
+        self.reject_llr = math.log(beta / (1.0 - alpha))
+
+        self.lock = threading.Lock()
+        # Accepted kit, None while the kit is detected per batch
+        self.kit_name = None
+        # Reads per kit collected for the test or the re-check
+        self.adapter_counts = {}
+        self.sampled_reads = 0
+
+    def reset_counts(self):
+        self.adapter_counts = {}
+        self.sampled_reads = 0
+
+    def get_stride(self):
+        """
+        Step between the reads of a batch that are scanned for kit
+        detection
+
+        :return: 1 while the kit is detected per batch, 0 if no reads have
+        to be scanned
+        :rtype: int
+        """
+        with self.lock:
+            if self.kit_name is None:
+                return 1
+            if self.recheck_rate <= 0.0:
+                return 0
+            return max(1, int(round(1.0 / self.recheck_rate)))
+
+    def add_counts(self, adapter_counts):
+        for kit, count in adapter_counts.items():
+            self.adapter_counts[kit] = self.adapter_counts.get(kit, 0) + count
+            self.sampled_reads += count
+
+    def update(self, adapter_counts, batch_kit_name):
+        """
+        Adds the adapter counts of the reads scanned in a batch (see
+        get_stride)
+
+        :param adapter_counts: Number of scanned reads per kit
+        :type adapter_counts: dict
+        :param batch_kit_name: Most abundant kit of the scanned reads
+        :return: Kit used for the batch
+        :rtype: str
+        """
+        with self.lock:
+            self.add_counts(adapter_counts)
+
+            if self.kit_name is None:
+                kit_name, count, runner_up = get_top_kits(self.adapter_counts)
+                llr = get_margin_llr(count, runner_up)
+                if llr >= self.accept_llr and \
+                        self.sampled_reads >= self.min_reads:
+                    self.kit_name = kit_name
+                    logging.info("Kit {} detected from {} reads ({} reads, "
+                                 "runner-up {} reads). Re-checking {:.1%} "
+                                 "of the reads from now on".format(
+                                     kit_name, self.sampled_reads, count,
+                                     runner_up, self.recheck_rate))
+                    self.reset_counts()
+                elif llr <= self.reject_llr:
+                    logging.debug("No dominant kit in {} reads ({} reads of "
+                                  "{}, runner-up {} reads), detecting the "
+                                  "kit per batch".format(self.sampled_reads,
+                                                         count, kit_name,
+                                                         runner_up))
+                    self.reset_counts()
+                return batch_kit_name
+
+            if self.sampled_reads < KIT_RECHECK_MIN_READS:
+                return self.kit_name
+
+            kit_name, count, _ = get_top_kits(self.adapter_counts)
+            if kit_name != self.kit_name:
+                logging.warning("Kit {} found in {} of {} re-checked reads "
+                                "instead of kit {}, detecting the kit per "
+                                "batch again".format(kit_name, count,
+                                                     self.sampled_reads,
+                                                     self.kit_name))
+                self.kit_name = None
+                self.reset_counts()
+                return kit_name
+
+            logging.debug("Kit {} confirmed by {} of {} re-checked "
+                          "reads".format(kit_name, count,
+                                         self.sampled_reads))
+            self.reset_counts()
+            return self.kit_name
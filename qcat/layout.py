@@ -2,8 +2,21 @@ import re
 
 from collections import namedtuple
 
+from qcat.qgram import BarcodeQgramIndex
+
 BarcodePosition = namedtuple("BarcodePosition", "start end length")
 
+# Alignment targets of a barcode set (see compile_barcode_set)
+CompiledBarcodeSet = namedtuple("CompiledBarcodeSet",
+                                "barcodes index upstream_context "
+                                "downstream_context targets target_length "
+                                "barcode_end barcode_length")
+
+# Alignment targets of an adapter layout (see compile_layout)
+CompiledLayout = namedtuple("CompiledLayout",
+                            "layout sequence adapter_length barcode_length "
+                            "norm_denominator barcode_sets")
+
 
 class AdapterLayout:
     """
@@ -69,6 +82,15 @@ class AdapterLayout:
 
         self.description = description
 
+        # q-gram indices of both barcode sets
+        # (see scanner_base.find_highest_scoring_barcode)
+        self.barcode_index_1 = None
+        self.barcode_index_2 = None
+        if self.barcode_set_1:
+            self.barcode_index_1 = BarcodeQgramIndex(self.barcode_set_1)
+        if self.barcode_set_2:
+            self.barcode_index_2 = BarcodeQgramIndex(self.barcode_set_2)
+
     @staticmethod
     def get_placeholder_pos(adapter_template, index=0):
         """
@@ -188,6 +210,21 @@ class AdapterLayout:
             raise RuntimeError("Invalid barcode index: {}. Must be 0 or 1 "
                                "(for double barcoding)".format(index))
 
+    def get_barcode_index(self, index=0):
+        """
+        Get the q-gram index of a barcode set
+
+        :param index: 0 for single barcoding, 0 or 1 for double barcoding
+        :return: qgram.BarcodeQgramIndex
+        """
+        if index == 0:
+            return self.barcode_index_1
+        elif index == 1:
+            return self.barcode_index_2
+        else:
+            raise RuntimeError("Invalid barcode index: {}. Must be 0 or 1 "
+                               "(for double barcoding)".format(index))
+
     def get_upstream_context(self, n, index=0):
         """
         Return n bp upstream of the barcode
@@ -246,3 +283,125 @@ class AdapterLayout:
         :rtype: bool
         """
         return self.barcode_set_2 is not None
+
+
+def compile_barcode_set(barcode_set, barcode_index=None, upstream_context="",
+                        downstream_context="", barcode_end=-1,
+                        barcode_length=0):
+    """
+    Precomputes the sequences that the barcodes of a set are aligned to
+
+    :param barcode_set: List of Barcode tuples
+    :param barcode_index: q-gram index of barcode_set
+    :param upstream_context: Sequence upstream of barcode in adapter
+    :param downstream_context: Sequence downstream of barcode in adapter
+    :param barcode_end: Position of the last barcode bp in the adapter
+    :param barcode_length: Length of the barcode in the adapter
+    :return: CompiledBarcodeSet
+    """
+    targets = tuple(upstream_context + barcode.sequence + downstream_context
+                    for barcode in barcode_set or [])
+    target_length = len(targets[0]) if targets else 0
+    return CompiledBarcodeSet(barcode_set, barcode_index, upstream_context,
+                              downstream_context, targets, target_length,
+                              barcode_end, barcode_length)
+
+
+def compile_layout(layout, context_length, match, nmatch):
+    """
+    Precomputes alignment targets, lengths and normalization constants of an
+    adapter layout. AdapterLayout only stores the adapter, everything else
+    would otherwise be recomputed for every read.
+
+    :param layout: AdapterLayout
+    :param context_length: Number of adapter bp aligned together with the
+    barcode (qcatConfig.barcode_context_length)
+    :param match: Match score of adapter alignments (qcatConfig.match)
+    :param nmatch: Score of N in adapter alignments (qcatConfig.nmatch)
+    :return: CompiledLayout
+    """
+    sequence = layout.get_adapter_sequences()
+    barcode_length = layout.get_barcode_length(0) + \
+        layout.get_barcode_length(1)
+    barcode_sets = tuple(
+        compile_barcode_set(layout.get_barcode_set(index),
+                            layout.get_barcode_index(index),
+                            layout.get_upstream_context(context_length,
+                                                        index),
+                            layout.get_downstream_context(context_length,
+                                                          index),
+                            layout.get_barcode_end(index),
+                            layout.get_barcode_length(index))
+        for index in [0, 1])
+    # Score of a perfect alignment (see scanner_base.get_norm_socre)
+    norm_denominator = (len(sequence) - barcode_length) * match + \
+        barcode_length * nmatch
+    return CompiledLayout(layout, sequence, len(sequence), barcode_length,
+                          norm_denominator, barcode_sets)
+
+
+class CompiledKit(object):
+    """
+    Read-only, precompiled version of the adapter layouts used by a
+    BarcodeScanner: one CompiledLayout per layout and the layouts of each
+    kit. Only valid for the qcatConfig values it was compiled for (see
+    matches).
+    """
+
+    def __init__(self, layouts, context_length, match, nmatch,
+                 precompile=True):
+        """
+        :param layouts: List of AdapterLayouts
+        :param context_length: see compile_layout
+        :param match: see compile_layout
+        :param nmatch: see compile_layout
+        :param precompile: If False, nothing is precomputed: layouts are
+        compiled on every call of get and get_layouts scans all layouts.
+        Used as baseline by qcat-benchmark
+        """
+        self.layouts = tuple(layouts)
+        self.key = (context_length, match, nmatch)
+        self.precompile = precompile
+        self.compiled = {}
+        self.kits = {}
+        if not precompile:
+            return
+        for layout in self.layouts:
+            self.compiled[id(layout)] = compile_layout(layout, context_length,
+                                                       match, nmatch)
+            self.kits.setdefault(layout.kit.lower(), []).append(layout)
+
+    def matches(self, qcat_config):
+        """
+        Checks whether the kit was compiled with the settings of qcat_config
+
+        :param qcat_config: qcatConfig object
+        :return: bool
+        """
+        return self.key == (qcat_config.barcode_context_length,
+                            qcat_config.match, qcat_config.nmatch)
+
+    def get(self, layout):
+        """
+        Compiled version of a layout. Layouts that are not part of the kit
+        are compiled on the fly.
+
+        :param layout: AdapterLayout
+        :return: CompiledLayout
+        """
+        compiled = self.compiled.get(id(layout))
+        if compiled is None or compiled.layout is not layout:
+            compiled = compile_layout(layout, *self.key)
+        return compiled
+
+    def get_layouts(self, kit_name):
+        """
+        Layouts of a kit
+
+        :param kit_name: Name of the kit (case insensitive)
+        :return: List of AdapterLayouts (empty if the kit is unknown)
+        """
+        if not self.precompile:
+            return [layout for layout in self.layouts
+                    if kit_name.lower() == layout.kit.lower()]
+        return self.kits.get(kit_name.lower(), [])
@@ -0,0 +1,203 @@
+"""
+Merges the results of sharded qcat runs (qcat --shard i/N).
+
+Each shard writes its own barcode folder (-b), TSV file (--tsv) and summary
+(--summary). qcat-merge concatenates the per-barcode FASTQ/FASTA files of all
+shards, combines the TSV files and adds up the adapter/barcode histograms.
+Reads are grouped by shard, so the order of reads within a file differs from
+a single-node run.
+"""
+from __future__ import print_function
+
+import logging
+import os
+import shutil
+import sys
+
+import six
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from qcat import __version__, cli
+
+
+def parse_args(argv):
+    """
+    Commandline parser
+
+    :param argv: Command line arguments
+    :type argv: List
+    :return: None
+    """
+    usage = "Merge the output of sharded qcat runs (qcat --shard i/N)"
+    parser = ArgumentParser(description=usage,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-V", '--version',
+                        action='version',
+                        version='%(prog)s ' + __version__)
+    parser.add_argument('-l', "--log",
+                        dest="log",
+                        type=str,
+                        default="INFO",
+                        help="Print debug information")
+    parser.add_argument("--quiet",
+                        dest="QUIET",
+                        action='store_true',
+                        help="Don't print summary")
+    parser.add_argument(dest="SHARD_DIRS",
+                        nargs="*",
+                        help="Barcode folders (-b) of all shards")
+    parser.add_argument('-b', "--barcode_dir",
+                        dest="barcode_dir",
+                        type=str,
+                        default=None,
+                        help="Folder the merged per-barcode files are "
+                             "written to")
+    parser.add_argument("--tsv-files",
+                        dest="tsv_files",
+                        nargs="+",
+                        default=[],
+                        help="TSV files (--tsv) of all shards")
+    parser.add_argument("--tsv-output",
+                        dest="tsv_output",
+                        type=str,
+                        default=None,
+                        help="Merged TSV file (default: stdout)")
+    parser.add_argument("--summary-files",
+                        dest="summary_files",
+                        nargs="+",
+                        default=[],
+                        help="Summary files (--summary) of all shards")
+    parser.add_argument("--summary",
+                        dest="summary",
+                        type=str,
+                        default=None,
+                        help="Write merged adapter/barcode histograms to "
+                             "this file (JSON)")
+
+    args = parser.parse_args(argv)
+
+    if args.SHARD_DIRS and not args.barcode_dir:
+        parser.error("-b/--barcode_dir is required to merge barcode folders")
+
+    return args
+
+
+def merge_barcode_dirs(shard_dirs, out):
+    """
+    Concatenate per-barcode files with the same name from all shard folders
+
+    :param shard_dirs: Barcode folders of all shards
+    :type shard_dirs: List
+    :param out: Output folder
+    :type out: str
+    :return: Dict of output file name -> number of shards containing it
+    """
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    merged = {}
+    for shard_dir in shard_dirs:
+        if not os.path.isdir(shard_dir):
+            raise IOError("Barcode folder not found: {}".format(shard_dir))
+        for filename in sorted(os.listdir(shard_dir)):
+            if not filename.lower().endswith(cli.FASTX_EXTENSIONS):
+                continue
+            mode = "a" if filename in merged else "w"
+            with open(os.path.join(shard_dir, filename)) as src, \
+                    open(os.path.join(out, filename), mode) as dst:
+                shutil.copyfileobj(src, dst)
+            merged[filename] = merged.get(filename, 0) + 1
+
+    return merged
+
+
+def merge_tsv(tsv_files, out):
+    """
+    Concatenate TSV files, keeping only the first header line
+
+    :param tsv_files: TSV files of all shards
+    :type tsv_files: List
+    :param out: File handle
+    :return: None
+    """
+    header = None
+    for tsv_file in tsv_files:
+        with open(tsv_file) as fh:
+            line = fh.readline()
+            if header is None:
+                header = line
+                out.write(header)
+            elif line != header:
+                raise ValueError("TSV file {} has a different header".format(
+                    tsv_file))
+            shutil.copyfileobj(fh, out)
+
+
+def merge_summaries(summaries):
+    """
+    Add up adapter/barcode histograms
+
+    :param summaries: List of summaries (see cli.get_summary)
+    :return: Merged summary
+    """
+    barcode_dist = {}
+    adapter_dist = {}
+    total_reads = 0
+    skipped_reads = 0
+    for summary in summaries:
+        total_reads += summary["total_reads"]
+        skipped_reads += summary["skipped_reads"]
+        for key, value in six.iteritems(summary["barcodes"]):
+            barcode_dist[key] = barcode_dist.get(key, 0) + value
+        for key, value in six.iteritems(summary["adapters"]):
+            adapter_dist[key] = adapter_dist.get(key, 0) + value
+
+    return cli.get_summary(total_reads, skipped_reads, barcode_dist,
+                           adapter_dist)
+
+
+def main(argv=sys.argv[1:]):
+    """
+    Command line interface to merge sharded qcat runs
+
+    :param argv: Command line arguments
+    :type argv: list
+    :return: None
+    :rtype: NoneType
+    """
+    args = parse_args(argv=argv)
+
+    numeric_level = getattr(logging, args.log.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % args.log.upper())
+    logging.basicConfig(level=numeric_level, format='%(message)s')
+
+    try:
+        if args.SHARD_DIRS:
+            merged = merge_barcode_dirs(args.SHARD_DIRS, args.barcode_dir)
+            logging.debug("Merged {} files into {}".format(len(merged),
+                                                           args.barcode_dir))
+
+        if args.tsv_files:
+            if args.tsv_output:
+                with open(args.tsv_output, "w") as out:
+                    merge_tsv(args.tsv_files, out)
+            else:
+                merge_tsv(args.tsv_files, sys.stdout)
+
+        if args.summary_files:
+            summary = merge_summaries([cli.read_summary(filename)
+                                       for filename in args.summary_files])
+            if args.summary:
+                cli.write_summary(summary, args.summary)
+            if not args.QUIET:
+                cli.print_summary(summary)
+    except IOError as e:
+        logging.error(e)
+    except ValueError as e:
+        logging.error(e)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,146 @@
+"""
+Bit-parallel barcode scoring (Myers' bit-vector algorithm).
+
+Computes the edit distance of each barcode (with upstream and downstream
+context) to the best matching substring of the barcode region of a read.
+All barcodes of a set are packed into one Python integer, one lane of
+bits per barcode, so that every step of the algorithm processes the whole
+barcode set at once.
+
+The edit distance k is converted to the percentage score used by
+scanner_base.find_highest_scoring_barcode as 100 * (m - 2k) / m, where m is
+the length of barcode plus context. This equals the alignment score
+(match 1, mismatch -1, gap 1) for alignments without insertions in the
+read. Unlike the semi-global alignment, barcode and context have to be
+aligned completely, so scores can differ if the read ends within the
+barcode region.
+"""
+
+# Barcode sets are cached by (id(barcode_set), upstream, downstream context)
+_barcode_sets = {}
+
+
+class MyersBarcodeSet(object):
+    """
+    Bit-vector patterns of all barcodes of a barcode set
+    """
+
+    def __init__(self, barcode_set, upstream_context="",
+                 downstream_context=""):
+        """
+        :param barcode_set: List of Barcode tuples (all of the same length)
+        :param upstream_context: Sequence upstream of barcode in adapter
+        :param downstream_context: Sequence downstream of barcode in adapter
+        """
+        self.barcode_set = barcode_set
+        self.count = len(barcode_set)
+        patterns = [upstream_context + barcode.sequence + downstream_context
+                    for barcode in barcode_set]
+        self.length = len(patterns[0]) if patterns else 0
+        if any(len(pattern) != self.length for pattern in patterns):
+            raise RuntimeError("Barcodes of a set must have the same length")
+
+        # Lane: pattern bits and one guard bit
+        m = self.length
+        self.width = m + 1
+        lanes = range(self.count)
+        self.ones = sum(1 << (self.width * i) for i in lanes)
+        self.low = ((1 << m) - 1) * self.ones
+        self.high = (1 << (m - 1)) * self.ones
+        self.guard = (1 << m) * self.ones
+        self.lane_mask = (1 << self.width) - 1
+
+        self.peq = {}
+        for i, pattern in enumerate(patterns):
+            for j, base in enumerate(pattern):
+                self.peq[base] = self.peq.get(base, 0) | \
+                                 (1 << (self.width * i + j))
+
+    def distances(self, read_sequence):
+        """
+        Minimum edit distance of each pattern to any substring of the read
+
+        :param read_sequence: Barcode region of the read
+        :return: List of (edit distance, position of the last bp of the
+        best match in the read) tuples. Position is -1 if the best match
+        is the empty string
+        """
+        m = self.length
+        low = self.low
+        ones = self.ones
+        guard = self.guard
+        lane_mask = self.lane_mask
+        shift = m - 1
+
+        pv = low
+        mv = 0
+        # Score of lane = m + plus - minus
+        plus = 0
+        minus = 0
+        best = m * ones
+        best_end = 0
+        base_score = m * ones
+        for j, base in enumerate(read_sequence):
+            eq = self.peq.get(base, 0)
+            xv = eq | mv
+            xh = (((((eq & pv) + pv) & low) ^ pv) | eq)
+            ph = (mv | (low & ~(xh | pv)))
+            mh = pv & xh
+            plus += (ph & self.high) >> shift
+            minus += (mh & self.high) >> shift
+            ph = (ph << 1) & low
+            mh = (mh << 1) & low
+            pv = mh | (low & ~(xv | ph))
+            mv = ph & xv
+
+            score = base_score + plus - minus
+            # Guard bit of a lane stays set if score < best
+            improved = ((best | guard) - score - ones) & guard
+            if improved:
+                select = (improved >> m) * lane_mask
+                best = (best & ~select) | (score & select)
+                best_end = (best_end & ~select) | ((j + 1) * ones & select)
+
+        result = []
+        for i in range(self.count):
+            offset = self.width * i
+            result.append(((best >> offset) & lane_mask,
+                           ((best_end >> offset) & lane_mask) - 1))
+        return result
+
+
+def get_barcode_set(barcode_set, upstream_context="", downstream_context=""):
+    """
+    Returns the (cached) MyersBarcodeSet of a barcode set
+
+    :param barcode_set: List of Barcode tuples
+    :param upstream_context: Sequence upstream of barcode in adapter
+    :param downstream_context: Sequence downstream of barcode in adapter
+    :return: MyersBarcodeSet
+    """
+    key = (id(barcode_set), upstream_context, downstream_context)
+    myers_set = _barcode_sets.get(key)
+    if myers_set is None or myers_set.barcode_set is not barcode_set:
+        myers_set = MyersBarcodeSet(barcode_set, upstream_context,
+                                    downstream_context)
+        _barcode_sets[key] = myers_set
+    return myers_set
+
+
+def score_barcodes(barcode_region_read, barcode_set, upstream_context="",
+                   downstream_context=""):
+    """
+    Scores all barcodes of a set against the barcode region of a read
+
+    :param barcode_region_read: Barcode region of the read
+    :param barcode_set: List of Barcode tuples
+    :param upstream_context: Sequence upstream of barcode in adapter
+    :param downstream_context: Sequence downstream of barcode in adapter
+    :return: List of (score (0-100), identity (always 0.0), position of the
+    last aligned bp in the read) tuples
+    """
+    myers_set = get_barcode_set(barcode_set, upstream_context,
+                                downstream_context)
+    m = float(myers_set.length)
+    return [((m - 2 * distance) * 100.0 / m, 0.0, end)
+            for distance, end in myers_set.distances(barcode_region_read)]
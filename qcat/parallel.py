@@ -0,0 +1,514 @@
+"""
+Parallel execution of batch barcode detection.
+
+A batch of reads is split into work units with similar estimated cost
+(see scheduler) that are processed by a pool of workers. Kit detection and
+barcode detection are run in two rounds so that the kit is still detected
+from the full batch, exactly as in BarcodeScanner.detect_barcode_batch.
+
+Two backends are available:
+
+process: Each worker process holds its own BarcodeScanner, built once by
+scanner.factory when the worker starts. Reads are sent to the workers using
+the transport module.
+
+thread: Worker threads share the BarcodeScanner of the calling process.
+parasail is called through ctypes, which releases the GIL for the duration
+of each alignment, so alignments run concurrently. No reads or results are
+pickled, but the Python code around the alignments is still serialized by
+the GIL.
+"""
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from qcat import align, scheduler, transport
+
+PROCESS = "process"
+THREAD = "thread"
+BACKENDS = [PROCESS, THREAD]
+
+# BarcodeScanner owned by the current worker process
+_worker_scanner = None
+_worker_layout_index = None
+
+
+def _init_worker(scanner_args):
+    """
+    Builds the BarcodeScanner of a worker process
+
+    :param scanner_args: Keyword arguments passed to scanner.factory
+    :type scanner_args: dict
+    :return: None
+    """
+    global _worker_scanner, _worker_layout_index
+    from qcat.scanner import factory
+
+    _worker_scanner = factory(threads=1, **scanner_args)
+    _worker_layout_index = {}
+    for i, layout in enumerate(_worker_scanner.layouts):
+        _worker_layout_index[id(layout)] = i
+
+
+def pack_result(result, layout_index):
+    """
+    Replaces the AdapterLayout in a barcode result dict by its index in
+    BarcodeScanner.layouts. Avoids sending the full layout (including all
+    barcodes) back for every read.
+
+    :param result: see build_return_dict
+    :type result: dict
+    :param layout_index: Maps id(layout) to index in BarcodeScanner.layouts
+    :type layout_index: dict
+    :return: Result dict
+    :rtype: dict
+    """
+    adapter = result['adapter']
+    if adapter is not None and id(adapter) in layout_index:
+        result['adapter'] = layout_index[id(adapter)]
+    return result
+
+
+def unpack_result(result, layouts):
+    """
+    Reverts pack_result
+
+    :param result: Result dict returned by a worker
+    :type result: dict
+    :param layouts: BarcodeScanner.layouts of the calling process
+    :type layouts: List
+    :return: Result dict
+    :rtype: dict
+    """
+    if isinstance(result['adapter'], int):
+        result['adapter'] = layouts[result['adapter']]
+    return result
+
+
+def _scan_ends_task(args):
+    """
+    Kit detection for a slice of a batch
+
+    :param args: packed reads (see transport.iter_packed_reads), qcatConfig
+    :return: Index of the adapter layout found for each read, alignment
+    precision counts of the slice (see align.get_precision_delta)
+    :rtype: List, dict
+    """
+    packed_reads, qcat_config = args
+    before = align.get_precision_stats()
+    indices = []
+    for read_sequence, _ in transport.iter_packed_reads(packed_reads):
+        adapter_1, _ = _worker_scanner.scan_ends(read_sequence, qcat_config)
+        indices.append(_worker_layout_index.get(id(adapter_1), -1))
+    return indices, align.get_precision_delta(before)
+
+
+def _detect_barcode_task(args):
+    """
+    Barcode detection for a slice of a batch
+
+    :param args: packed reads (see transport.iter_packed_reads), kit name,
+    qcatConfig
+    :return: Packed barcode result dicts, alignment precision counts of the
+    slice (see align.get_precision_delta)
+    :rtype: List, dict
+    """
+    packed_reads, kit_name, qcat_config = args
+    before = align.get_precision_stats()
+    results = []
+    for read_sequence, read_length in \
+            transport.iter_packed_reads(packed_reads):
+        # Base qualities are not used for barcode detection
+        result = _worker_scanner.detect_barcode(read_sequence,
+                                                None,
+                                                qcat_config,
+                                                kit_name=kit_name)
+        result = transport.fix_windowed_result(result,
+                                               len(read_sequence),
+                                               read_length)
+        results.append(pack_result(result, _worker_layout_index))
+    return results, align.get_precision_delta(before)
+
+
+def _detect_barcode_batch_task(args):
+    """
+    Kit and barcode detection for a full batch in a single worker
+
+    :param args: packed reads (see transport.iter_packed_reads), number of
+    reads with base qualities, qcatConfig
+    :return: Packed barcode result dicts, alignment precision counts of the
+    batch (see align.get_precision_delta)
+    :rtype: List, dict
+    """
+    packed_reads, n, qcat_config = args
+    before = align.get_precision_stats()
+    reads = list(transport.iter_packed_reads(packed_reads))
+    read_sequences = [read_sequence for read_sequence, _ in reads]
+    results = _worker_scanner.detect_barcode_batch(read_sequences,
+                                                   [None] * n,
+                                                   qcat_config)
+    packed_results = []
+    for (read_sequence, read_length), result in zip(reads, results):
+        result = transport.fix_windowed_result(result,
+                                               len(read_sequence),
+                                               read_length)
+        packed_results.append(pack_result(result, _worker_layout_index))
+    return packed_results, align.get_precision_delta(before)
+
+
+class BatchExecutor(object):
+    """
+    Base class for parallel versions of BarcodeScanner.detect_barcode_batch
+    """
+
+    def __init__(self, threads, slices_per_worker=4):
+        """
+        Init
+
+        :param threads: Number of workers
+        :param slices_per_worker: Number of work units a batch is split into
+        per worker
+        """
+        self.threads = threads
+        self.slices_per_worker = slices_per_worker
+        # If True, each batch is split across all workers. Otherwise a batch
+        # is processed by a single worker. Use the latter when several
+        # batches are processed at the same time (e.g. many small input
+        # files).
+        self.split_batches = True
+        self.pool = None
+
+    def get_units(self, read_sequences, qcat_config, scan_middle):
+        """
+        Split reads into contiguous work units with similar estimated cost
+
+        :param read_sequences: List of read sequences
+        :param qcat_config: qcatConfig object
+        :param scan_middle: Reads are scanned for middle adapters
+        :return: List of start, stop, cost tuples
+        """
+        window_length = max(0, qcat_config.max_align_length)
+        costs = [scheduler.estimate_read_cost(len(read_sequence),
+                                              window_length,
+                                              scan_middle)
+                 for read_sequence in read_sequences]
+        return scheduler.pack_by_cost(costs,
+                                      self.threads * self.slices_per_worker)
+
+    def run_units(self, func, tasks, units):
+        """
+        Run one task per work unit on the pool (see scheduler.run_units)
+
+        :param func: Function to run
+        :param tasks: Task arguments, one per unit
+        :param units: see get_units
+        :return: Results of all units, concatenated in read order
+        """
+        results = []
+        costs = [cost for _, _, cost in units]
+        for unit_results in scheduler.run_units(self.pool, func, tasks, costs):
+            results += self.collect(unit_results)
+        return results
+
+    def collect(self, unit_results):
+        """
+        Results of a work unit as returned by the task
+
+        :param unit_results: Return value of the task
+        :return: List of results
+        """
+        return unit_results
+
+    @staticmethod
+    def count_kits(scanner, adapters):
+        """
+        Most abundant kit. Counts in read order so that ties are resolved as
+        in BarcodeScanner.detect_kit
+
+        :param scanner: BarcodeScanner of the calling process
+        :param adapters: Adapter found for each scanned read (or None)
+        :return: Kit name (see BarcodeScanner.get_batch_kit)
+        """
+        adapter_counts = {}
+        for adapter in adapters:
+            scanner.update_kit_count(adapter, adapter_counts)
+        return scanner.get_batch_kit(adapter_counts)
+
+    @staticmethod
+    def filter_results(scanner, results):
+        """
+        Applies BarcodeScanner.filter_barcodes to the results of a batch
+
+        :param scanner: BarcodeScanner of the calling process
+        :param results: List of barcode result dicts
+        :return: List of barcode result dicts
+        """
+        if not scanner.enable_filter_barcodes:
+            return results
+
+        barcode_count = {}
+        for result in results:
+            scanner.update_barcode_count(result, barcode_count)
+        return scanner.filter_barcodes(barcode_count, results)
+
+    def detect_barcode_batch(self, scanner, read_sequences, read_qualities,
+                             qcat_config):
+        """
+        Parallel version of BarcodeScanner.detect_barcode_batch
+
+        :param scanner: BarcodeScanner of the calling process
+        :param read_sequences: List of read sequences
+        :param read_qualities: List of read qualities
+        :param qcat_config: qcatConfig object
+        :return: List of barcode result dicts
+        """
+        raise NotImplementedError("Abstract class")
+
+    def close(self):
+        """
+        Shut down workers
+
+        :return: None
+        """
+        self.pool.close()
+        self.pool.join()
+
+
+class ProcessBatchExecutor(BatchExecutor):
+    """
+    Runs BarcodeScanner.detect_barcode_batch on a pool of worker processes
+    """
+
+    def __init__(self, threads, scanner_args, slices_per_worker=4):
+        """
+        Init
+
+        :param threads: Number of worker processes
+        :param scanner_args: Keyword arguments passed to scanner.factory
+        in every worker
+        :param slices_per_worker: Number of work units a batch is split into
+        per worker
+        """
+        super(ProcessBatchExecutor, self).__init__(threads, slices_per_worker)
+        logging.debug("Starting {} worker processes".format(threads))
+        transport.ensure_resource_tracker()
+        self.pool = multiprocessing.Pool(processes=threads,
+                                         initializer=_init_worker,
+                                         initargs=(scanner_args,))
+
+    @staticmethod
+    def get_window_length(scanner, qcat_config):
+        """
+        Number of bp at each end of a read that are needed for barcode
+        detection
+
+        :return: int, 0 for full reads
+        """
+        if scanner.scan_middle_adapter:
+            return 0
+        return max(0, qcat_config.max_align_length)
+
+    def collect(self, unit_results):
+        """
+        Adds the alignment precision counts of a worker to the counts of the
+        calling process (see align.add_precision_stats)
+
+        :param unit_results: Results and precision counts of a work unit
+        :return: List of results
+        """
+        unit_results, precision_delta = unit_results
+        align.add_precision_stats(precision_delta)
+        return unit_results
+
+    def detect_kit(self, scanner, packed_batch, read_sequences, qcat_config):
+        """
+        Parallel version of BarcodeScanner.detect_kit
+
+        :param scanner: BarcodeScanner of the calling process
+        :param packed_batch: Reads packed by transport.pack_batch
+        :param read_sequences: List of read sequences
+        :param qcat_config: qcatConfig object
+        :return: Name of the most abundant kit
+        """
+        stride = scanner.get_kit_stride()
+        if stride != 1:
+            # Only a sample of the reads is scanned once the kit is known
+            # (see kit_detection)
+            sample = read_sequences[::stride] if stride else []
+            if not sample:
+                return self.count_kits(scanner, [])
+            packed_sample = transport.pack_batch(
+                sample, max(0, qcat_config.max_align_length))
+            try:
+                return self.scan_kits(scanner, packed_sample, sample,
+                                      qcat_config)
+            finally:
+                packed_sample.close()
+
+        return self.scan_kits(scanner, packed_batch, read_sequences,
+                              qcat_config)
+
+    def scan_kits(self, scanner, packed_batch, read_sequences, qcat_config):
+        """
+        Scans the ends of all reads for adapters
+
+        :return: Name of the most abundant kit
+        """
+        # Kit detection only scans the ends of the reads
+        units = self.get_units(read_sequences, qcat_config, False)
+        tasks = [(packed_batch.get_slice(start, stop), qcat_config)
+                 for start, stop, _ in units]
+
+        adapters = []
+        for index in self.run_units(_scan_ends_task, tasks, units):
+            adapter = None
+            if index >= 0:
+                adapter = scanner.layouts[index]
+            adapters.append(adapter)
+
+        return self.count_kits(scanner, adapters)
+
+    def detect_barcode_batch(self, scanner, read_sequences, read_qualities,
+                             qcat_config):
+        # Shorter list wins, as with zip() in detect_barcode_batch
+        n = min(len(read_sequences), len(read_qualities))
+
+        packed_batch = transport.pack_batch(
+            read_sequences, self.get_window_length(scanner, qcat_config))
+        try:
+            if not self.split_batches:
+                task = (packed_batch.get_slice(0, len(read_sequences)), n,
+                        qcat_config)
+                packed_results = self.collect(
+                    self.pool.apply(_detect_barcode_batch_task, (task,)))
+                return [unpack_result(result, scanner.layouts)
+                        for result in packed_results]
+
+            kit_name = self.detect_kit(scanner, packed_batch,
+                                       read_sequences, qcat_config)
+
+            units = self.get_units(read_sequences[:n], qcat_config,
+                                   scanner.scan_middle_adapter)
+            tasks = [(packed_batch.get_slice(start, stop), kit_name,
+                      qcat_config)
+                     for start, stop, _ in units]
+
+            results = [unpack_result(result, scanner.layouts)
+                       for result in self.run_units(_detect_barcode_task,
+                                                    tasks, units)]
+        finally:
+            packed_batch.close()
+
+        return self.filter_results(scanner, results)
+
+
+class ThreadBatchExecutor(BatchExecutor):
+    """
+    Runs BarcodeScanner.detect_barcode_batch on a pool of threads that share
+    the BarcodeScanner of the calling process
+    """
+
+    def __init__(self, threads, slices_per_worker=4):
+        """
+        Init
+
+        :param threads: Number of worker threads
+        :param slices_per_worker: Number of work units a batch is split into
+        per worker
+        """
+        super(ThreadBatchExecutor, self).__init__(threads, slices_per_worker)
+        logging.debug("Starting {} worker threads".format(threads))
+        self.pool = ThreadPool(processes=threads)
+
+    @staticmethod
+    def scan_ends(scanner, read_sequences, qcat_config):
+        """
+        Kit detection for a slice of a batch
+
+        :return: Adapter found for each read and the adapter alignments of
+        both read ends (None if
+        BarcodeScanner.reuse_adapter_alignments is not set)
+        """
+        results = []
+        for read_sequence in read_sequences:
+            alignments = None
+            if scanner.reuse_adapter_alignments:
+                alignments = ({}, {})
+            adapter, _ = scanner.scan_ends(read_sequence, qcat_config,
+                                           alignments)
+            results.append((adapter, alignments))
+        return results
+
+    @staticmethod
+    def detect_barcodes(scanner, reads, kit_name, qcat_config):
+        """
+        Barcode detection for a slice of a batch
+
+        :param reads: List of read sequence, read qualities, adapter
+        alignments tuples
+        :return: List of barcode result dicts
+        """
+        return [scanner.detect_barcode(read_sequence, read_quality,
+                                       qcat_config, kit_name=kit_name,
+                                       adapter_alignments=alignments)
+                for read_sequence, read_quality, alignments in reads]
+
+    def detect_barcode_batch(self, scanner, read_sequences, read_qualities,
+                             qcat_config):
+        # Only a sample of the reads is scanned once the kit is known
+        # (see kit_detection)
+        stride = scanner.get_kit_stride()
+        sample = read_sequences[::stride] if stride else []
+
+        if not self.split_batches:
+            # Batches are already processed concurrently by the caller
+            scanned = self.scan_ends(scanner, sample, qcat_config)
+        else:
+            units = self.get_units(sample, qcat_config, False)
+            scanned = self.run_units(
+                lambda unit: self.scan_ends(scanner,
+                                            sample[unit[0]:unit[1]],
+                                            qcat_config),
+                units, units)
+        kit_name = self.count_kits(scanner,
+                                   [adapter for adapter, _ in scanned])
+
+        # Adapter alignments of kit detection are reused for barcode
+        # detection (see BarcodeScanner.reuse_adapter_alignments)
+        adapter_alignments = [None] * len(read_sequences)
+        for i, (_, alignments) in enumerate(scanned):
+            adapter_alignments[i * stride] = alignments
+        reads = list(zip(read_sequences, read_qualities, adapter_alignments))
+
+        if not self.split_batches:
+            results = self.detect_barcodes(scanner, reads, kit_name,
+                                           qcat_config)
+            return self.filter_results(scanner, results)
+
+        units = self.get_units([read_sequence for read_sequence, _, _ in
+                                reads],
+                               qcat_config, scanner.scan_middle_adapter)
+        results = self.run_units(
+            lambda unit: self.detect_barcodes(scanner,
+                                              reads[unit[0]:unit[1]],
+                                              kit_name, qcat_config),
+            units, units)
+
+        return self.filter_results(scanner, results)
+
+
+def get_batch_executor(backend, threads, scanner_args):
+    """
+    Create a BatchExecutor
+
+    :param backend: process or thread
+    :param threads: Number of workers
+    :param scanner_args: Keyword arguments passed to scanner.factory in every
+    worker process
+    :return: BatchExecutor
+    """
+    if backend == PROCESS:
+        return ProcessBatchExecutor(threads, scanner_args)
+    if backend == THREAD:
+        return ThreadBatchExecutor(threads)
+    raise ValueError("Invalid parallel backend: {}".format(backend))
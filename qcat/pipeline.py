@@ -0,0 +1,268 @@
+"""
+Reader / detection / writer pipeline.
+
+Batches are read by a reader thread, passed to the detection stage and
+written by a writer thread. Stages are connected by bounded queues and the
+number of batches between reader and writer is limited: when a downstream
+stage falls behind, the upstream stage blocks, so the number of batches held
+in memory is capped.
+
+The detection stage can process several batches at the same time (e.g. when
+barcode detection runs on a pool of worker processes). Batches can then
+finish out of order. In ordered mode, the writer holds finished batches in a
+ReorderBuffer until all preceding batches are written. In unordered mode,
+each batch is written as soon as it is finished. Reads within a batch are
+always written in input order.
+"""
+import logging
+import sys
+import threading
+
+import six
+from six.moves import queue
+
+# Size of the queues between pipeline stages (in batches)
+DEFAULT_QUEUE_SIZE = 2
+
+ORDERED = "ordered"
+UNORDERED = "unordered"
+OUTPUT_ORDERS = [ORDERED, UNORDERED]
+
+# Marks the end of a stream of batches
+_DONE = object()
+
+
+class ReorderBuffer(object):
+    """
+    Holds batches that finished out of order until all batches with a lower
+    sequence number are finished. Keeps track of its memory usage.
+    """
+
+    def __init__(self, sizeof=None):
+        """
+        Init
+
+        :param sizeof: Function returning the (approximate) size of an item
+        in bytes
+        """
+        self.sizeof = sizeof
+        self.next_seq = 0
+        self.pending = {}
+        self.pending_bytes = 0
+        self.max_batches = 0
+        self.max_bytes = 0
+
+    def add(self, seq, item):
+        """
+        Add a finished batch
+
+        :param seq: Sequence number of the batch (starting at 0)
+        :param item: Batch
+        :return: List of batches that can be written now, in order
+        """
+        size = 0
+        if self.sizeof:
+            size = self.sizeof(item)
+        self.pending[seq] = (item, size)
+        self.pending_bytes += size
+
+        self.max_batches = max(self.max_batches, len(self.pending))
+        self.max_bytes = max(self.max_bytes, self.pending_bytes)
+
+        ready = []
+        while self.next_seq in self.pending:
+            item, size = self.pending.pop(self.next_seq)
+            self.pending_bytes -= size
+            ready.append(item)
+            self.next_seq += 1
+        return ready
+
+    def report(self):
+        """
+        Log peak memory usage
+
+        :return: None
+        """
+        logging.debug("Reorder buffer held up to {} batches ({:.1f} MB)".format(
+            self.max_batches, self.max_bytes / 1024.0 / 1024.0))
+
+
+class Pipeline(object):
+    """
+    Runs reading, barcode detection and writing concurrently
+    """
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, detect_threads=1,
+                 output_order=ORDERED, sizeof=None):
+        """
+        Init
+
+        :param queue_size: Maximum number of batches waiting between two
+        stages
+        :type queue_size: int
+        :param detect_threads: Number of batches processed by the detection
+        stage at the same time
+        :type detect_threads: int
+        :param output_order: ordered: write batches in input order,
+        unordered: write batches as soon as they are finished
+        :type output_order: str
+        :param sizeof: Function returning the size of a batch in bytes. Used
+        to report memory usage of the reorder buffer.
+        """
+        if output_order not in OUTPUT_ORDERS:
+            raise ValueError("Invalid output order: {}".format(output_order))
+
+        self.queue_size = max(1, queue_size)
+        self.detect_threads = max(1, detect_threads)
+        self.output_order = output_order
+
+        batch_sizeof = None
+        if sizeof:
+            def batch_sizeof(finished):
+                batch, results = finished
+                return sizeof(batch)
+        self.reorder_buffer = ReorderBuffer(batch_sizeof)
+        self.read_queue = None
+        self.write_queue = None
+        # Limits the number of batches between reader and writer
+        self.window = threading.Semaphore(2 * self.queue_size +
+                                          self.detect_threads)
+        self.stop_event = threading.Event()
+        self.errors = []
+
+    def _put(self, q, item):
+        """
+        Blocking put that gives up when another stage failed
+
+        :return: True if item was added to the queue
+        """
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        """
+        Blocking get that gives up when another stage failed
+
+        :return: Next item or _DONE
+        """
+        while not self.stop_event.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _acquire_window(self):
+        while not self.stop_event.is_set():
+            if self.window.acquire(timeout=0.1):
+                return True
+        return False
+
+    def _fail(self):
+        self.errors.append(sys.exc_info())
+        self.stop_event.set()
+
+    def _read(self, batches):
+        try:
+            for seq, batch in enumerate(batches):
+                if not self._acquire_window():
+                    return
+                if not self._put(self.read_queue, (seq, batch)):
+                    return
+        except BaseException:
+            self._fail()
+        finally:
+            # One end marker per detection thread
+            for _ in range(self.detect_threads):
+                self._put(self.read_queue, _DONE)
+
+    def _detect(self, detect):
+        try:
+            while True:
+                item = self._get(self.read_queue)
+                if item is _DONE:
+                    break
+                seq, batch = item
+                results = detect(batch)
+                if not self._put(self.write_queue, (seq, (batch, results))):
+                    break
+        except BaseException:
+            self._fail()
+        finally:
+            self._put(self.write_queue, _DONE)
+
+    def _write(self, write):
+        try:
+            running = self.detect_threads
+            while running > 0:
+                item = self._get(self.write_queue)
+                if item is _DONE:
+                    if self.stop_event.is_set():
+                        return
+                    running -= 1
+                    continue
+                seq, finished = item
+                if self.output_order == ORDERED:
+                    ready = self.reorder_buffer.add(seq, finished)
+                else:
+                    ready = [finished]
+                for batch, results in ready:
+                    write(batch, results)
+                    self.window.release()
+        except BaseException:
+            self._fail()
+
+    def run(self, batches, detect, write):
+        """
+        Runs the pipeline until all batches are written
+
+        :param batches: Iterator over batches (reader stage)
+        :param detect: Function called with a batch, returns results
+        (detection stage). Called from detect_threads threads at the same
+        time.
+        :param write: Function called with a batch and its results
+        (writer stage)
+        :return: None
+        """
+        self.read_queue = queue.Queue(self.queue_size)
+        self.write_queue = queue.Queue(self.queue_size)
+
+        reader = threading.Thread(target=self._read, args=(batches,),
+                                  name="qcat-reader")
+        writer = threading.Thread(target=self._write, args=(write,),
+                                  name="qcat-writer")
+        detectors = [threading.Thread(target=self._detect, args=(detect,),
+                                      name="qcat-detect-{}".format(i))
+                     for i in range(1, self.detect_threads)]
+
+        threads = [reader, writer] + detectors
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            # The calling thread is one of the detection threads
+            self._detect(detect)
+            for thread in detectors:
+                thread.join()
+            writer.join()
+        except BaseException:
+            self._fail()
+        finally:
+            # Unblock the reader if it is waiting for space in the queue
+            self.stop_event.set()
+            reader.join()
+
+        if self.output_order == ORDERED and self.detect_threads > 1:
+            self.reorder_buffer.report()
+
+        if self.errors:
+            logging.debug("Pipeline stopped after error")
+            # Re-raise the first exception in the calling thread
+            exc_type, exc_value, exc_traceback = self.errors[0]
+            six.reraise(exc_type, exc_value, exc_traceback)
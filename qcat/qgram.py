@@ -0,0 +1,130 @@
+"""
+q-gram index for barcode sets.
+
+Counts the q-grams each barcode of a set shares with the barcode region of
+a read. The barcodes sharing the most q-grams are aligned first (see
+scanner_base.find_highest_scoring_barcode). The upstream and downstream
+context is the same for all barcodes of a set and is not indexed.
+
+The counts also give an upper bound of the barcode score (q-gram lemma): if
+barcode and context (length m) align with e edits, at least m - q + 1 - q * e
+of their q-grams occur in the read. With the barcode scoring (match 1,
+mismatch -1, gap open and extension 1) the alignment score is at most
+m - e.
+"""
+
+# q-gram size
+BARCODE_QGRAM_SIZE = 5
+# Number of barcodes returned by BarcodeQgramIndex.get_candidates
+BARCODE_CANDIDATES = 6
+
+
+def get_qgrams(sequence, q):
+    """
+    Returns all q-grams of sequence
+
+    :param sequence: str
+    :param q: q-gram size
+    :return: set
+    """
+    return set(sequence[i:i + q] for i in range(len(sequence) - q + 1))
+
+
+class BarcodeQgramIndex(object):
+    """
+    Index of the q-grams of all barcodes in a barcode set
+    """
+
+    def __init__(self, barcode_set, q=BARCODE_QGRAM_SIZE,
+                 candidates=BARCODE_CANDIDATES):
+        """
+        :param barcode_set: List of Barcode tuples
+        :param q: q-gram size
+        :param candidates: Number of barcodes returned by get_candidates
+        """
+        self.q = q
+        self.candidates = candidates
+        self.size = len(barcode_set)
+        self.lengths = [len(barcode.sequence) for barcode in barcode_set]
+        self.index = {}
+        for i, barcode in enumerate(barcode_set):
+            for j in range(len(barcode.sequence) - q + 1):
+                self.index.setdefault(barcode.sequence[j:j + q], []).append(i)
+
+    def count_shared_qgrams(self, read_sequence, read_qgrams=None):
+        """
+        Counts the q-gram positions of each barcode that occur in the read
+
+        :param read_sequence: Barcode region of the read
+        :param read_qgrams: q-grams of the read (optional)
+        :return: List with one count per barcode
+        """
+        if read_qgrams is None:
+            read_qgrams = get_qgrams(read_sequence, self.q)
+        counts = [0] * self.size
+        for qgram in read_qgrams:
+            for i in self.index.get(qgram, ()):
+                counts[i] += 1
+        return counts
+
+    def rank(self, read_sequence, counts=None):
+        """
+        Orders the barcodes by the number of q-grams shared with the read
+
+        :param read_sequence: Barcode region of the read
+        :param counts: Result of count_shared_qgrams (optional)
+        :return: List of indices into the barcode set, barcodes with equal
+        counts in the order of the barcode set
+        """
+        if counts is None:
+            counts = self.count_shared_qgrams(read_sequence)
+        return sorted(range(self.size), key=lambda i: -counts[i])
+
+    def get_candidates(self, read_sequence):
+        """
+        Returns the barcodes sharing the most q-grams with the read
+
+        :param read_sequence: Barcode region of the read
+        :return: Sorted list of indices into the barcode set or None if the
+        full barcode set has to be aligned
+        """
+        if self.size <= self.candidates:
+            return None
+        counts = self.count_shared_qgrams(read_sequence)
+        if not max(counts):
+            return None
+        return sorted(self.rank(read_sequence, counts)[:self.candidates])
+
+    def get_score_bounds(self, read_sequence, upstream_context="",
+                         downstream_context=""):
+        """
+        Upper bounds of the barcode scores (0-100, see
+        scanner_base.align_barcode). q-grams of the context are looked up
+        in the read, q-grams overlapping both context and barcode are
+        counted as shared.
+
+        :param read_sequence: Barcode region of the read
+        :param upstream_context: Sequence upstream of barcode in adapter
+        :param downstream_context: Sequence downstream of barcode in adapter
+        :return: List with one bound per barcode
+        """
+        q = self.q
+        read_qgrams = get_qgrams(read_sequence, q)
+        counts = self.count_shared_qgrams(read_sequence, read_qgrams)
+        shared_context = 0
+        for context in [upstream_context, downstream_context]:
+            if context:
+                shared_context += q - 1
+                shared_context += sum(1 for i in range(len(context) - q + 1)
+                                      if context[i:i + q] in read_qgrams)
+
+        context_length = len(upstream_context) + len(downstream_context)
+        bounds = []
+        for length, count in zip(self.lengths, counts):
+            m = length + context_length
+            # e >= ceil((m - q + 1 - shared) / q) = (m - shared) // q
+            edits = (m - count - shared_context) // q
+            if edits < 0:
+                edits = 0
+            bounds.append((m - edits) * 100.0 / m)
+        return bounds
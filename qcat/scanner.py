@@ -3,6 +3,8 @@ from __future__ import print_function
 import logging
 
 from qcat import adapters
+from qcat import kit_detection
+from qcat import parallel
 from qcat.scanner_base import BarcodeScanner
 try:
     from qcat.scanner_guppy import BarcodeScannerGuppy, guppy_import_failed
@@ -76,7 +78,10 @@ def get_kits(kit_folder=None):
 
 
 def factory(mode="epi2me", min_quality=None, kit=None, kit_folder=None,
-            enable_filter_barcodes=False, scan_middle_adapter=False, threads=1):
+            enable_filter_barcodes=False, scan_middle_adapter=False, threads=1,
+            parallel_backend=parallel.PROCESS, concurrent_ends=False,
+            sticky_kit=False,
+            kit_recheck_rate=kit_detection.DEFAULT_RECHECK_RATE):
     """
     Create a BarcodeScanner object
 
@@ -87,6 +92,15 @@ def factory(mode="epi2me", min_quality=None, kit=None, kit_folder=None,
     :param enable_filter_barcodes: Remove barcodes that occur in small numbers
     when running in batch mode
     :param scan_middle_adapter: Scan full read for adapters
+    :param threads: Number of workers used by detect_barcode_batch
+    :param parallel_backend: Run workers as processes or threads
+    (see parallel.BACKENDS)
+    :param concurrent_ends: Scan both ends of a read concurrently in
+    detect_barcode (see BarcodeScanner.enable_concurrent_ends)
+    :param sticky_kit: Keep the kit detected in previous batches instead of
+    detecting it for every batch (see kit_detection)
+    :param kit_recheck_rate: Fraction of reads used to re-check the kit
+    with sticky_kit
     :return: BarcodeScanner object
     """
 
@@ -100,13 +114,32 @@ def factory(mode="epi2me", min_quality=None, kit=None, kit_folder=None,
 
     for subclass in BarcodeScanner.__subclasses__():
         if mode == subclass.get_name():
-            return subclass(min_quality=min_quality,
-                            kit_folder=kit_folder,
-                            kit=kit,
-                            enable_filter_barcodes=enable_filter_barcodes,
-                            scan_middle_adapter=scan_middle_adapter,
-                            threads=threads
-                            )
+            detector = subclass(min_quality=min_quality,
+                                kit_folder=kit_folder,
+                                kit=kit,
+                                enable_filter_barcodes=enable_filter_barcodes,
+                                scan_middle_adapter=scan_middle_adapter,
+                                threads=threads
+                                )
+            if concurrent_ends and mode != "guppy":
+                detector.enable_concurrent_ends()
+            if sticky_kit and mode != "guppy":
+                detector.kit_detector = kit_detection.RunKitDetector(
+                    recheck_rate=kit_recheck_rate)
+            # Guppy does its own multi threading
+            if threads > 1 and mode != "guppy":
+                detector.batch_executor = parallel.get_batch_executor(
+                    parallel_backend,
+                    threads,
+                    scanner_args={
+                        'mode': mode,
+                        'min_quality': min_quality,
+                        'kit': kit,
+                        'kit_folder': kit_folder,
+                        'enable_filter_barcodes': enable_filter_barcodes,
+                        'scan_middle_adapter': scan_middle_adapter
+                    })
+            return detector
 
     raise RuntimeError("Invalid demultiplexing mode: {}".format(mode))
 
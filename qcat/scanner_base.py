@@ -3,31 +3,229 @@ from __future__ import print_function
 import logging
 import sys
 
-try:
-    import parasail
-except ImportError as e:
-    logging.error("Could not load parasail library. Please try reinstalling "
-                  "parasail using pip.")
-    sys.exit(1)
-
 import operator
+from multiprocessing.pool import ThreadPool
 
 from qcat import adapters, calibration
+from qcat import align
 from qcat import config
+from qcat import myers
+from qcat import vectorized
+# Alignment functions moved to the align module, still importable from here
+from qcat.align import ALIGN_PRECISION_32, ALIGN_PRECISION_AUTO, \
+    ALIGN_PRECISIONS, ReadProfile, align_sg, get_alignment_width, \
+    get_precision_stats
+from qcat.layout import CompiledKit
 from qcat.utils import revcomp
 
 
-if parasail.can_use_sse2():
-    parasail_sg_stat = parasail.sg_stats_striped_32
-    parasail_sg = parasail.sg_striped_32
-else:
-    logging.warning("Warning: SSE not supported, falling back to standard alignment")
-    parasail_sg_stat = parasail.sg_stats
-    parasail_sg = parasail.sg
+# Alignment backends (qcatConfig.align_backend, see align module)
+# parasail: align each read window/barcode pair with parasail
+# parasail-profile: build the striped query profile of a read window once
+# and reuse it for all adapter templates (or barcodes). Gives the same
+# results as parasail.
+# numpy: exact semi-global alignment in NumPy (see vectorized.align_target)
+ALIGN_BACKEND_PARASAIL = align.ALIGN_BACKEND_PARASAIL
+ALIGN_BACKEND_PROFILE = align.ALIGN_BACKEND_PROFILE
+ALIGN_BACKEND_NUMPY = align.ALIGN_BACKEND_NUMPY
+ALIGN_BACKENDS = align.get_backend_names()
+
+
+def create_read_profile(read_sequence, matrix, qcat_config):
+    """
+    Prepares a read window for the alignment of many adapter templates or
+    barcodes if the selected alignment backend supports it (see
+    align.AlignBackend.create_profile)
+
+    :param read_sequence: Read window (query of all following alignments)
+    :param matrix: parasail scoring matrix
+    :param qcat_config: qcatConfig object
+    :return: Profile or None
+    """
+    if not read_sequence:
+        return None
+    return align.get_backend(qcat_config.align_backend).create_profile(
+        read_sequence, matrix, qcat_config)
+
+
+# k-mer prefilter for adapter templates (qcatConfig.adapter_prefilter)
+# Templates are ranked by the number of k-mers they share with the read.
+# Only the ADAPTER_PREFILTER_TOP best templates and all templates sharing at
+# least ADAPTER_PREFILTER_MIN_FRACTION of the k-mers of the best template are
+# aligned. If no template shares ADAPTER_PREFILTER_MIN_SHARED k-mers with the
+# read, all templates are aligned.
+ADAPTER_KMER_SIZE = 6
+ADAPTER_PREFILTER_TOP = 4
+ADAPTER_PREFILTER_MIN_FRACTION = 0.5
+ADAPTER_PREFILTER_MIN_SHARED = 4
+
+
+# Barcode scoring backends (qcatConfig.barcode_backend)
+# parasail: semi-global alignment of each barcode (with context)
+# myers: bit-parallel edit distance of all barcodes of a set at once. Faster,
+# but scores can differ slightly from the alignment scores (see myers module)
+# numpy: semi-global alignment of all barcodes of a set at once (see
+# vectorized module). Same scores as parasail.sg
+BARCODE_BACKEND_PARASAIL = "parasail"
+BARCODE_BACKEND_MYERS = "myers"
+BARCODE_BACKEND_NUMPY = "numpy"
+BARCODE_BACKENDS = [BARCODE_BACKEND_PARASAIL, BARCODE_BACKEND_MYERS,
+                    BARCODE_BACKEND_NUMPY]
+
+# Upper bounds of alignment scores (see get_score_bound) are cached by
+# (target sequence, characters of the read, matrix key). Matrices are keyed
+# by their scores (see config.get_matrix_key), so the cache does not grow
+# when a config is unpickled in a worker process
+_score_bounds = {}
+
+
+def get_kmers(sequence, k):
+    """
+    Returns all k-mers of sequence that don't contain Ns
+
+    :param sequence: str
+    :param k: k-mer size
+    :return: set
+    """
+    kmers = set(sequence[i:i + k] for i in range(len(sequence) - k + 1))
+    if "N" in sequence:
+        kmers = set(kmer for kmer in kmers if "N" not in kmer)
+    return kmers
+
+
+class AdapterKmerIndex(object):
+    """
+    Index of the k-mers in the adapter templates (barcode regions are
+    masked with Ns and not indexed)
+    """
+
+    def __init__(self, adapter_templates, k=ADAPTER_KMER_SIZE):
+        """
+        :param adapter_templates: List of AdapterLayout objects
+        :param k: k-mer size
+        """
+        self.k = k
+        self.index = {}
+        self.indexed = set()
+        # Number of reads each template was the best one for
+        # (early termination, see rank)
+        self.hits = {}
+        for template in adapter_templates:
+            sequence = template.get_adapter_sequences()
+            if not sequence:
+                continue
+            self.indexed.add(id(template))
+            for kmer in get_kmers(sequence, k):
+                self.index.setdefault(kmer, []).append(id(template))
+
+    def count_shared_kmers(self, read_sequence):
+        """
+        Counts the k-mers each template shares with the read
+
+        :param read_sequence: Read sequence
+        :return: Dict of id(template) -> number of shared k-mers
+        """
+        counts = {}
+        for kmer in get_kmers(read_sequence, self.k):
+            for template_id in self.index.get(kmer, ()):
+                counts[template_id] = counts.get(template_id, 0) + 1
+        return counts
+
+    def add_hit(self, adapter_template):
+        """
+        Counts how often a template was the best one (see rank)
+
+        :param adapter_template: AdapterLayout object
+        :return: None
+        """
+        template_id = id(adapter_template)
+        self.hits[template_id] = self.hits.get(template_id, 0) + 1
+
+    def rank(self, adapter_templates):
+        """
+        Orders the adapter templates by how often they were the best
+        template so far
+
+        :param adapter_templates: List of AdapterLayout objects
+        :return: List of indices into adapter_templates, templates with equal
+        counts in the order of adapter_templates
+        """
+        hits = self.hits
+        return sorted(range(len(adapter_templates)),
+                      key=lambda i: -hits.get(id(adapter_templates[i]), 0))
+
+    def get_candidates(self, adapter_templates, read_sequence):
+        """
+        Selects the adapter templates that should be aligned to the read
+
+        :param adapter_templates: List of AdapterLayout objects
+        :param read_sequence: Read sequence
+        :return: Set of indices into adapter_templates or None if all
+        templates have to be aligned
+        """
+        counts = self.count_shared_kmers(read_sequence)
+        shared = [counts.get(id(template), 0) for template in adapter_templates]
+        if not shared or max(shared) < ADAPTER_PREFILTER_MIN_SHARED:
+            return None
+
+        ranked = sorted(shared, reverse=True)
+        cutoff = min(ranked[min(ADAPTER_PREFILTER_TOP, len(ranked)) - 1],
+                     ranked[0] * ADAPTER_PREFILTER_MIN_FRACTION)
+
+        candidates = set()
+        for i, template in enumerate(adapter_templates):
+            if shared[i] >= cutoff or id(template) not in self.indexed:
+                candidates.add(i)
+        return candidates
+
+
+def locate_barcode_region(read_sequence, adapter_template, barcode_set_index,
+                          alignment_stop_ref, qcat_config,
+                          compiled_layout=None):
+    """
+    Computes the region of the read that is expected to contain the barcode
+    sequence (see extract_barcode_region)
+
+    :param read_sequence: Sequence of the read
+    :param adapter_template: Adapter layout with masked barcode region
+    :param barcode_set_index: 0 for single barcoding, 0 or 1 for double
+    barcoding
+    :param alignment_stop_ref: Position on the read that the last bp of the
+    adapter template is aligned to
+    :param qcat_config: qcatConfig object
+    :param compiled_layout: Compiled adapter_template (optional)
+    :return: Start and end (inclusive) of the region in the read, expected
+    position of the first barcode bp in the region
+    :rtype: int, int, int
+    """
+    if compiled_layout is not None:
+        adapter_length = compiled_layout.adapter_length
+        compiled_set = compiled_layout.barcode_sets[barcode_set_index]
+        barcode_end = compiled_set.barcode_end
+        barcode_length = compiled_set.barcode_length
+    else:
+        adapter_length = adapter_template.get_adapter_length()
+        barcode_end = adapter_template.get_barcode_end(barcode_set_index)
+        barcode_length = adapter_template.get_barcode_length(
+            barcode_set_index)
+
+    barcode_end_ref = alignment_stop_ref - (adapter_length - barcode_end) + 1
+    barcode_start_ref = barcode_end_ref - barcode_length
+    barcode_start = barcode_start_ref
+
+    # Extend region to allow for indels
+    barcode_start_ref -= min(qcat_config.extracted_barcode_extension,
+                             barcode_start_ref)
+    barcode_end_ref += min(qcat_config.extracted_barcode_extension,
+                           len(read_sequence) - barcode_end_ref)
+
+    return barcode_start_ref, barcode_end_ref, \
+        barcode_start - barcode_start_ref
 
 
 def extract_barcode_region(read_sequence, adapter_template, barcode_set_index,
-                           alignment_stop_ref, qcat_config):
+                           alignment_stop_ref, qcat_config,
+                           compiled_layout=None):
     """
     Extracts the region from the read that is expected to contain
     the barcode sequence.
@@ -41,23 +239,145 @@ def extract_barcode_region(read_sequence, adapter_template, barcode_set_index,
     :type alignment_stop_ref: int
     :param qcat_config: qcatConfig object
     :type qcat_config: qcatConfig
+    :param compiled_layout: Compiled adapter_template (optional)
+    :type compiled_layout: layout.CompiledLayout
     :return: Part of the read that will be used to identify the barcode
     :rtype str
     """
-    adapter_length = adapter_template.get_adapter_length()
-    barcode_end = adapter_template.get_barcode_end(barcode_set_index)
-    barcode_length = adapter_template.get_barcode_length(barcode_set_index)
+    start, end, _ = locate_barcode_region(read_sequence, adapter_template,
+                                          barcode_set_index,
+                                          alignment_stop_ref, qcat_config,
+                                          compiled_layout)
+    return read_sequence[start:end + 1]
 
-    barcode_end_ref = alignment_stop_ref - (adapter_length - barcode_end) + 1
-    barcode_start_ref = barcode_end_ref - barcode_length
 
-    # Extend region to allow for indels
-    barcode_start_ref -= min(qcat_config.extracted_barcode_extension,
-                             barcode_start_ref)
-    barcode_end_ref += min(qcat_config.extracted_barcode_extension,
-                           len(read_sequence) - barcode_end_ref)
+def get_barcode_band(barcode_start, upstream_context, qcat_config):
+    """
+    Band used to align barcodes to an extracted barcode region if
+    qcatConfig.banded_barcodes is set. The band has the same width as the
+    extension of the region (qcatConfig.extracted_barcode_extension), so it
+    allows for the same shift of the barcode as the region itself.
+
+    :param barcode_start: Expected position of the first barcode bp in the
+    region (see locate_barcode_region)
+    :param upstream_context: Sequence upstream of barcode in adapter
+    :param qcat_config: qcatConfig object
+    :return: Expected position of the first bp of upstream context and band
+    width or None
+    :rtype: tuple
+    """
+    if not qcat_config.banded_barcodes:
+        return None
+    return (barcode_start - len(upstream_context),
+            qcat_config.extracted_barcode_extension)
+
+
+def get_score_bound(target, read_sequence, matrix):
+    """
+    Upper bound of the semi-global alignment score of target against
+    read_sequence. Each aligned bp of target scores at most its best match
+    against the characters of the read, gaps have negative scores and the
+    unaligned ends of target score 0. Thus, the score can not exceed the
+    highest sum of best matches over a substring of target, nor the sum of
+    the len(read_sequence) highest best matches.
+
+    :param target: Sequence aligned to the read (adapter or barcode)
+    :param read_sequence: Read sequence
+    :param matrix: parasail scoring matrix
+    :return: Upper bound of the alignment score
+    :rtype: int
+    """
+    alphabet = frozenset(read_sequence)
+    key = (target, alphabet, config.get_matrix_key(matrix))
+    bound = _score_bounds.get(key)
+    if bound is None:
+        scores = matrix.matrix
+        columns = [matrix.mapper[ord(base)] for base in alphabet]
+        best = [max(max(scores[row][column], scores[column][row])
+                    for column in columns)
+                for row in (matrix.mapper[ord(base)] for base in target)]
+        best_substring = 0
+        current = 0
+        for score in best:
+            current = max(0, current + score)
+            best_substring = max(best_substring, current)
+        bound = (int(best_substring),
+                 sorted((int(score) for score in best if score > 0),
+                        reverse=True))
+        _score_bounds[key] = bound
+
+    best_substring, positive = bound
+    if len(read_sequence) < len(target):
+        return min(best_substring, sum(positive[:len(read_sequence)]))
+    return best_substring
+
+
+def is_best_candidate(best_index, best_score, candidates, bounds):
+    """
+    Checks whether a barcode that is not a candidate can replace the best
+    candidate, i.e. score higher or score the same and come first in the
+    barcode set
+
+    :param best_index: Index of the best candidate in the barcode set
+    :param best_score: Score of the best candidate
+    :param candidates: Indices of the aligned barcodes
+    :param bounds: Upper bounds of the scores of all barcodes (see
+    BarcodeQgramIndex.get_score_bounds)
+    :return: True if no other barcode can replace the best candidate
+    :rtype: bool
+    """
+    candidates = set(candidates)
+    for i, bound in enumerate(bounds):
+        if i in candidates:
+            continue
+        if bound > best_score or (bound == best_score and i < best_index):
+            return False
+    return True
+
+
+def align_barcode(barcode_region_read, barcode, upstream_context,
+                  downstream_context, qcat_config, compute_identity=False,
+                  read_profile=None, target=None):
+    """
+    Aligns a single barcode (with context) to the barcode region of the read
+
+    :param barcode_region_read: Sequence extracted from the read that is
+    supposed to contain the barcode
+    :param barcode: Barcode tuple
+    :param upstream_context: Sequence upstream of barcode in adapter_template
+    :param downstream_context: Sequence downstream of barcode in
+    adapter_template
+    :param qcat_config: qcatConfig object
+    :param compute_identity: Compute identity of barcode alignment
+    :param read_profile: Query profile of barcode_region_read
+    (see create_read_profile)
+    :param target: Barcode with context (see layout.compile_barcode_set).
+    Computed from barcode and context if omitted
+    :return: Score (0-100), identity, position of the last aligned bp in
+    the read
+    :rtype: float, float, int
+    """
+    if target is None:
+        target = upstream_context + barcode.sequence + downstream_context
+    if read_profile:
+        aligned_barcode = read_profile.align(target, 1, 1)
+    else:
+        backend = align.get_backend(qcat_config.align_backend)
+        aligned_barcode = backend.align(barcode_region_read,
+                                        target,
+                                        1,
+                                        1,
+                                        qcat_config.matrix_barcode,
+                                        qcat_config,
+                                        stats=compute_identity)
+
+    score = aligned_barcode.score * 100.0 / (1.0 * len(target))
 
-    return read_sequence[barcode_start_ref:barcode_end_ref + 1]
+    identity = 0.0
+    if compute_identity:
+        identity = float(aligned_barcode.matches) / len(barcode.sequence)
+
+    return score, identity, aligned_barcode.end_query
 
 
 def find_highest_scoring_barcode(barcode_region_read,
@@ -65,7 +385,11 @@ def find_highest_scoring_barcode(barcode_region_read,
                                  qcat_config,
                                  upstream_context="",
                                  downstream_context="",
-                                 compute_identity=False):
+                                 compute_identity=False,
+                                 barcode_index=None,
+                                 barcode_scores=None,
+                                 targets=None,
+                                 band=None):
     """
     Aligns all the barcodes from barcode_set to the barcode region that
     was extracted from the read and chooses the barcode with the best alignment
@@ -75,6 +399,24 @@ def find_highest_scoring_barcode(barcode_region_read,
     alignments and secondbest is the second best score. Range is 0-1,
     a reasonable cutoff is between 0.1 and 0.2.
 
+    If qcatConfig.barcode_prefilter is set, only the candidates returned by
+    barcode_index are aligned first. All barcodes are aligned unless the
+    upper bounds of the other barcodes (see
+    BarcodeQgramIndex.get_score_bounds) show that none of them can replace
+    the best candidate (see is_best_candidate). The result is the same as
+    without the prefilter.
+
+    If qcatConfig.early_termination is set, barcodes are aligned in the
+    order of their upper bound and barcodes whose upper bound (see
+    get_score_bound and BarcodeQgramIndex.get_score_bounds) is below the
+    best score found so far are skipped. The result is the same as without
+    early termination.
+
+    With qcatConfig.barcode_backend set to myers, barcodes are scored by
+    edit distance instead of alignment (see myers module). With numpy, all
+    barcodes are aligned at once (see vectorized module). Neither backend
+    computes identity.
+
     :param barcode_region_read: Sequence extracted from the read that is
     supposed to contain the barcode
     :type barcode_region_read: str
@@ -87,6 +429,17 @@ def find_highest_scoring_barcode(barcode_region_read,
     :type downstream_context: str
     :param qcat_config: qcatConfig object
     :type qcat_config: qcatConfig
+    :param barcode_index: q-gram index of barcode_set
+    :type barcode_index: qgram.BarcodeQgramIndex
+    :param barcode_scores: Precomputed (score, identity, end) of all barcodes
+    in barcode_set (see vectorized.score_barcodes_batch)
+    :type barcode_scores: List
+    :param targets: Barcodes of barcode_set with context
+    (see layout.compile_barcode_set). Computed for each barcode if omitted
+    :type targets: tuple
+    :param band: Offset and width of the band the numpy backend aligns
+    barcodes in (see get_barcode_band). Ignored by the other backends
+    :type band: tuple
     :return: Best barcode and quality score
     :rtype Barcode, float
     """
@@ -101,37 +454,134 @@ def find_highest_scoring_barcode(barcode_region_read,
     if not barcode_region_read:
         return max_barcode, q_score, max_identity, max_end
 
-    for barcode in barcode_set:
-
-        if compute_identity:
-            align = parasail_sg_stat
-        else:
-            align = parasail_sg
-
-        aligned_barcode = align(s1=barcode_region_read,
-                                s2=upstream_context +
-                                   barcode.sequence +
-                                   downstream_context,
-                                open=1,
-                                extend=1,
-                                matrix=qcat_config.matrix_barcode)
-
-        score = aligned_barcode.score * 100.0 / (1.0 * len(upstream_context + barcode.sequence + downstream_context))
-
-        identity = 0.0
-        if compute_identity:
-            identity = float(aligned_barcode.matches) / len(barcode.sequence)
-
-        if not max_score or max_score < score:
-            second_best_score = max_score
-            second_best_identity = max_identity
-            max_score = score
-            max_barcode = barcode
-            max_identity = identity
-            max_end = aligned_barcode.end_query
-        elif not second_best_score or second_best_score < score:
-            second_best_score = score
-            second_best_identity = identity
+    alignments = {}
+    read_profile = None
+    candidates = None
+    ranking = None
+    bounds = None
+    if barcode_scores is not None:
+        alignments = dict(enumerate(barcode_scores))
+    elif qcat_config.barcode_backend == BARCODE_BACKEND_MYERS:
+        # Scores all barcodes at once
+        alignments = dict(enumerate(myers.score_barcodes(barcode_region_read,
+                                                         barcode_set,
+                                                         upstream_context,
+                                                         downstream_context)))
+    elif qcat_config.barcode_backend == BARCODE_BACKEND_NUMPY:
+        offset, band_width = band or (None, None)
+        alignments = dict(enumerate(vectorized.score_barcodes(
+            barcode_region_read, barcode_set, qcat_config.matrix_barcode,
+            upstream_context, downstream_context, 1, 1, offset,
+            band_width)))
+    else:
+        if not compute_identity:
+            read_profile = create_read_profile(barcode_region_read,
+                                               qcat_config.matrix_barcode,
+                                               qcat_config)
+
+        if barcode_index is not None and qcat_config.barcode_prefilter:
+            candidates = barcode_index.get_candidates(barcode_region_read)
+
+        if qcat_config.early_termination and barcode_set:
+            # All barcodes of a set have the same length and context
+            if targets is not None:
+                target = targets[0]
+            else:
+                target = upstream_context + barcode_set[0].sequence + \
+                    downstream_context
+            bound = get_score_bound(target, barcode_region_read,
+                                    qcat_config.matrix_barcode) * 100.0 / \
+                (1.0 * len(target))
+            bounds = [bound] * len(barcode_set)
+            if barcode_index is not None:
+                bounds = [min(bound, qgram_bound) for qgram_bound in
+                          barcode_index.get_score_bounds(barcode_region_read,
+                                                         upstream_context,
+                                                         downstream_context)]
+                ranking = sorted(range(len(barcode_set)),
+                                 key=lambda i: -bounds[i])
+
+    scans = [range(len(barcode_set))]
+    if candidates is not None:
+        scans.insert(0, candidates)
+
+    for scan in scans:
+        candidate_scan = scan is candidates
+        if bounds is not None:
+            # Align in order of the upper bounds and skip barcodes that can
+            # not replace the best one in the loop below: a higher score or
+            # an equal score and a lower index
+            if ranking is not None:
+                in_scan = set(scan)
+                scan = [i for i in ranking if i in in_scan]
+            aligned = []
+            best_index = None
+            for i in scan:
+                if i not in alignments and best_index is not None:
+                    best_score = alignments[best_index][0]
+                    if bounds[i] < best_score and ranking is not None:
+                        # Bounds of all remaining barcodes are lower
+                        break
+                    if bounds[i] < best_score or \
+                            (bounds[i] == best_score and i > best_index):
+                        continue
+                if i not in alignments:
+                    alignments[i] = align_barcode(barcode_region_read,
+                                                  barcode_set[i],
+                                                  upstream_context,
+                                                  downstream_context,
+                                                  qcat_config,
+                                                  compute_identity,
+                                                  read_profile,
+                                                  targets and targets[i])
+                aligned.append(i)
+                if best_index is None or \
+                        alignments[i][0] > alignments[best_index][0] or \
+                        (alignments[i][0] == alignments[best_index][0] and
+                         i < best_index):
+                    best_index = i
+            scan = sorted(aligned)
+
+        max_score = None
+        max_identity = 0.0
+        max_end = -1
+        second_best_score = None
+        second_best_identity = 0.0
+        max_barcode = None
+        max_index = None
+
+        for i in scan:
+            barcode = barcode_set[i]
+            if i not in alignments:
+                alignments[i] = align_barcode(barcode_region_read,
+                                              barcode,
+                                              upstream_context,
+                                              downstream_context,
+                                              qcat_config,
+                                              compute_identity,
+                                              read_profile,
+                                              targets and targets[i])
+            score, identity, end = alignments[i]
+
+            if not max_score or max_score < score:
+                second_best_score = max_score
+                second_best_identity = max_identity
+                max_score = score
+                max_barcode = barcode
+                max_index = i
+                max_identity = identity
+                max_end = end
+            elif not second_best_score or second_best_score < score:
+                second_best_score = score
+                second_best_identity = identity
+
+        if candidate_scan and max_score is not None:
+            if bounds is None:
+                bounds = barcode_index.get_score_bounds(barcode_region_read,
+                                                        upstream_context,
+                                                        downstream_context)
+            if is_best_candidate(max_index, max_score, candidates, bounds):
+                break
 
     # print(max_score, file=sys.stderr)
     # if max_score > 0:
@@ -165,11 +615,14 @@ def align_adapter_identity(adapter_sequence, adapter_length, read_sequence,
     if not read_sequence or not adapter_sequence:
         return None, 0.0
 
-    aligned_adapter = parasail_sg_stat(s1=read_sequence,
-                                       s2=adapter_sequence,
-                                       open=qcat_config.gap_open,
-                                       extend=qcat_config.gap_extend,
-                                       matrix=qcat_config.matrix)
+    backend = align.get_backend(qcat_config.align_backend)
+    aligned_adapter = backend.align(read_sequence,
+                                    adapter_sequence,
+                                    qcat_config.gap_open,
+                                    qcat_config.gap_extend,
+                                    qcat_config.matrix,
+                                    qcat_config,
+                                    stats=True)
 
     # Check whether the whole adapter is aligned to the read or only a suffix
     partial_match = aligned_adapter.length < (adapter_length * 0.85)
@@ -188,7 +641,8 @@ def align_adapter_identity(adapter_sequence, adapter_length, read_sequence,
     return aligned_adapter, adapter_identity
 
 
-def align_adapter(adapter_sequence, read_sequence, qcat_config):
+def align_adapter(adapter_sequence, read_sequence, qcat_config,
+                  read_profile=None):
     """
     Aligns a single adapter template to the read an computes the
     identity for the alignment
@@ -204,6 +658,8 @@ def align_adapter(adapter_sequence, read_sequence, qcat_config):
     :type barcode_length: int
     :param qcat_config: qcatConfig object
     :type qcat_config: qcatConfig
+    :param read_profile: Query profile of read_sequence
+    (see create_read_profile)
     :return: Parasail alignment object (None if partial match),
     alignment identity (0.0 if partial match)
     :rtype Result, int
@@ -211,11 +667,19 @@ def align_adapter(adapter_sequence, read_sequence, qcat_config):
     if not read_sequence or not adapter_sequence:
         return None, 0.0
 
-    aligned_adapter = parasail_sg(s1=read_sequence,
-                                  s2=adapter_sequence,
-                                  open=qcat_config.gap_open,
-                                  extend=qcat_config.gap_extend,
-                                  matrix=qcat_config.matrix)
+    if read_profile:
+        aligned_adapter = read_profile.align(adapter_sequence,
+                                             qcat_config.gap_open,
+                                             qcat_config.gap_extend)
+        return aligned_adapter, 0.0
+
+    backend = align.get_backend(qcat_config.align_backend)
+    aligned_adapter = backend.align(read_sequence,
+                                    adapter_sequence,
+                                    qcat_config.gap_open,
+                                    qcat_config.gap_extend,
+                                    qcat_config.matrix,
+                                    qcat_config)
 
     return aligned_adapter, 0.0
 
@@ -256,7 +720,7 @@ def compute_adapter_identity(adapter_template, read_sequence, qcat_config):
 
 
 def eval_adapter_template(adapter_template, read_sequence,
-                          qcat_config, identity=True):
+                          qcat_config, identity=True, read_profile=None):
     """
     Extracts the adapter sequence with masked barcode from the adapter_template
     and aligns (semi-global) it to the 5' end, 3' end or full read.
@@ -267,6 +731,8 @@ def eval_adapter_template(adapter_template, read_sequence,
     :type read_sequence: str
     :param qcat_config: qcatConfig object
     :type qcat_config: qcatConfig
+    :param read_profile: Query profile of read_sequence
+    (see create_read_profile). Only used if identity is False
     :return: Position the last bp of the adapter is aligned to in the read,
     Identity of adapter alignment, Score of adapter alignment
     :rtype: int, float, float
@@ -286,7 +752,8 @@ def eval_adapter_template(adapter_template, read_sequence,
     else:
         ret = align_adapter(adapter_template.get_adapter_sequences(),
                             read_sequence,
-                            qcat_config)
+                            qcat_config,
+                            read_profile)
         aligned_adapter, adapter_identity = ret
 
     if aligned_adapter is not None:
@@ -311,7 +778,8 @@ def get_norm_socre(template, score, qcat_config):
 
 
 def find_best_adapter_template(adapter_templates, read_sequence,
-                               qcat_config):
+                               qcat_config, adapter_index=None,
+                               compiled_kit=None, alignments=None):
     """
     Aligns all passed adapter templates to the read sequence returns the one
     with the highest alignment score
@@ -322,6 +790,20 @@ def find_best_adapter_template(adapter_templates, read_sequence,
     :type read_sequence: str
     :param qcat_config: qcatConfig object
     :type qcat_config: qcatConfig
+    :param adapter_index: If qcatConfig.adapter_prefilter is set, only
+    templates selected by AdapterKmerIndex.get_candidates are aligned. If
+    qcatConfig.early_termination is set, templates are aligned in the order
+    of AdapterKmerIndex.rank and templates that can not reach the best
+    score (see get_score_bound) are skipped
+    :type adapter_index: AdapterKmerIndex
+    :param compiled_kit: Adapter sequences and normalization constants of
+    adapter_templates. Computed for each template if omitted
+    :type compiled_kit: layout.CompiledKit
+    :param alignments: Adapter end position and normalized score of
+    templates that were already aligned to read_sequence, keyed by id of
+    the template. These templates are not aligned again; new alignments are
+    added to the dict
+    :type alignments: dict
     :return: Sequence of best adapter, alignment identity, last position of
     the aligned adapter in the read sequence,
     last position of barcode in the adapter template, length of the barcode
@@ -338,24 +820,93 @@ def find_best_adapter_template(adapter_templates, read_sequence,
     if not isinstance(adapter_templates, list):
         adapter_templates = [adapter_templates]
 
-    for i, template in enumerate(adapter_templates):
+    candidates = None
+    if adapter_index is not None and qcat_config.adapter_prefilter:
+        candidates = adapter_index.get_candidates(adapter_templates,
+                                                  read_sequence)
 
-        if not template.get_adapter_sequences():
-            continue
+    # Only created once the first template has to be aligned
+    read_profile = None
+    profile_created = False
+
+    order = range(len(adapter_templates))
+    if qcat_config.early_termination and adapter_index is not None:
+        order = adapter_index.rank(adapter_templates)
+
+    for i in order:
+        template = adapter_templates[i]
+
+        compiled = None
+        if compiled_kit is not None and compiled_kit.precompile:
+            compiled = compiled_kit.get(template)
+        sequence = template.get_adapter_sequences() if compiled is None \
+            else compiled.sequence
 
-        ret = eval_adapter_template(adapter_template=template,
-                                    read_sequence=read_sequence,
-                                    qcat_config=qcat_config,
-                                    identity=False)
-        adapter_end_position, _, adapter_score = ret
+        if not sequence:
+            continue
 
-        adapter_score = get_norm_socre(template, adapter_score, qcat_config)
+        if candidates is not None and i not in candidates:
+            continue
 
-        if best_adapter_score < adapter_score:
+        if alignments is not None and id(template) in alignments:
+            # Aligned before, e.g. during kit detection
+            adapter_end_position, adapter_score = alignments[id(template)]
+        else:
+            if qcat_config.early_termination and best_adapter_score >= 100.0:
+                # Skip templates that can not replace the best one: a higher
+                # score or, as without early termination, an equal score and
+                # a lower index. Bounds are rarely below 100 (perfect
+                # alignment) for reads longer than the adapter, so they are
+                # only computed after a perfect alignment was found
+                bound = get_score_bound(sequence, read_sequence,
+                                        qcat_config.matrix)
+                if compiled is not None:
+                    bound = bound * 100.0 / compiled.norm_denominator
+                else:
+                    bound = get_norm_socre(template, bound, qcat_config)
+                if bound < best_adapter_score or \
+                        (bound == best_adapter_score and
+                         i > best_adapter_template):
+                    continue
+
+            if not profile_created:
+                read_profile = create_read_profile(read_sequence,
+                                                   qcat_config.matrix,
+                                                   qcat_config)
+                profile_created = True
+
+            if compiled is not None:
+                aligned_adapter, _ = align_adapter(sequence, read_sequence,
+                                                   qcat_config, read_profile)
+                adapter_end_position = aligned_adapter.end_query
+                adapter_score = aligned_adapter.score * 100.0 / \
+                    compiled.norm_denominator
+            else:
+                ret = eval_adapter_template(adapter_template=template,
+                                            read_sequence=read_sequence,
+                                            qcat_config=qcat_config,
+                                            identity=False,
+                                            read_profile=read_profile)
+                adapter_end_position, _, adapter_score = ret
+
+                adapter_score = get_norm_socre(template, adapter_score,
+                                               qcat_config)
+
+            if alignments is not None:
+                alignments[id(template)] = (adapter_end_position,
+                                            adapter_score)
+
+        if best_adapter_score < adapter_score or \
+                (best_adapter_score == adapter_score and
+                 0 <= i < best_adapter_template):
             best_adapter_score = adapter_score
             best_adapter_template = i
             best_adapter_end_position = adapter_end_position
 
+    if qcat_config.early_termination and adapter_index is not None and \
+            best_adapter_template >= 0:
+        adapter_index.add_hit(adapter_templates[best_adapter_template])
+
     return best_adapter_template, best_adapter_end_position, best_adapter_score
 
 
@@ -436,6 +987,15 @@ class BarcodeScanner(object):
         self.enable_filter_barcodes = enable_filter_barcodes
         self.scan_middle_adapter = scan_middle_adapter
 
+        # Set by scanner.factory when running with more than one thread
+        self.batch_executor = None
+        # Thread pool used to scan both ends of a read concurrently
+        # (see enable_concurrent_ends)
+        self.end_pool = None
+        # Keeps the kit detected in previous batches (see kit_detection).
+        # Set by scanner.factory
+        self.kit_detector = None
+
         # Get kets
         if kit_name and kit_name.lower() != 'auto':
             for layout in available_kits:
@@ -446,6 +1006,16 @@ class BarcodeScanner(object):
                 if layout.auto_detect:
                     self.layouts.append(layout)
 
+        self.adapter_index = AdapterKmerIndex(self.layouts)
+
+        # Precompiled alignment targets of self.layouts (see get_compiled_kit)
+        self.precompile_layouts = True
+        self.compiled_kit = self.compile_kit(config.qcatConfig())
+
+        # Keep the adapter alignments of kit detection and reuse them for
+        # barcode detection in detect_barcode_batch
+        self.reuse_adapter_alignments = True
+
     @staticmethod
     def get_name():
         """
@@ -464,7 +1034,8 @@ class BarcodeScanner(object):
         raise NotImplemented("Abstract class")
 
     def scan(self, read_sequence, read_qualities, barcoding_kits,
-             non_barocding_kits, qcat_config=config.qcatConfig()):
+             non_barocding_kits, qcat_config=config.qcatConfig(),
+             adapter_alignments=None):
         """
 
         :param read_sequence:
@@ -472,10 +1043,38 @@ class BarcodeScanner(object):
         :param barcoding_kits:
         :param non_barocding_kits:
         :param qcat_config:
+        :param adapter_alignments: Adapter alignments of read_sequence
+        computed during kit detection (see find_best_adapter_template)
         :return:
         """
         raise NotImplemented("Abstract class")
 
+    def compile_kit(self, qcat_config):
+        """
+        Compiles self.layouts for the settings of qcat_config
+
+        :param qcat_config: qcatConfig object
+        :return: layout.CompiledKit
+        """
+        return CompiledKit(self.layouts, qcat_config.barcode_context_length,
+                           qcat_config.match, qcat_config.nmatch,
+                           precompile=self.precompile_layouts)
+
+    def get_compiled_kit(self, qcat_config):
+        """
+        Compiled adapter layouts. Layouts are recompiled if the settings of
+        qcat_config changed.
+
+        :param qcat_config: qcatConfig object
+        :return: layout.CompiledKit
+        """
+        compiled_kit = self.compiled_kit
+        if not compiled_kit.matches(qcat_config) or \
+                compiled_kit.precompile != self.precompile_layouts:
+            compiled_kit = self.compile_kit(qcat_config)
+            self.compiled_kit = compiled_kit
+        return compiled_kit
+
     def scan_middle(self, sequence, kit_name, qcat_config):
 
         detected_adapters = self.get_adapters(kit_name)
@@ -518,27 +1117,133 @@ class BarcodeScanner(object):
                 file=sys.stderr)
             return True
 
-    def detect_barcode(self,
-                       read_sequence,
-                       read_qualities=None,
-                       qcat_config=config.qcatConfig()):
+    def enable_concurrent_ends(self):
+        """
+        Scan the 5' end, the 3' end and (if enabled) the middle of a read
+        concurrently in detect_barcode. Reduces the latency of single reads
+        (e.g. --no-batch). The alignments release the GIL, so the scans run
+        in parallel.
 
-        if not self.override_kit_name:
-            kits = self.layouts
-        else:
-            kits = self.get_adapters(self.override_kit_name)
+        :return: None
+        """
+        if not self.end_pool:
+            self.end_pool = ThreadPool(processes=3)
 
-        # Check 5' end
-        align_seq_5p = extract_align_sequence(read_sequence,
-                                              False,
-                                              qcat_config.max_align_length)
+    def scan_read_end(self, read_sequence, read_qualities, kits, reverse,
+                      qcat_config, adapter_alignments=None):
+        """
+        Detects adapter and barcode at one end of a read
+
+        :param read_sequence: Read sequence
+        :param read_qualities: Base qualities (not used)
+        :param kits: List of AdapterLayouts
+        :param reverse: Scan reverse complement of the 3' end
+        :param qcat_config: qcatConfig object
+        :param adapter_alignments: Adapter alignments of this end computed
+        by scan_end (optional)
+        :return: see build_return_dict
+        """
+        align_seq = extract_align_sequence(read_sequence,
+                                           reverse,
+                                           qcat_config.max_align_length)
 
-        barcode_dict_5p = self.scan(align_seq_5p,
-                                    read_qualities,
-                                    kits,
-                                    [],
-                                    qcat_config=qcat_config)
+        return self.scan(align_seq,
+                         read_qualities,
+                         kits,
+                         [],
+                         qcat_config=qcat_config,
+                         adapter_alignments=adapter_alignments)
 
+    def detect_barcode(self,
+                       read_sequence,
+                       read_qualities=None,
+                       qcat_config=config.qcatConfig(),
+                       kit_name=None,
+                       adapter_alignments=None):
+        """
+        Detects adapter and barcode at the 5' and 3' end of a read
+
+        :param read_sequence: Read sequence
+        :param read_qualities: Base qualities (not used)
+        :param qcat_config: qcatConfig object
+        :param kit_name: Only use adapters of this kit. Overrides
+        override_kit_name. Passing the kit instead of setting
+        override_kit_name allows calling detect_barcode from multiple
+        threads at the same time
+        :param adapter_alignments: Adapter alignments of the 5' and 3' end
+        computed during kit detection (see scan_ends). Templates found there
+        are not aligned again
+        :return: see build_return_dict
+        """
+        if not kit_name:
+            kit_name = self.override_kit_name
+
+        kits = self.get_kit_layouts(kit_name)
+
+        alignments_5p = alignments_3p = None
+        if adapter_alignments:
+            alignments_5p, alignments_3p = adapter_alignments
+
+        middle_result = None
+        if self.end_pool:
+            # Scan both ends concurrently
+            result_5p = self.end_pool.apply_async(
+                self.scan_read_end,
+                (read_sequence, read_qualities, kits, False, qcat_config,
+                 alignments_5p))
+            result_5p_rc = self.end_pool.apply_async(
+                self.scan_read_end,
+                (read_sequence, read_qualities, kits, True, qcat_config,
+                 alignments_3p))
+
+            # If all adapters belong to the same kit, the kit passed to
+            # scan_middle is known before the ends are scanned
+            kit_names = set(layout.kit for layout in kits)
+            if self.scan_middle_adapter and len(kit_names) == 1:
+                middle_kit = kit_names.pop()
+                middle_result = (middle_kit, self.end_pool.apply_async(
+                    self.scan_middle,
+                    (read_sequence, middle_kit, qcat_config)))
+
+            barcode_dict_5p = result_5p.get()
+            barcode_dict_5p_rc = result_5p_rc.get()
+        else:
+            # Check 5' end
+            barcode_dict_5p = self.scan_read_end(read_sequence,
+                                                 read_qualities,
+                                                 kits,
+                                                 False,
+                                                 qcat_config,
+                                                 alignments_5p)
+            # Check 3' end
+            barcode_dict_5p_rc = self.scan_read_end(read_sequence,
+                                                    read_qualities,
+                                                    kits,
+                                                    True,
+                                                    qcat_config,
+                                                    alignments_3p)
+
+        return self.combine_end_results(read_sequence,
+                                        barcode_dict_5p,
+                                        barcode_dict_5p_rc,
+                                        qcat_config,
+                                        middle_result)
+
+    def combine_end_results(self, read_sequence, barcode_dict_5p,
+                            barcode_dict_5p_rc, qcat_config,
+                            middle_result=None):
+        """
+        Combines the results of both ends of a read (see scan_read_end)
+        into the final barcode call and computes trimming positions
+
+        :param read_sequence: Read sequence
+        :param barcode_dict_5p: Result for the 5' end
+        :param barcode_dict_5p_rc: Result for the reverse complemented 3' end
+        :param qcat_config: qcatConfig object
+        :param middle_result: Kit name and AsyncResult of a scan_middle call
+        started in advance (optional)
+        :return: see build_return_dict
+        """
         trim_5p = 0
         if barcode_dict_5p['adapter_end'] > 0:
             trim_5p = barcode_dict_5p['adapter_end']
@@ -547,17 +1252,6 @@ class BarcodeScanner(object):
             'barcode_score'] < self.min_quality:
             barcode_dict_5p = empty_return_dict()
 
-        # Check 3' end
-        align_seq_5p_rc = extract_align_sequence(read_sequence,
-                                                 True,
-                                                 qcat_config.max_align_length)
-
-        barcode_dict_5p_rc = self.scan(align_seq_5p_rc,
-                                       read_qualities,
-                                       kits,
-                                       [],
-                                       qcat_config=qcat_config)
-
         trim_3p = len(read_sequence)
         if barcode_dict_5p_rc['adapter'] and barcode_dict_5p_rc[
             'adapter_end'] > 0:
@@ -590,9 +1284,16 @@ class BarcodeScanner(object):
                     best = empty_return_dict()
                     best['exit_status'] = 1002
 
-        if self.scan_middle_adapter and best['adapter'] and self.scan_middle(read_sequence, best['adapter'].kit, qcat_config):
-            best = empty_return_dict()
-            best['exit_status'] = 997
+        if self.scan_middle_adapter and best['adapter']:
+            if middle_result and middle_result[0] == best['adapter'].kit:
+                middle_found = middle_result[1].get()
+            else:
+                middle_found = self.scan_middle(read_sequence,
+                                                best['adapter'].kit,
+                                                qcat_config)
+            if middle_found:
+                best = empty_return_dict()
+                best['exit_status'] = 997
 
         best["trim5p"] = trim_5p
         best["trim3p"] = trim_3p
@@ -603,37 +1304,65 @@ class BarcodeScanner(object):
 
         return best
 
+    def get_kit_layouts(self, kit_name):
+        """
+        Adapter layouts used for barcode detection
+
+        :param kit_name: Name of the kit. None for all kits
+        :return: List of AdapterLayouts
+        """
+        if not kit_name:
+            return self.layouts
+        return self.compiled_kit.get_layouts(kit_name)
+
     def get_adapters(self, kit_name):
-        result = []
-        for layout in self.layouts:
-            if kit_name.lower() == layout.kit.lower():
-                result.append(layout)
-        return result
+        return list(self.compiled_kit.get_layouts(kit_name))
 
     def get_adapter(self, kit_name):
-        for layout in self.layouts:
-            if kit_name.lower() == layout.kit.lower():
-                return layout
+        for layout in self.compiled_kit.get_layouts(kit_name):
+            return layout
 
-    def scan_end(self, sequence, reverse, qcat_config):
+    def scan_end(self, sequence, reverse, qcat_config, alignments=None):
         # Check 5' end
         align_seq_5p = extract_align_sequence(sequence,
                                               reverse,
                                               qcat_config.max_align_length)
 
-        ret = find_best_adapter_template(adapter_templates=self.layouts,
-                                         read_sequence=align_seq_5p,
-                                         qcat_config=qcat_config)
+        ret = find_best_adapter_template(
+            adapter_templates=self.layouts,
+            read_sequence=align_seq_5p,
+            qcat_config=qcat_config,
+            adapter_index=self.adapter_index,
+            compiled_kit=self.get_compiled_kit(qcat_config),
+            alignments=alignments)
 
         best_adapter_template_index, aligned_adapter_end, best_adapter_score = ret
 
         return self.layouts[best_adapter_template_index], aligned_adapter_end, best_adapter_score
 
-    def scan_ends(self, read_sequence, qcat_config):
+    def scan_ends(self, read_sequence, qcat_config, adapter_alignments=None):
+        """
+        Finds the best adapter at both ends of a read
+
+        :param read_sequence: Read sequence
+        :param qcat_config: qcatConfig object
+        :param adapter_alignments: Optional tuple of two dicts that receive
+        the adapter alignments of the 5' and 3' end (see
+        find_best_adapter_template)
+        :return: Adapter of the end with the higher score, adapter of the
+        other end
+        """
+        alignments_5p = alignments_3p = None
+        if adapter_alignments is not None:
+            alignments_5p, alignments_3p = adapter_alignments
         # 5' end
-        adapter_5p, end5p, score_5p = self.scan_end(read_sequence, False, qcat_config)
+        adapter_5p, end5p, score_5p = self.scan_end(read_sequence, False,
+                                                    qcat_config,
+                                                    alignments_5p)
         # 3' end
-        adapter_3p, end3p, score_3p = self.scan_end(read_sequence, True, qcat_config)
+        adapter_3p, end3p, score_3p = self.scan_end(read_sequence, True,
+                                                    qcat_config,
+                                                    alignments_3p)
         end3p = qcat_config.max_align_length - end3p
 
         if score_5p > score_3p:
@@ -659,23 +1388,65 @@ class BarcodeScanner(object):
             return None
         return sorted(adapter_counts.items(), key=operator.itemgetter(1), reverse=True)[0][0]
 
+    def get_kit_stride(self):
+        """
+        Step between the reads of a batch that are scanned for kit
+        detection (see kit_detection.RunKitDetector.get_stride)
+
+        :return: 1 for all reads, 0 for none
+        """
+        if not self.kit_detector:
+            return 1
+        return self.kit_detector.get_stride()
+
+    def get_batch_kit(self, adapter_counts):
+        """
+        Kit used for a batch
+
+        :param adapter_counts: Number of scanned reads per kit (see
+        update_kit_count)
+        :return: Most abundant kit, or the kit detected in previous batches
+        if kit_detector is set
+        """
+        kit_name = self.get_most_abundant_kits(adapter_counts)
+        if self.kit_detector:
+            kit_name = self.kit_detector.update(adapter_counts, kit_name)
+        return kit_name
+
     def detect_kit(self, read_sequences, qcat_config):
+        """
+        Most abundant kit in a batch of reads
 
+        :param read_sequences: List of read sequences
+        :param qcat_config: qcatConfig object
+        :return: Kit name, adapter alignments of both ends of each read (see
+        scan_ends, None for reads that were not scanned). Empty if
+        reuse_adapter_alignments is not set
+        """
         adapter_counts = {}
 
-        adapter_ends = []
-
-        for read_sequence in read_sequences:
-            adapter_1, adapter_2 = self.scan_ends(read_sequence, qcat_config)
+        adapter_alignments = []
+
+        stride = self.get_kit_stride()
+        for i, read_sequence in enumerate(read_sequences):
+            if stride == 0 or i % stride:
+                # Kit is known from previous batches
+                if self.reuse_adapter_alignments:
+                    adapter_alignments.append(None)
+                continue
+            alignments = None
+            if self.reuse_adapter_alignments:
+                alignments = ({}, {})
+                adapter_alignments.append(alignments)
+            adapter_1, adapter_2 = self.scan_ends(read_sequence, qcat_config,
+                                                  alignments)
             self.update_kit_count(adapter_1, adapter_counts)
             # self.update_kit_count(adapter_2, adapter_counts)
             # self.update_kit_count(adapter, adapter_counts)
 
-            # adapter_ends.append((end5p, end3p))
-
-        kit_name = self.get_most_abundant_kits(adapter_counts)
+        kit_name = self.get_batch_kit(adapter_counts)
 
-        return kit_name, adapter_ends
+        return kit_name, adapter_alignments
 
     @staticmethod
     def update_barcode_count(result, barcode_count):
@@ -713,21 +1484,45 @@ class BarcodeScanner(object):
 
     def detect_barcode_batch(self, read_sequences, read_qualities=[None],
                              qcat_config=config.qcatConfig()):
+        if self.batch_executor:
+            return self.batch_executor.detect_barcode_batch(self,
+                                                            read_sequences,
+                                                            read_qualities,
+                                                            qcat_config)
+
         # barcode_count = [0] * 1000
         barcode_count = {}
 
-        kit_name, _ = self.detect_kit(read_sequences, qcat_config)
+        kit_name, adapter_alignments = self.detect_kit(read_sequences,
+                                                       qcat_config)
         results = []
 
-        self.override_kit_name = kit_name
-        for read_sequence, read_quality in zip(read_sequences, read_qualities):
-            result = self.detect_barcode(read_sequence, read_quality, qcat_config)
+        for i, (read_sequence, read_quality) in \
+                enumerate(zip(read_sequences, read_qualities)):
+            alignments = None
+            if adapter_alignments:
+                alignments = adapter_alignments[i]
+            result = self.detect_barcode(read_sequence, read_quality,
+                                         qcat_config, kit_name=kit_name,
+                                         adapter_alignments=alignments)
             self.update_barcode_count(result, barcode_count)
             results.append(result)
 
-        self.override_kit_name = None
-
         if self.enable_filter_barcodes:
             results = self.filter_barcodes(barcode_count, results)
 
         return results
+
+    def close(self):
+        """
+        Shut down worker processes/threads (if any)
+
+        :return: None
+        """
+        if self.batch_executor:
+            self.batch_executor.close()
+            self.batch_executor = None
+        if self.end_pool:
+            self.end_pool.close()
+            self.end_pool.join()
+            self.end_pool = None
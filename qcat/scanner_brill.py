@@ -81,11 +81,15 @@ class BarcodeScannerBrill(BarcodeScanner):
     def detect_barcode(self,
                        read_sequence,
                        read_qualities=None,
-                       qcat_config=config.qcatConfig()):
+                       qcat_config=config.qcatConfig(),
+                       kit_name=None,
+                       adapter_alignments=None):
 
         result = empty_return_dict()
 
-        if not self.override_kit_name:
+        if kit_name:
+            override_kit_name = kit_name
+        elif not self.override_kit_name:
             detected_adapter, _ = self.scan_ends(read_sequence, qcat_config)
             override_kit_name = detected_adapter.kit
         else:
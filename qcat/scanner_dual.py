@@ -1,11 +1,14 @@
 import logging
+from multiprocessing.pool import ThreadPool
 
 from qcat import config
+from qcat import vectorized
 from qcat.adapters import Barcode
 from qcat.scanner import BarcodeScanner
 from qcat.scanner_base import find_best_adapter_template, \
-    extract_barcode_region, find_highest_scoring_barcode, build_return_dict, \
-    empty_return_dict
+    locate_barcode_region, find_highest_scoring_barcode, build_return_dict, \
+    empty_return_dict, extract_align_sequence, get_barcode_band, \
+    BARCODE_BACKEND_NUMPY
 
 
 class BarcodeScannerDual(BarcodeScanner):
@@ -15,11 +18,6 @@ class BarcodeScannerDual(BarcodeScanner):
         if min_quality is None:
             min_quality = 60
 
-        if threads != 1:
-            logging.warning("Multi threading is not yet supported in "
-                            "dual mode. Falling back to using a "
-                            "single thread.")
-
         super(BarcodeScannerDual, self).__init__(min_quality,
                                                  "dual",
                                                  kit_folder=kit_folder,
@@ -27,106 +25,180 @@ class BarcodeScannerDual(BarcodeScanner):
                                                  scan_middle_adapter=scan_middle_adapter
                                                  )
         self.barcodes = None
+        # Thread pool used to align both barcode sets concurrently
+        # (see enable_concurrent_ends)
+        self.set_pool = None
 
     @staticmethod
     def get_name():
         return "dual"
 
-    def scan(self,
-             read_sequence,
-             read_qualities,
-             bc_adapter_templates,
-             nobc_adapter_templates,
-             qcat_config=config.qcatConfig()):
+    def enable_concurrent_ends(self):
         """
-            Detects sequencing adapter and identifies best matching barcode
+        In addition to scanning both ends of a read concurrently, align the
+        two barcode sets concurrently. In batch mode, the barcode set
+        alignments of all reads in a batch are distributed over the pool.
 
-            :param read_sequence: Read sequence containing adapter
-            :type read_sequence: str
-            :param read_qualities: Base qualities of the read in Sanger encoding
-            :type read_qualities: str
-            :param adapter_templates: List of AdapterLayout objects
-            with Ns
-            :type adapter_templates: List
-            :param qcat_config: qcatConfig object
-            :type qcat_config: qcatConfig
-            :return: see build_return_dict
-            :rtype: Dictionary
-            """
-        exit_status = 0
+        :return: None
+        """
+        super(BarcodeScannerDual, self).enable_concurrent_ends()
+        if not self.set_pool:
+            self.set_pool = ThreadPool(processes=2)
+
+    def close(self):
+        super(BarcodeScannerDual, self).close()
+        if self.set_pool:
+            self.set_pool.close()
+            self.set_pool.join()
+            self.set_pool = None
+
+    def locate_barcodes(self, read_sequence, bc_adapter_templates,
+                        qcat_config, adapter_alignments=None):
+        """
+        Finds the best adapter and extracts the regions of the read that
+        contain the two barcodes
+
+        :param read_sequence: Read sequence containing adapter
+        :param bc_adapter_templates: List of AdapterLayout objects
+        :param qcat_config: qcatConfig object
+        :param adapter_alignments: Adapter alignments of read_sequence
+        computed during kit detection (see find_best_adapter_template)
+        :return: Best adapter, position of the last bp of the adapter on the
+        read, one barcode alignment job per barcode set
+        (see align_barcode_set)
+        :rtype: AdapterLayout, int, List
+        """
+        compiled_kit = self.get_compiled_kit(qcat_config)
 
         # Finding best barcoded adapters
         ret = find_best_adapter_template(adapter_templates=bc_adapter_templates,
                                          read_sequence=read_sequence,
-                                         qcat_config=qcat_config)
+                                         qcat_config=qcat_config,
+                                         adapter_index=self.adapter_index,
+                                         compiled_kit=compiled_kit,
+                                         alignments=adapter_alignments)
 
         best_adapter_template_index, aligned_adapter_end, best_adapter_score = ret
 
         # if barcoded adapter found
         best_adapter_template = bc_adapter_templates[
             best_adapter_template_index]
-
-        # Detect barcode
-        barcode_set_index = 0
+        compiled_layout = compiled_kit.get(best_adapter_template)
 
         # For high quality adapter alignments just use the barcode region,
         # for low quality compare full adapter to the barcodes
         # Do not scann full adapter is it contains double barcoding
         # best_adapter_score > 90.0 or
+        jobs = []
+        for barcode_set_index in [0, 1]:
+            compiled_set = compiled_layout.barcode_sets[barcode_set_index]
+            start, end, barcode_start = locate_barcode_region(
+                read_sequence=read_sequence,
+                adapter_template=best_adapter_template,
+                barcode_set_index=barcode_set_index,
+                alignment_stop_ref=aligned_adapter_end,
+                qcat_config=qcat_config,
+                compiled_layout=compiled_layout)
+            barcode_region_read = read_sequence[start:end + 1]
+            band = get_barcode_band(barcode_start,
+                                    compiled_set.upstream_context,
+                                    qcat_config)
+
+            barcode_set = compiled_set.barcodes
+            barcode_index = compiled_set.index
+            targets = compiled_set.targets
+            if self.barcodes:
+                barcode_set = self.barcodes
+                barcode_index = None
+                targets = None
+
+            jobs.append((barcode_region_read, barcode_set,
+                         compiled_set.upstream_context,
+                         compiled_set.downstream_context, qcat_config,
+                         barcode_index, None, targets, band))
+
+        return best_adapter_template, aligned_adapter_end, jobs
+
+    @staticmethod
+    def align_barcode_set(job):
+        """
+        Finds the best barcode of a barcode set
+
+        :param job: Barcode region of the read, barcode set, upstream
+        context, downstream context, qcatConfig, q-gram index of the
+        barcode set, precomputed barcode scores (or None), barcodes with
+        context (see layout.compile_barcode_set, or None), band
+        (see get_barcode_band, or None)
+        :return: see find_highest_scoring_barcode
+        """
+        barcode_region_read, barcode_set, up_context, down_context, \
+            qcat_config, barcode_index, barcode_scores, targets, band = job
+        return find_highest_scoring_barcode(
+            barcode_region_read=barcode_region_read,
+            barcode_set=barcode_set,
+            upstream_context=up_context,
+            downstream_context=down_context,
+            qcat_config=qcat_config,
+            barcode_index=barcode_index,
+            barcode_scores=barcode_scores,
+            targets=targets,
+            band=band)
+
+    @staticmethod
+    def score_barcode_jobs(jobs):
+        """
+        Scores the barcode regions of all jobs that share barcode set,
+        context and band width in one pass (numpy barcode backend, see
+        vectorized.score_barcodes_batch)
+
+        :param jobs: List of jobs (see align_barcode_set)
+        :return: List of jobs with precomputed barcode scores
+        """
+        groups = {}
+        for i, job in enumerate(jobs):
+            barcode_region_read, barcode_set, up_context, down_context = \
+                job[:4]
+            band = job[8]
+            if barcode_region_read:
+                key = (id(barcode_set), up_context, down_context,
+                       band and band[1])
+                groups.setdefault(key, []).append(i)
+
+        barcode_scores = [None] * len(jobs)
+        for key, indices in groups.items():
+            _, barcode_set, up_context, down_context, qcat_config = \
+                jobs[indices[0]][:5]
+            band_width = key[3]
+            offsets = None
+            if band_width is not None:
+                offsets = [jobs[i][8][0] for i in indices]
+            results = vectorized.score_barcodes_batch(
+                [jobs[i][0] for i in indices], barcode_set,
+                qcat_config.matrix_barcode, up_context, down_context, 1, 1,
+                offsets, band_width)
+            for i, result in zip(indices, results):
+                barcode_scores[i] = result
+
+        return [job[:6] + (scores,) + job[7:]
+                for job, scores in zip(jobs, barcode_scores)]
+
+    @staticmethod
+    def build_dual_result(best_adapter_template, aligned_adapter_end,
+                          barcode_results):
+        """
+        Combines the best barcodes of both barcode sets
+
+        :param best_adapter_template: Best adapter
+        :param aligned_adapter_end: Position of the last bp of the adapter
+        :param barcode_results: Result of align_barcode_set for both sets
+        :return: see build_return_dict
+        """
+        exit_status = 0
 
-        barcode_region_read = extract_barcode_region(
-            read_sequence=read_sequence,
-            adapter_template=best_adapter_template,
-            barcode_set_index=barcode_set_index,
-            alignment_stop_ref=aligned_adapter_end,
-            qcat_config=qcat_config)
-
-        # First barcode
-        up_context = best_adapter_template.get_upstream_context(
-            qcat_config.barcode_context_length, barcode_set_index)
-        down_context = best_adapter_template.get_downstream_context(
-            qcat_config.barcode_context_length, barcode_set_index)
-        barcode_set = best_adapter_template.get_barcode_set(
-            barcode_set_index)
-        if self.barcodes:
-            barcode_set = self.barcodes
-
-        # Find best barcode
         best_barcode, best_barcode_q_score, best_barcode_score, barcode_end = \
-            find_highest_scoring_barcode(
-                barcode_region_read=barcode_region_read,
-                barcode_set=barcode_set,
-                upstream_context=up_context,
-                downstream_context=down_context,
-                qcat_config=qcat_config)
-
-        # Detect second barcode
-        barcode_set_index = 1
-        barcode_region_read = extract_barcode_region(
-            read_sequence=read_sequence,
-            adapter_template=best_adapter_template,
-            barcode_set_index=barcode_set_index,
-            alignment_stop_ref=aligned_adapter_end,
-            qcat_config=qcat_config)
-
-        # First barcode
-        up_context = best_adapter_template.get_upstream_context(
-            qcat_config.barcode_context_length, barcode_set_index)
-        down_context = best_adapter_template.get_downstream_context(
-            qcat_config.barcode_context_length, barcode_set_index)
-        barcode_set = best_adapter_template.get_barcode_set(
-            barcode_set_index)
-        if self.barcodes:
-            barcode_set = self.barcodes
-
-        # Find best barcode
+            barcode_results[0]
         best_barcode_2, best_barcode_q_score_2, best_barcode_score_2, barcode_end_2 = \
-            find_highest_scoring_barcode(
-                barcode_region_read=barcode_region_read,
-                barcode_set=barcode_set,
-                upstream_context=up_context,
-                downstream_context=down_context,
-                qcat_config=qcat_config)
+            barcode_results[1]
 
         if best_barcode and best_barcode_2:
             dual_barcode = Barcode("barcode{:02d}/{:02d}".format(best_barcode.id, best_barcode_2.id),
@@ -144,3 +216,136 @@ class BarcodeScannerDual(BarcodeScanner):
             )
         else:
             return empty_return_dict()
+
+    def scan(self,
+             read_sequence,
+             read_qualities,
+             bc_adapter_templates,
+             nobc_adapter_templates,
+             qcat_config=config.qcatConfig(),
+             adapter_alignments=None):
+        """
+            Detects sequencing adapter and identifies best matching barcode
+
+            :param read_sequence: Read sequence containing adapter
+            :type read_sequence: str
+            :param read_qualities: Base qualities of the read in Sanger encoding
+            :type read_qualities: str
+            :param adapter_templates: List of AdapterLayout objects
+            with Ns
+            :type adapter_templates: List
+            :param qcat_config: qcatConfig object
+            :type qcat_config: qcatConfig
+            :param adapter_alignments: Adapter alignments of read_sequence
+            computed during kit detection (see find_best_adapter_template)
+            :type adapter_alignments: dict
+            :return: see build_return_dict
+            :rtype: Dictionary
+            """
+        best_adapter_template, aligned_adapter_end, jobs = \
+            self.locate_barcodes(read_sequence, bc_adapter_templates,
+                                 qcat_config, adapter_alignments)
+
+        if self.set_pool:
+            barcode_results = self.set_pool.map(self.align_barcode_set, jobs)
+        else:
+            barcode_results = [self.align_barcode_set(job) for job in jobs]
+
+        return self.build_dual_result(best_adapter_template,
+                                      aligned_adapter_end,
+                                      barcode_results)
+
+    def scan_batch(self, read_sequences, bc_adapter_templates, qcat_config,
+                   adapter_alignments=None):
+        """
+        Batch version of scan. Barcode set alignments of all reads are
+        collected first and evaluated together.
+
+        :param read_sequences: List of read sequences (read ends)
+        :param bc_adapter_templates: List of AdapterLayout objects
+        :param qcat_config: qcatConfig object
+        :param adapter_alignments: Adapter alignments of each read end
+        computed during kit detection (optional)
+        :return: List of result dicts (see build_return_dict)
+        """
+        if not adapter_alignments:
+            adapter_alignments = [None] * len(read_sequences)
+        located = [self.locate_barcodes(read_sequence, bc_adapter_templates,
+                                        qcat_config, alignments)
+                   for read_sequence, alignments in
+                   zip(read_sequences, adapter_alignments)]
+
+        jobs = [job for _, _, read_jobs in located for job in read_jobs]
+        if qcat_config.barcode_backend == BARCODE_BACKEND_NUMPY:
+            jobs = self.score_barcode_jobs(jobs)
+        if self.set_pool:
+            # A few chunks per thread
+            chunksize = max(1, len(jobs) // 8)
+            barcode_results = self.set_pool.map(self.align_barcode_set, jobs,
+                                                chunksize=chunksize)
+        else:
+            barcode_results = [self.align_barcode_set(job) for job in jobs]
+
+        results = []
+        for i, (best_adapter_template, aligned_adapter_end, _) in \
+                enumerate(located):
+            results.append(self.build_dual_result(
+                best_adapter_template,
+                aligned_adapter_end,
+                barcode_results[2 * i:2 * i + 2]))
+        return results
+
+    def detect_barcode_batch(self, read_sequences, read_qualities=[None],
+                             qcat_config=config.qcatConfig()):
+        """
+        Same as BarcodeScanner.detect_barcode_batch, but the read ends of
+        the whole batch are scanned with scan_batch
+
+        :param read_sequences: List of read sequences
+        :param read_qualities: List of read qualities
+        :param qcat_config: qcatConfig object
+        :return: List of barcode result dicts
+        """
+        if self.batch_executor:
+            return super(BarcodeScannerDual, self).detect_barcode_batch(
+                read_sequences, read_qualities, qcat_config)
+
+        kit_name, adapter_alignments = self.detect_kit(read_sequences,
+                                                       qcat_config)
+        kits = self.get_kit_layouts(kit_name)
+
+        # zip() truncates to the shorter list
+        read_sequences = [read_sequence for read_sequence, _ in
+                          zip(read_sequences, read_qualities)]
+
+        alignments_5p = [alignments[0] if alignments else None
+                         for alignments in adapter_alignments]
+        alignments_3p = [alignments[1] if alignments else None
+                         for alignments in adapter_alignments]
+
+        results_5p = self.scan_batch(
+            [extract_align_sequence(read_sequence, False,
+                                    qcat_config.max_align_length)
+             for read_sequence in read_sequences],
+            kits, qcat_config, alignments_5p)
+        results_5p_rc = self.scan_batch(
+            [extract_align_sequence(read_sequence, True,
+                                    qcat_config.max_align_length)
+             for read_sequence in read_sequences],
+            kits, qcat_config, alignments_3p)
+
+        barcode_count = {}
+        results = []
+        for read_sequence, barcode_dict_5p, barcode_dict_5p_rc in \
+                zip(read_sequences, results_5p, results_5p_rc):
+            result = self.combine_end_results(read_sequence,
+                                              barcode_dict_5p,
+                                              barcode_dict_5p_rc,
+                                              qcat_config)
+            self.update_barcode_count(result, barcode_count)
+            results.append(result)
+
+        if self.enable_filter_barcodes:
+            results = self.filter_barcodes(barcode_count, results)
+
+        return results
@@ -3,7 +3,8 @@ import logging
 from qcat import config
 from qcat.scanner import BarcodeScanner
 from qcat.scanner_base import find_best_adapter_template, \
-    extract_barcode_region, find_highest_scoring_barcode, build_return_dict
+    locate_barcode_region, find_highest_scoring_barcode, build_return_dict, \
+    get_barcode_band
 
 
 class BarcodeScannerEPI2ME(BarcodeScanner):
@@ -13,11 +14,6 @@ class BarcodeScannerEPI2ME(BarcodeScanner):
         if min_quality is None:
             min_quality = 58
 
-        if threads != 1:
-            logging.warning("Multi threading is not yet supported in "
-                            "epi2mme mode. Falling back to using a "
-                            "single thread.")
-
         super(BarcodeScannerEPI2ME, self).__init__(min_quality,
                                                    kit,
                                                    kit_folder=kit_folder,
@@ -35,7 +31,8 @@ class BarcodeScannerEPI2ME(BarcodeScanner):
              read_qualities,
              bc_adapter_templates,
              nobc_adapter_templates,
-             qcat_config=config.qcatConfig()):
+             qcat_config=config.qcatConfig(),
+             adapter_alignments=None):
         """
             Detects sequencing adapter and identifies best matching barcode
 
@@ -48,21 +45,29 @@ class BarcodeScannerEPI2ME(BarcodeScanner):
             :type adapter_templates: List
             :param qcat_config: qcatConfig object
             :type qcat_config: qcatConfig
+            :param adapter_alignments: Adapter alignments of read_sequence
+            computed during kit detection (see find_best_adapter_template)
+            :type adapter_alignments: dict
             :return: see build_return_dict
             :rtype: Dictionary
             """
         exit_status = 0
+        compiled_kit = self.get_compiled_kit(qcat_config)
 
         # Finding best barcoded adapters
         ret = find_best_adapter_template(adapter_templates=bc_adapter_templates,
                                          read_sequence=read_sequence,
-                                         qcat_config=qcat_config)
+                                         qcat_config=qcat_config,
+                                         adapter_index=self.adapter_index,
+                                         compiled_kit=compiled_kit,
+                                         alignments=adapter_alignments)
 
         best_adapter_template_index, aligned_adapter_end, best_adapter_score = ret
 
         # if barcoded adapter found
         best_adapter_template = bc_adapter_templates[
             best_adapter_template_index]
+        compiled_layout = compiled_kit.get(best_adapter_template)
 
         # Detect barcode
         barcode_set_index = 0
@@ -71,64 +76,81 @@ class BarcodeScannerEPI2ME(BarcodeScanner):
         # for low quality compare full adapter to the barcodes
         # Do not scan full adapter if it contains double barcoding
         # best_adapter_score > 90.0 or
+        compiled_set = compiled_layout.barcode_sets[barcode_set_index]
+        band = None
         if best_adapter_score > 90.0 or best_adapter_template.is_double_barcode():
-            barcode_region_read = extract_barcode_region(
+            start, end, barcode_start = locate_barcode_region(
                 read_sequence=read_sequence,
                 adapter_template=best_adapter_template,
                 barcode_set_index=barcode_set_index,
                 alignment_stop_ref=aligned_adapter_end,
-                qcat_config=qcat_config)
+                qcat_config=qcat_config,
+                compiled_layout=compiled_layout)
+            barcode_region_read = read_sequence[start:end + 1]
+            band = get_barcode_band(barcode_start,
+                                    compiled_set.upstream_context,
+                                    qcat_config)
         else:
             barcode_region_read = read_sequence[:qcat_config.max_align_length]
 
         # First barcode
-        up_context = best_adapter_template.get_upstream_context(
-            qcat_config.barcode_context_length, barcode_set_index)
-        down_context = best_adapter_template.get_downstream_context(
-            qcat_config.barcode_context_length, barcode_set_index)
-        barcode_set = best_adapter_template.get_barcode_set(
-            barcode_set_index)
+        barcode_set = compiled_set.barcodes
+        barcode_index = compiled_set.index
+        targets = compiled_set.targets
         if self.barcodes:
             barcode_set = self.barcodes
+            barcode_index = None
+            targets = None
 
         # Find best barcode
         best_barcode, best_barcode_q_score, best_barcode_score, barcode_end = \
             find_highest_scoring_barcode(
                 barcode_region_read=barcode_region_read,
                 barcode_set=barcode_set,
-                upstream_context=up_context,
-                downstream_context=down_context,
-                qcat_config=qcat_config)
+                upstream_context=compiled_set.upstream_context,
+                downstream_context=compiled_set.downstream_context,
+                qcat_config=qcat_config,
+                barcode_index=barcode_index,
+                targets=targets,
+                band=band)
 
         # If double barcode adapter
         barcode_set_index = 1
-        if best_adapter_template.get_barcode_set(barcode_set_index):
+        if compiled_layout.barcode_sets[barcode_set_index].barcodes:
 
-            barcode_region_read = extract_barcode_region(
+            compiled_set = compiled_layout.barcode_sets[barcode_set_index]
+            start, end, barcode_start = locate_barcode_region(
                 read_sequence=read_sequence,
                 adapter_template=best_adapter_template,
                 barcode_set_index=barcode_set_index,
                 alignment_stop_ref=aligned_adapter_end,
-                qcat_config=qcat_config)
-
-            # First barcode
-            up_context = best_adapter_template.get_upstream_context(
-                qcat_config.barcode_context_length, barcode_set_index)
-            down_context = best_adapter_template.get_downstream_context(
-                qcat_config.barcode_context_length, barcode_set_index)
-            barcode_set = best_adapter_template.get_barcode_set(
-                barcode_set_index)
+                qcat_config=qcat_config,
+                compiled_layout=compiled_layout)
+            barcode_region_read = read_sequence[start:end + 1]
+            band = get_barcode_band(barcode_start,
+                                    compiled_set.upstream_context,
+                                    qcat_config)
+
+            # Second barcode
+            barcode_set = compiled_set.barcodes
+            barcode_index = compiled_set.index
+            targets = compiled_set.targets
             if self.barcodes:
                 barcode_set = self.barcodes
+                barcode_index = None
+                targets = None
 
             # Find best barcode
             best_barcode_2, best_barcode_q_score_2, best_barcode_score_2, barcode_end_2 = \
                 find_highest_scoring_barcode(
                     barcode_region_read=barcode_region_read,
                     barcode_set=barcode_set,
-                    upstream_context=up_context,
-                    downstream_context=down_context,
-                    qcat_config=qcat_config)
+                    upstream_context=compiled_set.upstream_context,
+                    downstream_context=compiled_set.downstream_context,
+                    qcat_config=qcat_config,
+                    barcode_index=barcode_index,
+                    targets=targets,
+                    band=band)
         else:
             logging.debug("Adapter type does not have second barcode")
 
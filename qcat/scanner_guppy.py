@@ -113,7 +113,8 @@ class BarcodeScannerGuppy(BarcodeScanner):
     def detect_barcode(self,
                        read_sequence,
                        read_qualities=None,
-                       qcat_config=config.qcatConfig()):
+                       qcat_config=config.qcatConfig(),
+                       kit_name=None):
 
         guppy_result = self.barcoder.detect_barcode(("", read_sequence))[0]
 
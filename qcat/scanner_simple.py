@@ -1,8 +1,9 @@
-import logging
 import os
 
 from qcat import config
 from qcat.adapters import get_barcodes_simple, get_barcodes_from_fastq
+from qcat.layout import compile_barcode_set
+from qcat.qgram import BarcodeQgramIndex
 from qcat.scanner_base import BarcodeScanner, find_highest_scoring_barcode, \
     build_return_dict, empty_return_dict
 
@@ -14,11 +15,6 @@ class BarcodeScannerSimple(BarcodeScanner):
         if min_quality is None:
             min_quality = 60
 
-        if threads != 1:
-            logging.warning("Multi threading is not yet supported in "
-                            "simple mode. Falling back to using a "
-                            "single thread.")
-
         super(BarcodeScannerSimple, self).__init__(min_quality,
                                                    None,
                                                    kit_folder=kit_folder,
@@ -29,6 +25,9 @@ class BarcodeScannerSimple(BarcodeScanner):
             self.barcodes = get_barcodes_from_fastq(kit)
         else:
             self.barcodes = get_barcodes_simple(kit)
+        self.barcode_index = BarcodeQgramIndex(self.barcodes)
+        self.compiled_barcodes = compile_barcode_set(self.barcodes,
+                                                     self.barcode_index)
 
     @staticmethod
     def get_name():
@@ -45,7 +44,8 @@ class BarcodeScannerSimple(BarcodeScanner):
              read_qualities,
              bc_adapter_templates,
              nobc_adapter_templates,
-             qcat_config=config.qcatConfig()):
+             qcat_config=config.qcatConfig(),
+             adapter_alignments=None):
         """
             Aligns all passed barcodes to the read sequence and chooses the one
             with the highest alignment score. Simplest version of barcode detection
@@ -61,6 +61,7 @@ class BarcodeScannerSimple(BarcodeScanner):
             :type barcode_set: List
             :param qcat_config: qcatConfig object
             :type qcat_config: qcatConfig
+            :param adapter_alignments: Not used, adapters are not aligned
             :return: see build_return_dict
             :rtype: Dictionary
             """
@@ -71,7 +72,9 @@ class BarcodeScannerSimple(BarcodeScanner):
             find_highest_scoring_barcode(barcode_region_read=read_sequence,
                                          barcode_set=self.barcodes,
                                          qcat_config=qcat_config,
-                                         compute_identity=True)
+                                         compute_identity=True,
+                                         barcode_index=self.barcode_index,
+                                         targets=self.compiled_barcodes.targets)
 
         # barcode_err_probe = 0.0
         # if best_barcode:
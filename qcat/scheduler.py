@@ -0,0 +1,217 @@
+"""
+Cost-based scheduling of barcode detection work.
+
+The time needed to process a read depends on its length and on the
+demultiplexing options: adapter and barcode detection only look at both
+ends of a read (qcatConfig.max_align_length bp each), but with
+--detect-middle the adapters are also aligned to the full read, forward and
+reverse. A single ultra-long read can then cost as much as thousands of
+normal reads.
+
+Instead of splitting a batch into slices with the same number of reads,
+reads are packed into work units with roughly the same estimated cost.
+Units are handed out longest first from a shared queue (each idle worker
+takes the next unit), so no worker sits idle while another is still busy
+with an expensive unit.
+
+The number of reads per batch can be adapted in the same spirit (see
+BatchSizer): batches are sized from the time and memory that recent
+batches needed per read, so that batches of ultra-long reads stay within a
+memory ceiling and batches of short amplicons are not needlessly small.
+"""
+import collections
+import logging
+import threading
+
+# Fixed cost per read (in aligned bp) for the work done outside of the
+# alignments
+READ_OVERHEAD = 50
+
+# Number of reads per batch if batches are not sized adaptively
+DEFAULT_BATCH_SIZE = 4000
+# Batch size that selects adaptive batch sizes (see BatchSizer)
+BATCH_SIZE_AUTO = "auto"
+# Limits of adaptive batch sizes. Kit detection (BarcodeScanner.detect_kit)
+# uses the reads of a single batch, so batches are never made smaller than
+# MIN_BATCH_SIZE reads, even if that exceeds the memory ceiling
+MIN_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 100000
+# Target time per batch (seconds) and memory ceiling for the reads of a
+# batch (bytes)
+DEFAULT_BATCH_SECONDS = 10.0
+DEFAULT_BATCH_MEMORY = 256 * 1024 * 1024
+# Number of recent batches the time and memory per read are averaged over
+RECENT_BATCHES = 4
+# Maximum factor between the sizes of two successive batches
+MAX_BATCH_SIZE_CHANGE = 2.0
+
+
+def estimate_read_cost(read_length, window_length, scan_middle):
+    """
+    Estimates the cost of barcode detection for a single read
+
+    :param read_length: Length of the read
+    :param window_length: Number of bp scanned at each end of the read
+    (qcatConfig.max_align_length). 0 for full reads
+    :param scan_middle: Adapters are also aligned to the middle of the read
+    (forward and reverse complement)
+    :return: Estimated cost (in aligned bp)
+    :rtype: int
+    """
+    if window_length <= 0:
+        ends = 2 * read_length
+        middle = 0
+    else:
+        ends = 2 * min(read_length, window_length)
+        middle = max(0, read_length - 2 * window_length)
+
+    cost = READ_OVERHEAD + ends
+    if scan_middle:
+        cost += 2 * middle
+    return cost
+
+
+def pack_by_cost(costs, n_units):
+    """
+    Splits reads into contiguous work units with roughly equal cost. A read
+    that costs more than the target is placed in a unit of its own.
+
+    :param costs: Estimated cost of each read
+    :type costs: List
+    :param n_units: Target number of units
+    :type n_units: int
+    :return: List of start, stop, cost tuples
+    :rtype: List
+    """
+    total = sum(costs)
+    if not costs:
+        return []
+    target = total / float(max(1, n_units))
+
+    units = []
+    start = 0
+    unit_cost = 0
+    for i, cost in enumerate(costs):
+        if i > start and unit_cost + cost > target:
+            units.append((start, i, unit_cost))
+            start = i
+            unit_cost = 0
+        unit_cost += cost
+    units.append((start, len(costs), unit_cost))
+    return units
+
+
+def _run_indexed(args):
+    """
+    Runs a single work unit and returns its index with the result
+
+    :param args: function, index, task
+    :return: index, result
+    """
+    func, index, task = args
+    return index, func(task)
+
+
+def run_units(pool, func, tasks, costs):
+    """
+    Runs func for all tasks on a multiprocessing pool. Tasks are submitted in
+    order of decreasing cost and handed out one at a time, so that idle
+    workers always pick up the next unit. Results are returned in task order.
+
+    :param pool: multiprocessing.Pool or multiprocessing.pool.ThreadPool
+    :param func: Function to run. Has to be picklable for process pools
+    :param tasks: List of task arguments
+    :param costs: Estimated cost of each task
+    :return: List of results
+    """
+    order = sorted(range(len(tasks)), key=lambda i: -costs[i])
+    results = [None] * len(tasks)
+    for index, result in pool.imap_unordered(
+            _run_indexed, [(func, i, tasks[i]) for i in order], chunksize=1):
+        results[index] = result
+    return results
+
+
+class BatchSizer(object):
+    """
+    Chooses the number of reads per batch from the time and memory per read
+    measured on recent batches. Passed to cli.iter_fastx instead of a fixed
+    batch size. Can be shared by the reader and several detection threads.
+    """
+
+    def __init__(self, target_seconds=DEFAULT_BATCH_SECONDS,
+                 max_bytes=DEFAULT_BATCH_MEMORY, min_size=MIN_BATCH_SIZE,
+                 max_size=MAX_BATCH_SIZE, initial_size=DEFAULT_BATCH_SIZE):
+        """
+        Init
+
+        :param target_seconds: Target time for processing a batch
+        :param max_bytes: Memory ceiling for the reads of a batch (see
+        cli.get_batch_bytes)
+        :param min_size: Minimum number of reads per batch
+        :param max_size: Maximum number of reads per batch
+        :param initial_size: Number of reads of the first batches
+        """
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.max_size = max_size
+        self.batch_size = max(min_size, min(max_size, initial_size))
+
+        self.lock = threading.Lock()
+        # Number of reads, bytes and seconds of recent batches
+        self.recent = collections.deque(maxlen=RECENT_BATCHES)
+
+    def get_limits(self):
+        """
+        Limits for the next batch. A batch ends once it holds max_reads
+        reads, or once its reads take max_bytes and it holds at least
+        min_reads reads
+
+        :return: max_reads, max_bytes, min_reads
+        :rtype: int, int, int
+        """
+        with self.lock:
+            return self.batch_size, self.max_bytes, self.min_size
+
+    def add_batch(self, n_reads, n_bytes, seconds):
+        """
+        Records a processed batch and updates the batch size
+
+        :param n_reads: Number of reads of the batch
+        :param n_bytes: Size of the reads in bytes
+        :param seconds: Time needed for barcode detection
+        :return: New batch size
+        :rtype: int
+        """
+        if n_reads <= 0:
+            return self.batch_size
+
+        with self.lock:
+            self.recent.append((n_reads, n_bytes, seconds))
+            reads = sum(batch[0] for batch in self.recent)
+            seconds_per_read = sum(batch[2] for batch in self.recent) / reads
+            # Memory is limited by the batch with the longest reads
+            bytes_per_read = max(batch[1] / float(batch[0])
+                                 for batch in self.recent)
+
+            size = self.max_size
+            if seconds_per_read > 0.0:
+                size = self.target_seconds / seconds_per_read
+            # Timings of single batches are noisy, so the batch size only
+            # follows them gradually. The memory ceiling applies at once
+            size = min(size, self.batch_size * MAX_BATCH_SIZE_CHANGE)
+            size = max(size, self.batch_size / MAX_BATCH_SIZE_CHANGE)
+            if bytes_per_read > 0.0:
+                size = min(size, self.max_bytes / bytes_per_read)
+            size = int(max(self.min_size, min(self.max_size, size)))
+
+            logging.debug("Batch of {} reads ({:.1f} MB) took {:.2f}s. "
+                          "{:.2f} ms and up to {:.0f} bytes per read over "
+                          "the last {} batches, next batches: {} "
+                          "reads".format(
+                              n_reads, n_bytes / 1e6, seconds,
+                              seconds_per_read * 1e3, bytes_per_read,
+                              len(self.recent), size))
+            self.batch_size = size
+            return size
@@ -0,0 +1,150 @@
+"""
+On-disk spill of barcode results for run-wide barcode filtering.
+
+With --filter-barcodes, rare barcodes are removed by comparing the number
+of reads of each barcode to the most abundant barcode
+(BarcodeScanner.filter_barcodes). Per batch, the outcome depends on where
+the batch boundaries fall. With --filter-scope run, the input is processed
+twice instead: the first pass writes the result of each read to a
+SpillFile and counts the barcodes of the whole run. The second pass reads
+the input again together with the spilled results and filters them with the
+run-wide barcode counts.
+
+Each read takes one fixed-size record (see RECORD_FORMAT). The record of
+the read at offset i is stored at i * RECORD_SIZE, so batches can be
+spilled in any order. Adapters and barcodes are stored as indices into
+tables of the distinct adapters and barcodes seen so far. Memory use is
+bounded by these tables and the barcode counts, not by the number of
+reads.
+"""
+import struct
+import tempfile
+
+from qcat.scanner_base import BarcodeScanner, build_return_dict
+
+# Scope of --filter-barcodes: each batch or the whole run
+FILTER_SCOPE_BATCH = "batch"
+FILTER_SCOPE_RUN = "run"
+FILTER_SCOPES = [FILTER_SCOPE_BATCH, FILTER_SCOPE_RUN]
+
+# Read offset, barcode index, barcode score, adapter index, adapter end,
+# trim5p, trim3p, exit status. Indices are -1 for None
+RECORD_FORMAT = "<qidiiiii"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+
+class SpillFile(object):
+    """
+    Temporary file holding the barcode result of every read of a run
+    """
+
+    def __init__(self, folder=None):
+        """
+        Init
+
+        :param folder: Folder for the temporary file (default: system
+        temporary folder)
+        """
+        self.file = tempfile.TemporaryFile(dir=folder)
+        self.n_reads = 0
+
+        # Distinct adapters and barcodes of all spilled results
+        self.adapters = []
+        self.adapter_index = {}
+        self.barcodes = []
+        self.barcode_index = {}
+
+        # Reads per barcode id (see BarcodeScanner.update_barcode_count)
+        self.barcode_count = {}
+
+    @staticmethod
+    def get_index(value, values, index):
+        """
+        Index of value in the table values, value is added if missing
+
+        :param value: AdapterLayout or Barcode, None
+        :param values: Table of distinct values
+        :param index: Maps the key of each value to its index in values
+        :return: Index, -1 for None
+        :rtype: int
+        """
+        if value is None:
+            return -1
+        # AdapterLayouts are compared by identity (see
+        # parallel.pack_result), Barcodes by value
+        key = value if isinstance(value, tuple) else id(value)
+        if key not in index:
+            index[key] = len(values)
+            values.append(value)
+        return index[key]
+
+    def write(self, offset, results):
+        """
+        Spills the results of a batch
+
+        :param offset: Offset of the first read of the batch in the run
+        :param results: List of barcode result dicts
+        :return: None
+        """
+        records = []
+        for i, result in enumerate(results):
+            BarcodeScanner.update_barcode_count(result, self.barcode_count)
+            records.append(struct.pack(
+                RECORD_FORMAT,
+                offset + i,
+                self.get_index(result['barcode'], self.barcodes,
+                               self.barcode_index),
+                result['barcode_score'],
+                self.get_index(result['adapter'], self.adapters,
+                               self.adapter_index),
+                result['adapter_end'],
+                result['trim5p'],
+                result['trim3p'],
+                result['exit_status']))
+
+        self.file.seek(offset * RECORD_SIZE)
+        self.file.write(b"".join(records))
+        self.n_reads = max(self.n_reads, offset + len(results))
+
+    def iter_results(self, batch_size=4000):
+        """
+        Reads all spilled results in read order
+
+        :param batch_size: Number of records read at once
+        :return: Generator of barcode result dicts
+        """
+        self.file.flush()
+        self.file.seek(0)
+        offset = 0
+        while offset < self.n_reads:
+            n = min(batch_size, self.n_reads - offset)
+            data = self.file.read(n * RECORD_SIZE)
+            if len(data) != n * RECORD_SIZE:
+                raise IOError("Spill file is truncated at read {}".format(
+                    offset + len(data) // RECORD_SIZE))
+            for i in range(n):
+                read_offset, barcode, barcode_score, adapter, adapter_end, \
+                    trim5p, trim3p, exit_status = \
+                    struct.unpack_from(RECORD_FORMAT, data, i * RECORD_SIZE)
+                if read_offset != offset:
+                    raise IOError("No result spilled for read {}".format(
+                        offset))
+                yield build_return_dict(
+                    best_barcode=self.barcodes[barcode]
+                    if barcode >= 0 else None,
+                    best_barcode_score=barcode_score,
+                    best_adapter=self.adapters[adapter]
+                    if adapter >= 0 else None,
+                    best_adapter_end=adapter_end,
+                    exit_status=exit_status,
+                    trim5p=trim5p,
+                    trim3p=trim3p)
+                offset += 1
+
+    def close(self):
+        """
+        Deletes the temporary file
+
+        :return: None
+        """
+        self.file.close()
@@ -1,12 +1,27 @@
 from __future__ import print_function
 
+import os
+import random
+
+import pytest
+
 from qcat import scanner, adapters
+from qcat import align
 from qcat import utils
 from qcat import cli
 from qcat import config
+from qcat import kit_detection
+from qcat import merge
+from qcat import parallel
+from qcat import pipeline
+from qcat import scheduler
+from qcat import transport
+from qcat import scanner_base
+from qcat import spill
 # from qcat import calibration
 from qcat.scanner import get_adapter_by_name
-from qcat.scanner_base import find_best_adapter_template, extract_align_sequence
+from qcat.scanner_base import find_best_adapter_template, extract_align_sequence, \
+    find_highest_scoring_barcode, BarcodeScanner
 from qcat.scanner_epi2me import BarcodeScannerEPI2ME
 
 barcode_spacer = "NNNNNNNNNNNNNNNNNNNNNNNN"
@@ -700,3 +715,990 @@ def test_trimming():
 
     assert fp <= 0.2 # 2.0
 
+
+
+def _read_test_batch():
+    seqs = []
+    quals = []
+    for path in ["qcat/test/data/nbd103.fastq", "qcat/test/data/pbk004.fastq",
+                 "qcat/test/data/rab204.fastq", "qcat/test/data/rbk004.fastq"]:
+        for names, comments, s, q in cli.iter_fastx(path, True, 4000):
+            seqs += s
+            quals += q
+    return seqs, quals
+
+
+def _result_summary(results):
+    summary = []
+    for result in results:
+        summary.append((result['barcode'],
+                        result['barcode_score'],
+                        result['adapter'].kit if result['adapter'] else None,
+                        result['adapter_end'],
+                        result['trim5p'],
+                        result['trim3p'],
+                        result['exit_status']))
+    return summary
+
+
+@pytest.mark.parametrize("backend", parallel.BACKENDS)
+def test_detect_barcode_batch_multiprocessing(backend):
+    seqs, quals = _read_test_batch()
+
+    for filter_barcodes, middle in [(False, False), (True, False), (False, True)]:
+        single = scanner.factory(enable_filter_barcodes=filter_barcodes,
+                                 scan_middle_adapter=middle)
+        multi = scanner.factory(enable_filter_barcodes=filter_barcodes,
+                                scan_middle_adapter=middle,
+                                threads=2,
+                                parallel_backend=backend)
+        try:
+            expected = single.detect_barcode_batch(seqs, quals)
+            results = multi.detect_barcode_batch(seqs, quals)
+            multi.batch_executor.split_batches = False
+            unsplit_results = multi.detect_barcode_batch(seqs, quals)
+        finally:
+            multi.close()
+
+        assert len(results) == len(seqs)
+        assert _result_summary(results) == _result_summary(expected)
+        assert _result_summary(unsplit_results) == _result_summary(expected)
+
+
+def test_detect_barcode_concurrent_ends():
+    seqs, quals = _read_test_batch()
+
+    for kit, middle in [(None, False), (None, True), ("NBD103/NBD104", True)]:
+        sequential = scanner.factory(kit=kit, scan_middle_adapter=middle)
+        concurrent = scanner.factory(kit=kit, scan_middle_adapter=middle,
+                                     concurrent_ends=True)
+        try:
+            assert concurrent.end_pool
+            expected = [sequential.detect_barcode(seq) for seq in seqs]
+            results = [concurrent.detect_barcode(seq) for seq in seqs]
+        finally:
+            concurrent.close()
+
+        assert _result_summary(results) == _result_summary(expected)
+
+
+def test_align_backend_profile():
+    seqs, quals = _read_test_batch()
+    dual_seqs = _dual_reads()
+
+    qcat_config = config.get_default_config()
+    profile_config = config.get_default_config()
+    profile_config.align_backend = scanner_base.ALIGN_BACKEND_PROFILE
+
+    for mode, reads in [("epi2me", seqs), ("dual", dual_seqs)]:
+        detector = scanner.factory(mode=mode, scan_middle_adapter=True)
+        expected = [detector.detect_barcode(seq, qcat_config=qcat_config)
+                    for seq in reads]
+        results = [detector.detect_barcode(seq, qcat_config=profile_config)
+                   for seq in reads]
+        assert _result_summary(results) == _result_summary(expected)
+
+
+def test_align_precision_auto():
+    seqs, quals = _read_test_batch()
+
+    qcat_config = config.get_default_config()
+    auto_config = config.get_default_config()
+    auto_config.align_precision = scanner_base.ALIGN_PRECISION_AUTO
+
+    assert scanner_base.get_alignment_width(150, 80, qcat_config.matrix,
+                                            qcat_config) == 32
+    assert scanner_base.get_alignment_width(150, 80, auto_config.matrix,
+                                            auto_config) == 16
+    assert scanner_base.get_alignment_width(
+        40, 46, auto_config.matrix_barcode, auto_config) == 8
+
+    # Saturates with 8 bit scores
+    before = scanner_base.get_precision_stats()
+    for profile in [False, True]:
+        read, target = "A" * 126, "C" * 126
+        if profile:
+            result = scanner_base.ReadProfile(read, auto_config.matrix_barcode,
+                                              auto_config).align(target, 1, 1)
+        else:
+            result = scanner_base.align_sg(read, target, 1, 1,
+                                           auto_config.matrix_barcode,
+                                           auto_config)
+        expected = scanner_base.align_sg(read, target, 1, 1,
+                                         qcat_config.matrix_barcode,
+                                         qcat_config)
+        assert not result.saturated
+        assert result.score == expected.score
+    after = scanner_base.get_precision_stats()
+    assert after["fallback"] - before["fallback"] == 2
+    assert after["narrow"] - before["narrow"] == 2
+
+    detector = scanner.factory()
+    expected = [detector.detect_barcode(seq, qcat_config=qcat_config)
+                for seq in seqs]
+    results = [detector.detect_barcode(seq, qcat_config=auto_config)
+               for seq in seqs]
+    assert [r['barcode'] for r in results] == \
+        [r['barcode'] for r in expected]
+
+    # Alignments of worker processes are counted in the calling process
+    detector = scanner.factory(threads=2,
+                               parallel_backend=parallel.PROCESS)
+    try:
+        for split_batches in [True, False]:
+            detector.batch_executor.split_batches = split_batches
+            before = align.get_precision_stats()
+            detector.detect_barcode_batch(seqs, [None] * len(seqs),
+                                          auto_config)
+            assert align.get_precision_delta(before)["narrow"] > 0
+    finally:
+        detector.close()
+
+
+def test_config_pickle():
+    import pickle
+
+    qcat_config = config.get_default_config()
+    copy = pickle.loads(pickle.dumps(qcat_config))
+    # Unpickled configs share the scoring matrices of the process
+    assert copy.matrix is qcat_config.matrix
+    assert copy.matrix_barcode is qcat_config.matrix_barcode
+
+    qcat_config.mismatch = 3
+    copy = pickle.loads(pickle.dumps(qcat_config))
+    assert copy.matrix is qcat_config.matrix
+    assert copy.matrix is not config.get_default_config().matrix
+    assert copy.matrix.matrix[0][1] == -3
+
+
+def test_matrix_caches():
+    import pickle
+    from qcat import vectorized
+
+    layout = get_adapter_by_name("NBD104/NBD114")[0]
+    barcode_set = layout.get_barcode_set(0)
+    region = "GTT" + barcode_set[3].sequence + "CAGC"
+
+    # Worker processes unpickle a new config for every task. The caches
+    # must not grow with every copy of the scoring matrices
+    qcat_config = config.get_default_config()
+    sizes = None
+    for _ in range(5):
+        qcat_config = pickle.loads(pickle.dumps(qcat_config))
+        vectorized.score_barcodes(region, barcode_set,
+                                  qcat_config.matrix_barcode, "GTT", "CAGC")
+        vectorized.align_target(region, "GTTAACCTTAGCAAT",
+                                qcat_config.matrix, 2, 2)
+        scanner_base.get_score_bound(region, "ACGTN",
+                                     qcat_config.matrix_barcode)
+        current = (len(vectorized._barcode_sets), len(vectorized._targets),
+                   len(scanner_base._score_bounds))
+        assert sizes is None or current == sizes
+        sizes = current
+
+    # Matrices that were not created by config.get_matrix are keyed by
+    # their scores
+    import parasail
+    for _ in range(3):
+        matrix = parasail.matrix_create("ATGCN", 1, -1)
+        vectorized.align_target(region, "GTTAACCTTAGCAAT", matrix, 1, 1)
+        scanner_base.get_score_bound(region, "ACGTN", matrix)
+    assert len(vectorized._targets) == sizes[1] + 1
+    assert len(scanner_base._score_bounds) == sizes[2] + 1
+
+
+def test_adapter_prefilter():
+    seqs, quals = _read_test_batch()
+
+    qcat_config = config.get_default_config()
+    prefilter_config = config.get_default_config()
+    prefilter_config.adapter_prefilter = True
+
+    detector = scanner.factory()
+    layouts = detector.layouts
+    assert scanner_base.get_kmers("ACGTNACGTAC", 4) == {"GTAC", "CGTA",
+                                                        "ACGT"}
+
+    # Adapter template without barcode is always selected
+    layout = detector.get_adapter("RBK004")
+    read = layout.get_adapter_sequences(layout.get_barcode_set(0)[0].sequence)
+    candidates = detector.adapter_index.get_candidates(layouts, read)
+    assert layouts.index(layout) in candidates
+    assert len(candidates) < len(layouts)
+    # No shared k-mers: align all templates
+    assert detector.adapter_index.get_candidates(layouts, "A" * 150) is None
+
+    # Same barcode calls as exhaustive search
+    expected = [detector.detect_barcode(seq, qcat_config=qcat_config)
+                for seq in seqs]
+    results = [detector.detect_barcode(seq, qcat_config=prefilter_config)
+               for seq in seqs]
+    assert [(r['barcode'], r['barcode_score']) for r in results] == \
+        [(r['barcode'], r['barcode_score']) for r in expected]
+
+
+def test_barcode_prefilter():
+    seqs, quals = _read_test_batch()
+
+    qcat_config = config.get_default_config()
+    prefilter_config = config.get_default_config()
+    prefilter_config.barcode_prefilter = True
+
+    layout = get_adapter_by_name("PBC096")[0]
+    barcode_set = layout.get_barcode_set(0)
+    barcode_index = layout.get_barcode_index(0)
+    assert barcode_index.size == len(barcode_set)
+    assert layout.get_barcode_index(1) is None
+
+    barcode = barcode_set[42]
+    candidates = barcode_index.get_candidates("ACGT" + barcode.sequence +
+                                              "TTGCA")
+    assert 42 in candidates
+    assert len(candidates) < len(barcode_set)
+
+    # barcode06 with 8 edits scores best, but is not among the candidates:
+    # the bounds of the other barcodes force a full scan
+    noisy_region = "ACGTTTGCTCGTAAAGCATAAATAGTCTTGCA"
+    assert 5 not in barcode_index.get_candidates(noisy_region)
+    assert find_highest_scoring_barcode(noisy_region, barcode_set,
+                                        qcat_config)[0] == barcode_set[5]
+
+    rnd = random.Random(1)
+    for region in ["ACGT" + barcode.sequence + "TTGCA", noisy_region,
+                   "".join(rnd.choice("ACGT") for _ in range(46))]:
+        expected = find_highest_scoring_barcode(region, barcode_set,
+                                                qcat_config)
+        result = find_highest_scoring_barcode(region, barcode_set,
+                                              prefilter_config,
+                                              barcode_index=barcode_index)
+        assert result == expected
+
+    for mode, reads in [("epi2me", seqs), ("dual", _dual_reads())]:
+        detector = scanner.factory(mode=mode)
+        expected = [detector.detect_barcode(seq, qcat_config=qcat_config)
+                    for seq in reads]
+        results = [detector.detect_barcode(seq, qcat_config=prefilter_config)
+                   for seq in reads]
+        assert _result_summary(results) == _result_summary(expected)
+
+
+def test_myers_barcode_backend():
+    from qcat import myers
+
+    def edit_distance(pattern, text):
+        previous = list(range(len(pattern) + 1))
+        best = (len(pattern), -1)
+        for j, base in enumerate(text):
+            current = [0]
+            for i in range(1, len(pattern) + 1):
+                current.append(min(previous[i - 1] + (pattern[i - 1] != base),
+                                   previous[i] + 1,
+                                   current[i - 1] + 1))
+            if current[-1] < best[0]:
+                best = (current[-1], j)
+            previous = current
+        return best
+
+    layout = get_adapter_by_name("NBD104/NBD114")[0]
+    barcode_set = layout.get_barcode_set(0)
+    rnd = random.Random(2)
+    for barcode in barcode_set:
+        region = "".join(rnd.choice("ACGT") for _ in range(10))
+        region += "GTT" + barcode.sequence[:10] + "A" + \
+            barcode.sequence[11:20] + "CAGC"
+        myers_set = myers.get_barcode_set(barcode_set, "GTT", "CAGC")
+        assert myers_set is myers.get_barcode_set(barcode_set, "GTT", "CAGC")
+        assert myers_set.distances(region) == \
+            [edit_distance("GTT" + b.sequence + "CAGC", region)
+             for b in barcode_set]
+
+    seqs, quals = _read_test_batch()
+    qcat_config = config.get_default_config()
+    myers_config = config.get_default_config()
+    myers_config.barcode_backend = scanner_base.BARCODE_BACKEND_MYERS
+    detector = scanner.factory()
+    expected = [detector.detect_barcode(seq, qcat_config=qcat_config)
+                for seq in seqs]
+    results = [detector.detect_barcode(seq, qcat_config=myers_config)
+               for seq in seqs]
+    # On the test reads, lower scores only drop calls below the minimum
+    # score
+    assert sum(1 for r in results if r['barcode']) >= 0.9 * \
+        sum(1 for r in expected if r['barcode'])
+    for result, exp in zip(results, expected):
+        if result['barcode']:
+            assert result['barcode'] == exp['barcode']
+            # Edit distance score is never higher than the alignment score
+            assert result['barcode_score'] <= exp['barcode_score'] + 1e-9
+
+
+def test_numpy_barcode_backend():
+    import parasail
+    from qcat import vectorized
+
+    qcat_config = config.get_default_config()
+    matrix = qcat_config.matrix_barcode
+    layout = get_adapter_by_name("NBD104/NBD114")[0]
+    barcode_set = layout.get_barcode_set(0)
+    rnd = random.Random(3)
+    regions = [""]
+    for barcode in barcode_set:
+        sequence = "GTT" + barcode.sequence + "CAGC"
+        sequence = "".join(base if rnd.random() > 0.1 else rnd.choice("ACGTN")
+                           for base in sequence)
+        cut = rnd.randint(0, 12)
+        regions.append("".join(rnd.choice("ACGT") for _ in range(cut)) +
+                       sequence[rnd.randint(0, 6):] +
+                       "".join(rnd.choice("ACGT") for _ in range(12 - cut)))
+    regions.append("A")
+
+    # qcat uses open=1/extend=1, open=2 checks affine gap costs
+    for gap_open in [1, 2]:
+        results = vectorized.score_barcodes_batch(regions, barcode_set,
+                                                  matrix, "GTT", "CAGC",
+                                                  gap_open, 1)
+        assert results[0] is None
+        for region, scores in zip(regions[1:], results[1:]):
+            assert scores == vectorized.score_barcodes(
+                region, barcode_set, matrix, "GTT", "CAGC", gap_open, 1)
+            for barcode, (score, identity, end) in zip(barcode_set, scores):
+                target = "GTT" + barcode.sequence + "CAGC"
+                # Reference (non-vectorized) parasail implementation
+                expected = parasail.sg(region, target, gap_open, 1, matrix)
+                assert score == expected.score * 100.0 / len(target)
+                assert end == expected.end_query
+
+    seqs = _dual_reads()
+    quals = [None] * len(seqs)
+    numpy_config = config.get_default_config()
+    numpy_config.barcode_backend = scanner_base.BARCODE_BACKEND_NUMPY
+    detector = scanner.factory(mode="dual")
+    expected = detector.detect_barcode_batch(seqs, quals, qcat_config)
+    results = detector.detect_barcode_batch(seqs, quals, numpy_config)
+    assert _result_summary(results) == _result_summary(expected)
+
+    detector = scanner.factory()
+    seqs = seqs[:10]
+    expected = [detector.detect_barcode(seq, qcat_config=qcat_config)
+                for seq in seqs]
+    results = [detector.detect_barcode(seq, qcat_config=numpy_config)
+               for seq in seqs]
+    assert _result_summary(results) == _result_summary(expected)
+
+
+def test_banded_barcodes():
+    from qcat import vectorized
+
+    qcat_config = config.get_default_config()
+    matrix = qcat_config.matrix_barcode
+    layout = get_adapter_by_name("NBD104/NBD114")[0]
+    barcode_set = layout.get_barcode_set(0)
+    rnd = random.Random(5)
+    regions = []
+    offsets = []
+    for barcode in barcode_set:
+        shift = rnd.randint(0, 8)
+        regions.append("".join(rnd.choice("ACGT") for _ in range(shift)) +
+                       "GTT" + barcode.sequence + "CAGC" +
+                       "".join(rnd.choice("ACGT") for _ in range(8 - shift)))
+        offsets.append(4)
+
+    full = vectorized.score_barcodes_batch(regions, barcode_set, matrix,
+                                           "GTT", "CAGC")
+    for width in [4, 1]:
+        banded = vectorized.score_barcodes_batch(regions, barcode_set,
+                                                 matrix, "GTT", "CAGC", 1, 1,
+                                                 offsets, width)
+        for i, (scores, expected) in enumerate(zip(banded, full)):
+            # Band scores can only be lower
+            assert all(score[0] <= best[0]
+                       for score, best in zip(scores, expected))
+            # Same score if the barcode lies within the band
+            shift = regions[i].index("GTT" + barcode_set[i].sequence) - 4
+            if abs(shift) <= width:
+                assert scores[i] == expected[i]
+            else:
+                assert scores[i][0] < expected[i][0]
+
+    start, end, barcode_start = scanner_base.locate_barcode_region(
+        "A" * 200, layout, 0, 120, qcat_config)
+    assert barcode_start == qcat_config.extracted_barcode_extension
+    assert scanner_base.get_barcode_band(barcode_start, "GTT",
+                                         qcat_config) is None
+
+    seqs = _dual_reads()
+    quals = [None] * len(seqs)
+    numpy_config = config.get_default_config()
+    numpy_config.barcode_backend = scanner_base.BARCODE_BACKEND_NUMPY
+    banded_config = config.get_default_config()
+    banded_config.barcode_backend = scanner_base.BARCODE_BACKEND_NUMPY
+    banded_config.banded_barcodes = True
+    assert scanner_base.get_barcode_band(11, "GTT", banded_config) == (8, 11)
+    detector = scanner.factory(mode="dual")
+    expected = detector.detect_barcode_batch(seqs, quals, numpy_config)
+    results = detector.detect_barcode_batch(seqs, quals, banded_config)
+    assert _result_summary(results) == _result_summary(expected)
+
+
+def test_early_termination():
+    from qcat.qgram import BarcodeQgramIndex
+
+    qcat_config = config.get_default_config()
+    early_config = config.get_default_config()
+    early_config.early_termination = True
+
+    # Score bounds hold for barcodes with and without errors
+    layout = get_adapter_by_name("PBC096")[0]
+    barcode_set = layout.get_barcode_set(0)
+    barcode_index = BarcodeQgramIndex(barcode_set)
+    rnd = random.Random(4)
+    for barcode in barcode_set[:24]:
+        region = "".join(base for base in "GTT" + barcode.sequence + "CAGC"
+                         if rnd.random() > 0.05)
+        region = "ACGTTGCA" + region + "TTGACG"
+        bounds = barcode_index.get_score_bounds(region, "GTT", "CAGC")
+        for b, bound in zip(barcode_set, bounds):
+            score = scanner_base.align_barcode(region, b, "GTT", "CAGC",
+                                               qcat_config)[0]
+            assert score <= bound
+        target = "GTT" + barcode.sequence + "CAGC"
+        assert scanner_base.get_score_bound(
+            target, region, qcat_config.matrix_barcode) == len(target)
+        assert scanner_base.get_score_bound(
+            target, region[:10], qcat_config.matrix_barcode) == 10
+
+    seqs, quals = _read_test_batch()
+    for mode, reads, kit in [("epi2me", seqs, "auto"),
+                             ("simple", seqs, "extended"),
+                             ("dual", _dual_reads(), "auto")]:
+        detector = scanner.factory(mode=mode, kit=kit)
+        expected = [detector.detect_barcode(seq, qcat_config=qcat_config)
+                    for seq in reads]
+        results = [detector.detect_barcode(seq, qcat_config=early_config)
+                   for seq in reads]
+        assert results == expected
+
+
+def test_align_backends():
+    qcat_config = config.get_default_config()
+    assert align.get_backend_names()[:3] == ["parasail", "parasail-profile",
+                                             "numpy"]
+    with pytest.raises(RuntimeError):
+        align.get_backend("unknown")
+
+    # NumPy backend gives the scores of parasail.sg
+    random.seed(3)
+    backend = align.get_backend(align.ALIGN_BACKEND_NUMPY)
+    for matrix, gap_open, gap_extend in [
+            (qcat_config.matrix, qcat_config.gap_open, qcat_config.gap_extend),
+            (qcat_config.matrix_barcode, 1, 1), (qcat_config.matrix, 3, 1)]:
+        for _ in range(50):
+            target = "".join(random.choice("ACGTN") for _ in range(30))
+            read = "".join(random.choice("ACGT") for _ in range(60))
+            read = read[:20] + target.replace("N", "G")[2:] + read[20:]
+            result = backend.align(read, target, gap_open, gap_extend, matrix,
+                                   qcat_config)
+            expected = align.parasail.sg(read, target, gap_open, gap_extend,
+                                         matrix)
+            assert (result.score, result.end_query) == \
+                (expected.score, expected.end_query)
+
+    # Registered backends can be selected
+    class CountingBackend(align.ParasailBackend):
+        name = "counting"
+        calls = 0
+
+        def align(self, *args, **kwargs):
+            CountingBackend.calls += 1
+            return super(CountingBackend, self).align(*args, **kwargs)
+
+    align.register_backend(CountingBackend())
+    try:
+        seqs, quals = _read_test_batch()
+        counting_config = config.get_default_config()
+        counting_config.align_backend = "counting"
+        detector = scanner.factory()
+        for seq in seqs[:10]:
+            assert detector.detect_barcode(seq, qcat_config=counting_config) \
+                == detector.detect_barcode(seq, qcat_config=qcat_config)
+        assert CountingBackend.calls > 0
+    finally:
+        align._backends.pop("counting")
+        align._backend_names.remove("counting")
+
+
+def test_compiled_kit():
+    qcat_config = config.get_default_config()
+    detector = scanner.factory()
+    compiled_kit = detector.get_compiled_kit(qcat_config)
+
+    layout = detector.get_adapter("NBD104/NBD114")
+    compiled = compiled_kit.get(layout)
+    assert compiled.sequence == layout.get_adapter_sequences()
+    assert compiled.adapter_length == layout.get_adapter_length()
+    assert scanner_base.get_norm_socre(layout, 42, qcat_config) == \
+        42 * 100.0 / compiled.norm_denominator
+    barcode_set = compiled.barcode_sets[0]
+    up = layout.get_upstream_context(qcat_config.barcode_context_length)
+    down = layout.get_downstream_context(qcat_config.barcode_context_length)
+    assert barcode_set.upstream_context == up
+    assert barcode_set.targets[0] == \
+        up + layout.get_barcode_set(0)[0].sequence + down
+    assert compiled.barcode_sets[1].targets == ()
+    assert detector.get_adapters("nbd104/nbd114") == \
+        [other for other in detector.layouts
+         if other.kit == "NBD104/NBD114"]
+    assert detector.get_adapters("unknown") == []
+
+    # Recompiled when the context length changes
+    context_config = config.get_default_config()
+    context_config.barcode_context_length = 5
+    compiled = detector.get_compiled_kit(context_config).get(layout)
+    assert len(compiled.barcode_sets[0].upstream_context) == 5
+    assert detector.get_compiled_kit(qcat_config) is not compiled_kit
+
+    # Same results without precompiled layouts
+    seqs, quals = _read_test_batch()
+    for mode, reads in [("epi2me", seqs), ("dual", _dual_reads())]:
+        detector = scanner.factory(mode=mode)
+        expected = [detector.detect_barcode(seq, qcat_config=qcat_config)
+                    for seq in reads]
+        detector.precompile_layouts = False
+        results = [detector.detect_barcode(seq, qcat_config=qcat_config)
+                   for seq in reads]
+        assert results == expected
+
+
+def _dual_reads(n=40):
+    rnd = random.Random(0)
+    layouts = scanner.factory(mode="dual").layouts
+
+    def fill(layout, barcode_1, barcode_2):
+        sequence = layout.get_adapter_sequences()
+        for barcode in [barcode_1, barcode_2]:
+            start = sequence.index("N")
+            sequence = sequence[:start] + barcode.sequence + \
+                       sequence[start + len(barcode.sequence):]
+        return sequence
+
+    def random_sequence(length):
+        return "".join(rnd.choice("ACGT") for _ in range(length))
+
+    reads = []
+    for i in range(n):
+        barcode_1 = rnd.choice(layouts[0].get_barcode_set(0))
+        barcode_2 = rnd.choice(layouts[0].get_barcode_set(1))
+        read = random_sequence(20)
+        if i % 4:
+            read += fill(layouts[0], barcode_1, barcode_2)
+        read += random_sequence(500)
+        if i % 3:
+            read += utils.revcomp(fill(layouts[1], barcode_1, barcode_2))
+        reads.append(read + random_sequence(20))
+    return reads
+
+
+def test_dual_batch():
+    seqs = _dual_reads()
+    quals = [None] * len(seqs)
+
+    single = scanner.factory(mode="dual")
+    expected = [single.detect_barcode(seq) for seq in seqs]
+    assert any(result['barcode'] for result in expected)
+    # Generic per read implementation
+    expected_batch = BarcodeScanner.detect_barcode_batch(single, seqs, quals)
+    assert _result_summary(single.detect_barcode_batch(seqs, quals)) == \
+        _result_summary(expected_batch)
+
+    concurrent = scanner.factory(mode="dual", concurrent_ends=True)
+    try:
+        assert concurrent.set_pool
+        results = [concurrent.detect_barcode(seq) for seq in seqs]
+        batch_results = concurrent.detect_barcode_batch(seqs, quals)
+    finally:
+        concurrent.close()
+
+    assert _result_summary(results) == _result_summary(expected)
+    assert _result_summary(batch_results) == _result_summary(expected_batch)
+
+
+def test_reuse_adapter_alignments():
+    qcat_config = config.get_default_config()
+    seqs, quals = _read_test_batch()
+
+    detector = scanner.factory(mode="epi2me")
+    _, adapter_alignments = detector.detect_kit(seqs, qcat_config)
+    assert len(adapter_alignments) == len(seqs)
+    for alignments in adapter_alignments[0]:
+        assert set(alignments) == set(id(layout) for layout in
+                                      detector.layouts)
+
+    # Templates found in alignments are not aligned again
+    read_sequence = extract_align_sequence(seqs[0], False,
+                                           qcat_config.max_align_length)
+    layouts = detector.layouts
+    alignments = {id(layouts[1]): (42, 200.0)}
+    ret = find_best_adapter_template(layouts, read_sequence, qcat_config,
+                                     alignments=alignments)
+    assert ret == (1, 42, 200.0)
+    assert len(alignments) == len(layouts)
+
+    # Same calls as aligning the adapters of the detected kit again
+    for mode, reads in [("epi2me", seqs), ("dual", _dual_reads())]:
+        detector = scanner.factory(mode=mode)
+        detector.reuse_adapter_alignments = False
+        expected = detector.detect_barcode_batch(reads, [None] * len(reads),
+                                                 qcat_config)
+        assert not detector.detect_kit(reads, qcat_config)[1]
+        detector.reuse_adapter_alignments = True
+        results = detector.detect_barcode_batch(reads, [None] * len(reads),
+                                                qcat_config)
+        assert _result_summary(results) == _result_summary(expected)
+
+
+def test_run_kit_detector():
+    detector = kit_detection.RunKitDetector(recheck_rate=0.1, min_reads=100)
+    assert detector.get_stride() == 1
+
+    # No dominant kit: detected per batch, counts are discarded
+    assert detector.update({"A": 60, "B": 60}, "A") == "A"
+    assert detector.kit_name is None and detector.sampled_reads == 0
+
+    # Too few reads
+    assert detector.update({"A": 50}, "A") == "A"
+    assert detector.kit_name is None
+    assert detector.update({"B": 10, "A": 90}, "A") == "A"
+    assert detector.kit_name == "A"
+    assert detector.get_stride() == 10
+
+    # Re-checked reads are collected until KIT_RECHECK_MIN_READS
+    assert detector.update({"B": 150}, "B") == "A"
+    assert detector.update({"B": 100}, "B") == "B"
+    assert detector.kit_name is None
+    assert detector.get_stride() == 1
+
+    # Re-checking disabled
+    detector = kit_detection.RunKitDetector(recheck_rate=0.0, min_reads=10)
+    detector.update({"A": 100}, "A")
+    assert detector.get_stride() == 0
+    assert detector.update({}, None) == "A"
+
+
+def test_sticky_kit():
+    qcat_config = config.get_default_config()
+    seqs, quals = _read_test_batch()
+    nbd_seqs = [seq for seq, result in
+                zip(seqs, scanner.factory().detect_barcode_batch(seqs, quals))
+                if result['adapter'] and
+                result['adapter'].kit == "NBD104/NBD114"]
+
+    for mode, reads in [("epi2me", nbd_seqs), ("dual", _dual_reads())]:
+        detector = scanner.factory(mode=mode)
+        kit_name, _ = detector.detect_kit(reads, qcat_config)
+        expected = detector.detect_barcode_batch(reads, [None] * len(reads),
+                                                 qcat_config)
+
+        detector = scanner.factory(mode=mode, sticky_kit=True,
+                                   kit_recheck_rate=0.5)
+        detector.kit_detector.min_reads = 10
+        for _ in range(3):
+            results = detector.detect_barcode_batch(reads,
+                                                    [None] * len(reads),
+                                                    qcat_config)
+            assert _result_summary(results) == _result_summary(expected)
+        assert detector.kit_detector.kit_name == kit_name
+        assert detector.get_kit_stride() == 2
+
+
+def test_scheduler():
+    from multiprocessing.pool import ThreadPool
+
+    assert scheduler.estimate_read_cost(100, 150, True) == \
+        scheduler.estimate_read_cost(100, 150, False)
+    long_read = scheduler.estimate_read_cost(500000, 150, True)
+    assert long_read > 100 * scheduler.estimate_read_cost(5000, 150, True)
+    assert long_read > 1000 * scheduler.estimate_read_cost(500000, 150, False)
+
+    costs = [10] * 20 + [1000] + [10] * 20
+    units = scheduler.pack_by_cost(costs, 4)
+    # Units are contiguous, cover all reads and the expensive read is in a
+    # unit of its own
+    assert units[0][0] == 0 and units[-1][1] == len(costs)
+    assert all(a[1] == b[0] for a, b in zip(units, units[1:]))
+    assert (20, 21, 1000) in units
+    assert sum(cost for _, _, cost in units) == sum(costs)
+    assert scheduler.pack_by_cost([], 4) == []
+
+    pool = ThreadPool(2)
+    try:
+        results = scheduler.run_units(pool, lambda task: task * 2,
+                                      [1, 2, 3, 4], [1, 4, 2, 3])
+    finally:
+        pool.close()
+        pool.join()
+    assert results == [2, 4, 6, 8]
+
+
+def test_batch_sizer(tmpdir):
+    sizer = scheduler.BatchSizer(target_seconds=1.0, max_bytes=10000,
+                                 min_size=10, max_size=1000,
+                                 initial_size=100)
+    assert sizer.get_limits() == (100, 10000, 10)
+    # Fast reads: grows gradually, up to the maximum size
+    assert sizer.add_batch(100, 1000, 0.01) == 200
+    assert sizer.add_batch(200, 2000, 0.02) == 400
+    assert sizer.add_batch(400, 4000, 0.04) == 800
+    assert sizer.add_batch(800, 8000, 0.08) == 1000
+    # Long reads: the memory ceiling applies at once
+    assert sizer.add_batch(100, 1000000, 0.01) == 10
+
+    # Batches end at the memory ceiling (about 205 bytes per read), but not
+    # before they hold min_size reads
+    fastq = tmpdir.join("reads.fastq")
+    fastq.write("".join("@read{}\n{}\n+\n{}\n".format(i, "A" * 100,
+                                                       "I" * 100)
+                        for i in range(50)))
+    sizer = scheduler.BatchSizer(max_bytes=2000, min_size=5, initial_size=20)
+    assert [len(batch[0]) for batch in
+            cli.iter_fastx(str(fastq), True, sizer)] == [10] * 5
+    sizer = scheduler.BatchSizer(max_bytes=100, min_size=15, initial_size=20)
+    assert [len(batch[0]) for batch in
+            cli.iter_fastx(str(fastq), True, sizer)] == [15, 15, 15, 5]
+
+
+def test_transport():
+    seqs = ["", "ACGT", "A" * 10 + "C" * 10 + "G" * 10, "T" * 20]
+
+    for window_length in [0, 5, 10]:
+        packed_batch = transport.pack_batch(seqs, window_length)
+        try:
+            reads = list(transport.iter_packed_reads(packed_batch.get_slice(1, 4)))
+        finally:
+            packed_batch.close()
+
+        assert [length for _, length in reads] == [4, 30, 20]
+        assert [s for s, _ in reads] == [transport.get_window(s, window_length)
+                                         for s in seqs[1:]]
+
+    assert transport.get_window(seqs[2], 5) == "A" * 5 + "G" * 5
+    assert transport.get_window(seqs[2], 15) == seqs[2]
+
+
+def test_pipeline():
+    written = []
+
+    pipeline.Pipeline(queue_size=1).run(iter(range(20)),
+                                        lambda batch: batch * 2,
+                                        lambda batch, result: written.append((batch, result)))
+    assert written == [(i, i * 2) for i in range(20)]
+
+    def fail(batch):
+        raise ValueError("detection failed")
+
+    with pytest.raises(ValueError):
+        pipeline.Pipeline(queue_size=1).run(iter(range(20)), fail,
+                                            lambda batch, result: None)
+
+
+def test_pipeline_output_order():
+    import random
+    import time
+
+    def detect(batch):
+        time.sleep(random.random() * 0.01)
+        return batch * 2
+
+    for output_order in pipeline.OUTPUT_ORDERS:
+        written = []
+        p = pipeline.Pipeline(queue_size=2, detect_threads=4,
+                              output_order=output_order,
+                              sizeof=lambda batch: 1)
+        p.run(iter(range(50)), detect,
+              lambda batch, result: written.append((batch, result)))
+        if output_order == pipeline.ORDERED:
+            assert written == [(i, i * 2) for i in range(50)]
+            assert p.reorder_buffer.max_bytes == p.reorder_buffer.max_batches
+        else:
+            assert sorted(written) == [(i, i * 2) for i in range(50)]
+
+
+def _run_cli(tmpdir, name, argv, fastq=("qcat/test/data/nbd103.fastq",)):
+    out = os.path.join(str(tmpdir), name)
+    cli.main(["-f"] + list(fastq) + ["-b", out, "--trim"] + argv)
+    content = {}
+    for filename in os.listdir(out):
+        with open(os.path.join(out, filename)) as fh:
+            content[filename] = fh.read()
+    return content
+
+
+def test_cli_threads(tmpdir):
+    expected = _run_cli(tmpdir, "single", [])
+    assert sum(len(c) for c in expected.values()) > 0
+    assert _run_cli(tmpdir, "multi", ["-t", "2"]) == expected
+    assert _run_cli(tmpdir, "unordered", ["-t", "2", "--output-order",
+                                          "unordered"]) == expected
+
+
+def test_stream_reads(tmpdir):
+    filenames = ["qcat/test/data/nbd103.fastq"]
+    qcat_config = config.get_default_config()
+    detector = scanner.factory()
+
+    expected = []
+    for names, comments, seqs, quals in cli.iter_fastx_files(filenames,
+                                                              True, 1):
+        expected.append((names[0], comments[0], seqs[0], quals[0],
+                         detector.detect_barcode(seqs[0], quals[0],
+                                                 qcat_config)))
+
+    class Writer(object):
+        def __init__(self):
+            self.reads = []
+
+        def write_read(self, name, comment, sequence, quality, result):
+            self.reads.append((name, comment, sequence, quality, result))
+
+    writer = Writer()
+    cli.stream_reads(cli.iter_fastx_files_reads(filenames, True), detector,
+                     writer, qcat_config)
+    assert writer.reads == expected
+
+    # --no-batch writes the same reads with and without run-wide filtering,
+    # which still uses batches of one read
+    assert _run_cli(tmpdir, "stream", ["--no-batch"]) == \
+        _run_cli(tmpdir, "spilled", ["--no-batch", "--filter-barcodes",
+                                     "--filter-scope", "run"])
+
+
+def test_spill_file():
+    seqs, quals = _read_test_batch()
+    results = scanner.factory().detect_barcode_batch(seqs, quals)
+
+    spill_file = spill.SpillFile()
+    try:
+        # Batches are spilled in any order
+        spill_file.write(10, results[10:])
+        spill_file.write(0, results[:10])
+        assert list(spill_file.iter_results()) == results
+        barcode_count = {}
+        for result in results:
+            BarcodeScanner.update_barcode_count(result, barcode_count)
+        assert spill_file.barcode_count == barcode_count
+
+        spill_file.write(len(results) + 1, results[:1])
+        with pytest.raises(IOError):
+            list(spill_file.iter_results())
+    finally:
+        spill_file.close()
+
+
+def test_cli_filter_scope(tmpdir):
+    with open("qcat/test/data/nbd103.fastq") as fh:
+        lines = fh.read().splitlines()
+    records = [lines[i:i + 4] for i in range(0, len(lines), 4)]
+    results = scanner.factory().detect_barcode_batch(
+        [record[1] for record in records], [record[3] for record in records])
+    barcoded = {}
+    for record, result in zip(records, results):
+        if result['barcode']:
+            barcoded.setdefault(result['barcode'].id, record)
+    common, rare = [barcoded[i] for i in sorted(barcoded)[:2]]
+
+    def write_fastq(name, reads):
+        content = []
+        for i, record in enumerate(reads):
+            content += ["@{}_{}".format(name, i)] + record[1:]
+        tmpdir.join(name + ".fastq").write("\n".join(content) + "\n")
+        return str(tmpdir.join(name + ".fastq"))
+
+    # Each input file is a batch of its own. The rare barcode is filtered
+    # in the first batch, but not in the whole run
+    first = [common] * 40 + [rare]
+    second = [rare] * 10
+    halves = [write_fastq("first", first), write_fastq("second", second)]
+    single = write_fastq("single", first + second)
+
+    def read_counts(content):
+        return dict((filename, text.count("\n") // 4)
+                    for filename, text in content.items())
+
+    expected = read_counts(_run_cli(tmpdir, "single", ["--filter-barcodes"],
+                                    fastq=[single]))
+    assert sorted(expected.values()) == [11, 40]
+    batch = read_counts(_run_cli(tmpdir, "batch", ["--filter-barcodes"],
+                                 fastq=halves))
+    assert sorted(batch.values()) == [10, 40]
+    for name, argv in [("run", []), ("run_threads", ["-t", "2"])]:
+        run = _run_cli(tmpdir, name, ["--filter-barcodes", "--filter-scope",
+                                      "run"] + argv, fastq=halves)
+        assert read_counts(run) == expected
+
+
+def test_cli_input_folder(tmpdir):
+    folder = tmpdir.mkdir("input")
+    for name in ["nbd103.fastq", "rbk004.fastq"]:
+        with open(os.path.join("qcat/test/data", name)) as fh:
+            folder.join(name).write(fh.read())
+    folder.join("notes.txt").write("not a read file")
+
+    filenames = cli.get_input_files([str(folder)])
+    assert [os.path.basename(f) for f in filenames] == ["nbd103.fastq",
+                                                        "rbk004.fastq"]
+    assert cli.get_input_files([str(folder.join("*.fastq"))]) == filenames
+    assert cli.get_input_files(None) == [None]
+    with pytest.raises(IOError):
+        cli.get_input_files([str(folder.join("*.fa"))])
+
+    expected = _run_cli(tmpdir, "single", [], fastq=filenames)
+    assert sum(len(c) for c in expected.values()) > 0
+    assert _run_cli(tmpdir, "folder", ["-t", "2"],
+                    fastq=[str(folder)]) == expected
+
+
+def test_shard_merge(tmpdir, capsys):
+    fastq = "qcat/test/data/nbd103.fastq"
+    names = [name for batch in cli.iter_fastx(fastq, True, 100)
+             for name in batch[0]]
+    shards = [[name for batch in cli.iter_fastx(fastq, True, 100, (i, 3))
+               for name in batch[0]] for i in range(1, 4)]
+    # Each read is in exactly one shard
+    assert sorted(sum(shards, [])) == sorted(names)
+
+    out = str(tmpdir)
+    argv = ["-f", fastq, "--trim", "--tsv", "--quiet", "-k", "NBD103/NBD104"]
+    capsys.readouterr()
+    cli.main(argv + ["-b", os.path.join(out, "single"),
+                     "--summary", os.path.join(out, "single.json")])
+    expected_tsv = capsys.readouterr().out
+    for i in range(1, 4):
+        cli.main(argv + ["-b", os.path.join(out, "shard{}".format(i)),
+                         "--shard", "{}/3".format(i),
+                         "--summary", os.path.join(out, "shard{}.json".format(i))])
+        tmpdir.join("shard{}.tsv".format(i)).write(capsys.readouterr().out)
+
+    merge.main([os.path.join(out, "shard{}".format(i)) for i in range(1, 4)] +
+               ["-b", os.path.join(out, "merged"), "--quiet",
+                "--tsv-files"] +
+               [os.path.join(out, "shard{}.tsv".format(i)) for i in range(1, 4)] +
+               ["--tsv-output", os.path.join(out, "merged.tsv"),
+                "--summary-files"] +
+               [os.path.join(out, "shard{}.json".format(i)) for i in range(1, 4)] +
+               ["--summary", os.path.join(out, "merged.json")])
+
+    def records(folder):
+        content = {}
+        for filename in os.listdir(folder):
+            with open(os.path.join(folder, filename)) as fh:
+                lines = fh.read().splitlines()
+            content[filename] = sorted(zip(*[iter(lines)] * 4))
+        return content
+
+    assert records(os.path.join(out, "merged")) == \
+        records(os.path.join(out, "single"))
+    merged_tsv = tmpdir.join("merged.tsv").read().splitlines()
+    expected_tsv = expected_tsv.splitlines()
+    assert merged_tsv[0] == expected_tsv[0]
+    assert sorted(merged_tsv[1:]) == sorted(expected_tsv[1:])
+    assert cli.read_summary(os.path.join(out, "merged.json")) == \
+        cli.read_summary(os.path.join(out, "single.json"))
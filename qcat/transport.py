@@ -0,0 +1,197 @@
+"""
+Transport of read batches to worker processes.
+
+Barcode detection only looks at the first and last
+qcatConfig.max_align_length bp of a read (unless middle adapters are
+scanned). Instead of pickling every read, the sequences of a batch are
+packed into a single shared memory block together with an offsets array.
+Workers attach to the block and only decode the read ends they need.
+
+Packed reads are passed to the workers as "windowed" sequences: for reads
+longer than 2 * window_length, the 5' and 3' windows are concatenated.
+Adapter and barcode detection on the windowed sequence gives the same
+result as on the full read, except for trim3p which is shifted by the
+number of bp that were left out (see fix_windowed_result).
+"""
+import struct
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+_OFFSET = struct.Struct("q")
+
+
+def get_window(read_sequence, window_length):
+    """
+    Returns the part of the read used for barcode detection
+
+    :param read_sequence: Read sequence
+    :param window_length: Number of bp at each end of the read. If 0,
+    the full read is returned
+    :return: Windowed sequence
+    :rtype: str
+    """
+    if window_length > 0 and len(read_sequence) > 2 * window_length:
+        return read_sequence[:window_length] + read_sequence[-window_length:]
+    return read_sequence
+
+
+def fix_windowed_result(result, windowed_length, read_length):
+    """
+    Convert the trimming position of a result computed on a windowed
+    sequence to the full read
+
+    :param result: see build_return_dict
+    :param windowed_length: Length of the windowed sequence
+    :param read_length: Length of the full read
+    :return: result
+    """
+    result['trim3p'] += read_length - windowed_length
+    return result
+
+
+def _attach(name):
+    """
+    Attach to an existing shared memory block without taking ownership.
+    The block is unlinked by the process that created it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: attaching registers the block again. Workers share
+        # the resource tracker of the parent process (see
+        # ensure_resource_tracker), so this is a no-op. Unregistering here
+        # would remove the parent's registration and make the tracker fail
+        # when the parent unlinks the block.
+        return shared_memory.SharedMemory(name=name)
+
+
+def iter_packed_reads(packed):
+    """
+    Iterate over reads sent to a worker process
+
+    :param packed: Return value of SharedBatch.get_slice or
+    PickledBatch.get_slice
+    :return: Windowed sequence, length of the full read
+    :rtype: str, int
+    """
+    if packed[0] == "pickle":
+        _, reads = packed
+        for read in reads:
+            yield read
+        return
+
+    _, name, start, stop, window_length = packed
+    shm = _attach(name)
+    try:
+        buf = shm.buf
+        for i in range(start, stop):
+            read_start = _OFFSET.unpack_from(buf, i * _OFFSET.size)[0]
+            read_end = _OFFSET.unpack_from(buf, (i + 1) * _OFFSET.size)[0]
+            read_length = read_end - read_start
+            if 0 < window_length and 2 * window_length < read_length:
+                sequence = bytes(buf[read_start:read_start + window_length]) + \
+                           bytes(buf[read_end - window_length:read_end])
+            else:
+                sequence = bytes(buf[read_start:read_end])
+            yield sequence.decode("ascii"), read_length
+        del buf
+    finally:
+        shm.close()
+
+
+class SharedBatch(object):
+    """
+    Read sequences of a batch packed into one shared memory block.
+
+    Layout: n + 1 int64 offsets followed by the concatenated sequences.
+    Offsets are relative to the start of the block.
+    """
+
+    def __init__(self, read_sequences, window_length):
+        """
+        Init
+
+        :param read_sequences: List of read sequences
+        :param window_length: Number of bp at each end of a read that
+        workers need. 0 for full reads
+        """
+        self.window_length = window_length
+
+        header_size = (len(read_sequences) + 1) * _OFFSET.size
+        data_size = sum(len(s) for s in read_sequences)
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=max(1, header_size + data_size))
+
+        buf = self.shm.buf
+        offset = header_size
+        for i, read_sequence in enumerate(read_sequences):
+            _OFFSET.pack_into(buf, i * _OFFSET.size, offset)
+            buf[offset:offset + len(read_sequence)] = read_sequence.encode("ascii")
+            offset += len(read_sequence)
+        _OFFSET.pack_into(buf, len(read_sequences) * _OFFSET.size, offset)
+        del buf
+
+    def get_slice(self, start, stop):
+        """
+        Task argument passed to a worker
+
+        :param start: Index of first read
+        :param stop: Index after last read
+        :return: tuple, see iter_packed_reads
+        """
+        return "shm", self.shm.name, start, stop, self.window_length
+
+    def close(self):
+        """
+        Release the shared memory block
+
+        :return: None
+        """
+        self.shm.close()
+        self.shm.unlink()
+
+
+class PickledBatch(object):
+    """
+    Fallback if shared memory is not available: only the windowed
+    sequences are pickled and sent to the workers
+    """
+
+    def __init__(self, read_sequences, window_length):
+        self.reads = [(get_window(s, window_length), len(s))
+                      for s in read_sequences]
+
+    def get_slice(self, start, stop):
+        return "pickle", self.reads[start:stop]
+
+    def close(self):
+        pass
+
+
+def pack_batch(read_sequences, window_length):
+    """
+    Pack read sequences for transport to worker processes
+
+    :param read_sequences: List of read sequences
+    :param window_length: Number of bp at each end of a read that
+    workers need. 0 for full reads
+    :return: SharedBatch or PickledBatch
+    """
+    if shared_memory:
+        return SharedBatch(read_sequences, window_length)
+    return PickledBatch(read_sequences, window_length)
+
+
+def ensure_resource_tracker():
+    """
+    Start the resource tracker before forking worker processes so that all
+    workers share it
+
+    :return: None
+    """
+    if shared_memory:
+        resource_tracker.ensure_running()
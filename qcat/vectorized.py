@@ -0,0 +1,440 @@
+"""
+Vectorized semi-global alignment of barcode sets (NumPy).
+
+All barcodes of a set have the same length (see layout.AdapterLayout), so
+barcodes with context can be stored as one 2-D array. Instead of aligning
+each barcode separately, the dynamic programming matrices of all barcodes,
+and optionally of many barcode regions, are computed at once: the DP
+iterates over the positions of barcode and context, each step updates the
+scores of all barcodes and all positions in all read regions.
+
+Scores are those of parasail.sg (semi-global alignment, free end gaps,
+affine gap penalties: a gap of length L costs open + (L - 1) * extend).
+"""
+import numpy
+
+from collections import namedtuple
+
+from qcat import config
+
+# Maximum size of the DP arrays (barcodes x regions x region length) in
+# score_barcodes_batch. Regions are aligned in chunks that fit. Small chunks
+# stay in the CPU cache
+MAX_CELLS = 250000
+
+# Barcode sets are cached by (id(barcode_set), upstream, downstream context,
+# matrix key). Matrices are keyed by their scores (see
+# config.get_matrix_key), so the cache does not grow when a config is
+# unpickled in a worker process
+_barcode_sets = {}
+
+# Single alignment target (see align_target). Has the sequence attribute of
+# a Barcode, so it can be aligned as a barcode set of size one
+Target = namedtuple("Target", "sequence")
+
+# Single targets are cached by (target sequence, matrix key)
+_targets = {}
+
+
+def prefix_max(values):
+    """
+    In-place running maximum along the first axis. Same as
+    numpy.maximum.accumulate(values, axis=0), but with log2(len(values))
+    operations on whole rows, which is considerably faster than the
+    column-wise accumulate.
+
+    :param values: numpy array
+    :return: values
+    """
+    step = 1
+    while step < values.shape[0]:
+        numpy.maximum(values[step:], values[:-step], out=values[step:])
+        step *= 2
+    return values
+
+
+def get_score_table(matrix):
+    """
+    Converts a parasail scoring matrix to a lookup table
+
+    :param matrix: parasail scoring matrix
+    :return: ASCII code -> row index array, score table
+    """
+    mapper = numpy.array(matrix.mapper[:256], dtype=numpy.intp)
+    table = numpy.array(matrix.matrix, dtype=numpy.int32)
+    return mapper, table
+
+
+class NumpyBarcodeSet(object):
+    """
+    Barcodes of a barcode set (with context) as 2-D array
+    """
+
+    def __init__(self, barcode_set, matrix, upstream_context="",
+                 downstream_context=""):
+        """
+        :param barcode_set: List of Barcode tuples (all of the same length)
+        :param matrix: parasail scoring matrix
+        :param upstream_context: Sequence upstream of barcode in adapter
+        :param downstream_context: Sequence downstream of barcode in adapter
+        """
+        self.barcode_set = barcode_set
+        patterns = [upstream_context + barcode.sequence + downstream_context
+                    for barcode in barcode_set]
+        self.length = len(patterns[0]) if patterns else 0
+        if any(len(pattern) != self.length for pattern in patterns):
+            raise RuntimeError("Barcodes of a set must have the same length")
+
+        self.mapper, self.table = get_score_table(matrix)
+        self.patterns = numpy.array(
+            [self.encode(pattern) for pattern in patterns],
+            dtype=numpy.intp).reshape(len(patterns), self.length)
+
+    def encode(self, sequence):
+        """
+        :param sequence: str
+        :return: Array of row indices into the score table
+        """
+        codes = numpy.frombuffer(sequence.encode("ascii"), dtype=numpy.uint8)
+        return self.mapper[codes]
+
+    def align(self, read_sequences, gap_open, gap_extend):
+        """
+        Semi-global alignment of all barcodes to all read regions
+
+        :param read_sequences: List of barcode regions (not empty)
+        :param gap_open: Gap open penalty
+        :param gap_extend: Gap extension penalty
+        :return: Scores and end positions in the read regions. Arrays of
+        shape (barcodes, regions)
+        """
+        n_barcodes = self.patterns.shape[0]
+        n_reads = len(read_sequences)
+        lengths = numpy.array([len(seq) for seq in read_sequences])
+        n = int(lengths.max())
+
+        # Pad regions with the '*' row of the score table. Padding is never
+        # used: cells right of the region end don't influence cells within
+        # the region
+        reads = numpy.full((n_reads, n), self.table.shape[0] - 1,
+                           dtype=numpy.intp)
+        for r, seq in enumerate(read_sequences):
+            reads[r, :len(seq)] = self.encode(seq)
+        # Scores are bounded by the length of region and pattern, so 16 bit
+        # integers are sufficient for barcodes. Halves the memory traffic.
+        bound = (n + self.length) * (int(numpy.abs(self.table).max()) +
+                                     gap_open + gap_extend)
+        dtype = numpy.int16 if bound < 8000 else numpy.int32
+        neg_inf = numpy.iinfo(dtype).min // 2
+
+        # Score of each pattern base against each read position, axes:
+        # region position, pattern base, region
+        profile = self.table.astype(dtype)[:, reads].transpose(2, 0, 1).copy()
+
+        # Axes: region position (row 0: before the region), barcode, region.
+        # The prefix maximum for horizontal gaps runs along the first axis,
+        # so all operations work on contiguous rows of barcodes x regions
+        shape = (n + 1, n_barcodes, n_reads)
+        # H: best score ending at (i, j), F: ending with a gap in the read
+        h = numpy.zeros(shape, dtype=dtype)
+        h_next = numpy.zeros(shape, dtype=dtype)
+        f = numpy.full(shape, neg_inf, dtype=dtype)
+        tmp = numpy.empty(shape, dtype=dtype)
+        # Horizontal gaps: E[j] = max over k < j of
+        # H[k] - open - (j - 1 - k) * extend
+        ramp = (numpy.arange(n + 1, dtype=dtype) *
+                dtype(gap_extend))[:, None, None]
+        e_offset = ramp[:-1] + dtype(gap_open)
+
+        read_index = numpy.arange(n_reads)
+        # Best score in the last column (end of each region), excluding the
+        # last row. Like parasail, ties are resolved in favour of the end of
+        # the region, otherwise of the first position in the last row
+        col_score = numpy.full((n_barcodes, n_reads), neg_inf, dtype=dtype)
+        linear = gap_open == gap_extend
+        for i in range(self.length):
+            numpy.take(profile, self.patterns[:, i], axis=1, out=tmp[1:])
+            numpy.add(h[:-1], tmp[1:], out=h_next[1:])
+            if linear:
+                # Linear gap costs: F[i, j] = H[i - 1, j] - extend and
+                # H[j] = max over k <= j of (H'[k] - (j - k) * extend),
+                # where H' does not contain horizontal gaps
+                numpy.subtract(h[1:], dtype(gap_extend), out=tmp[1:])
+                numpy.maximum(h_next[1:], tmp[1:], out=h_next[1:])
+                numpy.add(h_next, ramp, out=h_next)
+                prefix_max(h_next)
+                numpy.subtract(h_next, ramp, out=h_next)
+            else:
+                numpy.subtract(f, dtype(gap_extend), out=f)
+                numpy.subtract(h, dtype(gap_open), out=tmp)
+                numpy.maximum(f, tmp, out=f)
+                numpy.maximum(h_next[1:], f[1:], out=h_next[1:])
+
+                numpy.add(h_next, ramp, out=tmp)
+                prefix_max(tmp)
+                numpy.subtract(tmp[:-1], e_offset, out=tmp[:-1])
+                numpy.maximum(h_next[1:], tmp[:-1], out=h_next[1:])
+            h, h_next = h_next, h
+            if i < self.length - 1:
+                numpy.maximum(col_score, h[lengths, :, read_index].T,
+                              out=col_score)
+
+        # Best score in the last row within each region
+        positions = numpy.arange(1, n + 1)
+        in_region = positions[:, None] <= lengths[None, :]
+        last_row = numpy.where(in_region[:, None, :], h[1:], neg_inf)
+        row_end = last_row.argmax(axis=0)
+        row_score = numpy.take_along_axis(last_row, row_end[None],
+                                          axis=0)[0]
+
+        use_row = row_score > col_score
+        scores = numpy.maximum(row_score, col_score)
+        ends = numpy.where(use_row, row_end, lengths[None, :] - 1)
+        return scores, ends
+
+    def align_banded(self, read_sequences, offsets, width, gap_open,
+                     gap_extend):
+        """
+        Banded version of align. Only cells close to the expected diagonal
+        are computed: pattern base i (0-based) can only be aligned to read
+        positions i + offset - width to i + offset + width. Scores are the
+        same as with align if the optimal alignment stays within the band,
+        otherwise they can be lower.
+
+        The DP matrices are stored band-major: row i, band position k
+        corresponds to column j = i + offset - width + k of the full matrix
+        (column 0: before the region). Diagonal steps keep k, vertical steps
+        (gap in the read) come from k + 1 of the previous row and
+        horizontal steps from k - 1 of the same row.
+
+        :param read_sequences: List of barcode regions (not empty)
+        :param offsets: Expected position of the first pattern base in each
+        region (may be negative)
+        :param width: Band width (bp on each side of the expected diagonal)
+        :param gap_open: Gap open penalty
+        :param gap_extend: Gap extension penalty
+        :return: see align
+        """
+        n_barcodes = self.patterns.shape[0]
+        n_reads = len(read_sequences)
+        m = self.length
+        band = 2 * width + 1
+        lengths = numpy.array([len(seq) for seq in read_sequences])
+        # Column of band position 0 in row 0
+        starts = numpy.asarray(offsets, dtype=numpy.intp) - width
+
+        # Region bases in band coordinates: row i (1-based) uses
+        # reads[:, i - 1:i - 1 + band]. Outside the region: '*' row
+        pad = self.table.shape[0] - 1
+        reads = numpy.full((n_reads, m + band - 1), pad, dtype=numpy.intp)
+        for r, seq in enumerate(read_sequences):
+            codes = self.encode(seq)
+            first = max(0, -starts[r])
+            last = min(reads.shape[1], len(seq) - starts[r])
+            if first < last:
+                reads[r, first:last] = codes[starts[r] + first:
+                                             starts[r] + last]
+
+        bound = (int(lengths.max()) + m) * \
+            (int(numpy.abs(self.table).max()) + gap_open + gap_extend)
+        dtype = numpy.int16 if bound < 8000 else numpy.int32
+        neg_inf = numpy.iinfo(dtype).min // 2
+
+        # Axes: band position, pattern base, region
+        profile = self.table.astype(dtype)[:, reads].transpose(2, 0, 1).copy()
+
+        shape = (band, n_barcodes, n_reads)
+        h = numpy.empty(shape, dtype=dtype)
+        h_next = numpy.empty(shape, dtype=dtype)
+        f = numpy.full(shape, neg_inf, dtype=dtype)
+        tmp = numpy.empty(shape, dtype=dtype)
+        ramp = (numpy.arange(band, dtype=dtype) *
+                dtype(gap_extend))[:, None, None]
+        e_offset = ramp[:-1] + dtype(gap_open)
+        linear = gap_open == gap_extend
+
+        read_index = numpy.arange(n_reads)
+
+        # Columns of all cells, axes: row, band position, region. Cells left
+        # of column 0 and right of the region end don't exist, cells in
+        # column 0 have score 0
+        columns = numpy.arange(m + 1)[:, None, None] + \
+            numpy.arange(band)[None, :, None] + starts[None, None, :]
+        outside_all = ((columns < 0) |
+                       (columns > lengths[None, None, :]))[:, :, None, :]
+        zero_all = (columns == 0)[:, :, None, :]
+        has_zero = zero_all.any(axis=(1, 2, 3))
+        # Band position of the last column of the region in each row
+        region_end = lengths[None, :] - starts[None, :] - \
+            numpy.arange(m + 1)[:, None]
+        end_in_band = (region_end >= 0) & (region_end < band)
+        region_end = numpy.clip(region_end, 0, band - 1)
+
+        h.fill(0)
+        numpy.copyto(h, neg_inf, where=outside_all[0])
+
+        col_score = numpy.full((n_barcodes, n_reads), neg_inf, dtype=dtype)
+        for i in range(1, m + 1):
+            outside = outside_all[i]
+            numpy.take(profile[i - 1:i - 1 + band], self.patterns[:, i - 1],
+                       axis=1, out=tmp)
+            numpy.add(h, tmp, out=h_next)
+            # Vertical gaps: cell above is at k + 1 in the previous row
+            if linear:
+                numpy.subtract(h[1:], dtype(gap_extend), out=tmp[:-1])
+                numpy.maximum(h_next[:-1], tmp[:-1], out=h_next[:-1])
+            else:
+                f[:-1] = f[1:]
+                f[-1] = neg_inf
+                numpy.subtract(f, dtype(gap_extend), out=f)
+                numpy.subtract(h[1:], dtype(gap_open), out=tmp[:-1])
+                numpy.maximum(f[:-1], tmp[:-1], out=f[:-1])
+                numpy.maximum(h_next, f, out=h_next)
+            if has_zero[i]:
+                numpy.copyto(h_next, 0, where=zero_all[i])
+            numpy.copyto(h_next, neg_inf, where=outside)
+
+            # Horizontal gaps
+            if linear:
+                numpy.add(h_next, ramp, out=h_next)
+                prefix_max(h_next)
+                numpy.subtract(h_next, ramp, out=h_next)
+            else:
+                numpy.add(h_next, ramp, out=tmp)
+                prefix_max(tmp)
+                numpy.subtract(tmp[:-1], e_offset, out=tmp[:-1])
+                numpy.maximum(h_next[1:], tmp[:-1], out=h_next[1:])
+            numpy.copyto(h_next, neg_inf, where=outside)
+            h, h_next = h_next, h
+
+            if i < m and end_in_band[i].any():
+                # Cell in the last column of the region
+                end_score = h[region_end[i], :, read_index].T
+                numpy.maximum(col_score,
+                              numpy.where(end_in_band[i][None, :], end_score,
+                                          neg_inf),
+                              out=col_score)
+
+        # Best score in the last row within each region (excluding column 0)
+        last_row = numpy.where(outside_all[m] | zero_all[m], neg_inf, h)
+        row_k = last_row.argmax(axis=0)
+        row_score = numpy.take_along_axis(last_row, row_k[None], axis=0)[0]
+        row_end = row_k + (starts + m)[None, :] - 1
+
+        use_row = row_score > col_score
+        scores = numpy.maximum(row_score, col_score)
+        ends = numpy.where(use_row, row_end, lengths[None, :] - 1)
+        return scores, ends
+
+
+def get_barcode_set(barcode_set, matrix, upstream_context="",
+                    downstream_context=""):
+    """
+    Returns the (cached) NumpyBarcodeSet of a barcode set
+
+    :param barcode_set: List of Barcode tuples
+    :param matrix: parasail scoring matrix
+    :param upstream_context: Sequence upstream of barcode in adapter
+    :param downstream_context: Sequence downstream of barcode in adapter
+    :return: NumpyBarcodeSet
+    """
+    key = (id(barcode_set), upstream_context, downstream_context,
+           config.get_matrix_key(matrix))
+    numpy_set = _barcode_sets.get(key)
+    if numpy_set is None or numpy_set.barcode_set is not barcode_set:
+        numpy_set = NumpyBarcodeSet(barcode_set, matrix, upstream_context,
+                                    downstream_context)
+        _barcode_sets[key] = numpy_set
+    return numpy_set
+
+
+def score_barcodes_batch(barcode_regions, barcode_set, matrix,
+                         upstream_context="", downstream_context="",
+                         gap_open=1, gap_extend=1, offsets=None,
+                         band_width=None):
+    """
+    Scores all barcodes of a set against many barcode regions
+
+    :param barcode_regions: List of barcode regions
+    :param barcode_set: List of Barcode tuples
+    :param matrix: parasail scoring matrix
+    :param upstream_context: Sequence upstream of barcode in adapter
+    :param downstream_context: Sequence downstream of barcode in adapter
+    :param gap_open: Gap open penalty
+    :param gap_extend: Gap extension penalty
+    :param offsets: Expected position of the first bp of upstream context
+    in each region. If set, regions are aligned with a band of band_width
+    bp around the expected diagonal (see NumpyBarcodeSet.align_banded)
+    :param band_width: Band width
+    :return: One list per region (None for empty regions) of
+    (score (0-100), identity (always 0.0), position of the last aligned bp
+    in the read) tuples
+    """
+    numpy_set = get_barcode_set(barcode_set, matrix, upstream_context,
+                                downstream_context)
+    results = [None] * len(barcode_regions)
+    todo = [i for i, region in enumerate(barcode_regions) if region]
+    if not todo or not barcode_set:
+        return results
+
+    banded = offsets is not None and band_width is not None
+    if banded:
+        n = 2 * band_width + 1
+    else:
+        n = max(len(barcode_regions[i]) for i in todo) + 1
+    chunk = max(1, MAX_CELLS // (len(barcode_set) * n))
+    length = float(numpy_set.length)
+    for start in range(0, len(todo), chunk):
+        indices = todo[start:start + chunk]
+        regions = [barcode_regions[i] for i in indices]
+        if banded:
+            scores, ends = numpy_set.align_banded(
+                regions, [offsets[i] for i in indices], band_width,
+                gap_open, gap_extend)
+        else:
+            scores, ends = numpy_set.align(regions, gap_open, gap_extend)
+        scores = scores * 100.0 / length
+        for r, i in enumerate(indices):
+            results[i] = [(float(score), 0.0, int(end))
+                          for score, end in zip(scores[:, r], ends[:, r])]
+    return results
+
+
+def score_barcodes(barcode_region_read, barcode_set, matrix,
+                   upstream_context="", downstream_context="",
+                   gap_open=1, gap_extend=1, offset=None, band_width=None):
+    """
+    Scores all barcodes of a set against the barcode region of a read
+
+    :return: see score_barcodes_batch
+    """
+    offsets = None
+    if offset is not None:
+        offsets = [offset]
+    return score_barcodes_batch([barcode_region_read], barcode_set, matrix,
+                                upstream_context, downstream_context,
+                                gap_open, gap_extend, offsets,
+                                band_width)[0]
+
+
+def align_target(read_sequence, target, matrix, gap_open, gap_extend):
+    """
+    Semi-global alignment of a single target (e.g. adapter template) to a
+    read window. Used by align.NumpyBackend.
+
+    :param read_sequence: Read window (not empty)
+    :param target: Target sequence
+    :param matrix: parasail scoring matrix
+    :param gap_open: Gap open penalty
+    :param gap_extend: Gap extension penalty
+    :return: Score, position of the last aligned bp in the read
+    :rtype: int, int
+    """
+    key = (target, config.get_matrix_key(matrix))
+    numpy_set = _targets.get(key)
+    if numpy_set is None:
+        numpy_set = NumpyBarcodeSet([Target(target)], matrix)
+        _targets[key] = numpy_set
+    scores, ends = numpy_set.align([read_sequence], gap_open, gap_extend)
+    return int(scores[0, 0]), int(ends[0, 0])
+
@@ -17,6 +17,7 @@ setup(
     author_email='philipp.rescheneder@nanoporetech.com',
     install_requires=[
         'biopython',
+        'numpy',
         'parasail',
         'six',
         'pyyaml'
@@ -41,5 +42,7 @@ setup(
     entry_points={"console_scripts": ['qcat = qcat.cli:main',
                                       'qcat-eval = qcat.eval:main',
                                       'qcat-roc = qcat.eval_roc:main',
-                                      'qcat-eval-truth = qcat.eval_full:main']}
+                                      'qcat-eval-truth = qcat.eval_full:main',
+                                      'qcat-merge = qcat.merge:main',
+                                      'qcat-benchmark = qcat.benchmark:main']}
 )
\ No newline at end of file